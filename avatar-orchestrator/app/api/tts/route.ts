@@ -48,10 +48,23 @@ export async function POST(req: NextRequest) {
       method: "POST",
       headers: { "Content-Type": "application/json" },
       body: JSON.stringify(coquiPayload),
+      // browser went away → Coqui cancels the synthesis
+      signal: req.signal,
     });
 
     console.log("TTS ROUTE → Coqui HTTP status:", resp.status);
 
+    if (resp.status === 429) {
+      const retryAfter = resp.headers.get("retry-after") ?? "1";
+
+      console.warn("TTS ROUTE → Coqui queue full, retry after", retryAfter);
+
+      return new NextResponse("TTS busy, retry later", {
+        status: 429,
+        headers: { "Content-Type": "text/plain", "Retry-After": retryAfter },
+      });
+    }
+
     if (!resp.ok) {
       const rawErrorHtml = await resp.text();
 
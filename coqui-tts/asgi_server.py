@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""Async (ASGI) front-end for server.py.
+
+Takes the same command line as server.py; importing server loads the synthesizer
+and starts the scheduler worker. Requests are parsed and validated on the event
+loop, synthesis runs on the scheduler's single bounded worker, and a full queue
+is answered right away with 429 + Retry-After instead of parking a thread per
+request. The legacy Flask routes (/, /details, MaryTTS) are mounted behind it.
+
+    python3 asgi_server.py --model_path ... --config_path ... --port 5002
+"""
+import asyncio
+import io
+import struct
+
+import numpy as np
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Mount, Route
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:  # older stacks: starlette's own (deprecated) adapter
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import server
+from server import args, parse_tts_request, scheduler, synthesizer, validate_tts_request
+from tts_scheduler import JobCancelled, QueueFull
+
+# how often a waiting request checks whether its client went away
+DISCONNECT_POLL_S = 0.1
+
+
+def cancelled_response(e: JobCancelled):
+    # 504 when the deadline passed, 499 (client closed request) for explicit cancels
+    status = 504 if e.reason == "deadline" else 499
+    return JSONResponse({"error": str(e), "reason": e.reason}, status_code=status)
+
+
+def queue_full_response(e: QueueFull):
+    return JSONResponse({"error": str(e)}, status_code=429, headers={"Retry-After": str(e.retry_after)})
+
+
+def wav_stream_header(sample_rate, channels=1, bits=16):
+    """RIFF header with unknown (max) sizes, as used for streamed PCM WAV."""
+    byte_rate = sample_rate * channels * bits // 8
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * bits // 8, bits)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF)
+    )
+
+
+def to_pcm16(samples):
+    # streamed chunks cannot be peak-normalized over the whole answer like
+    # Synthesizer.save_wav does, XTTS output is already in [-1, 1]
+    wav = np.clip(np.asarray(samples, dtype=np.float32), -1.0, 1.0)
+    return (wav * 32767).astype("<i2").tobytes()
+
+
+async def read_request(request):
+    json_data = None
+    if request.headers.get("content-type", "").startswith("application/json"):
+        try:
+            json_data = await request.json()
+        except ValueError:
+            json_data = None
+        if not isinstance(json_data, dict):
+            json_data = {}
+    values = dict(request.query_params)
+    if request.method == "POST" and json_data is None:
+        form = await request.form()
+        values.update({k: v for k, v in form.items() if isinstance(v, str)})
+    return json_data, values
+
+
+async def watch_job(request, job, fut):
+    """Await fut without blocking a thread; cancel the job if the client leaves or the deadline passes."""
+    while not fut.done():
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), timeout=DISCONNECT_POLL_S)
+        except asyncio.TimeoutError:
+            if await request.is_disconnected():
+                job.cancel("disconnected")
+            elif job.expired():
+                job.cancel("deadline")
+    return fut.result()
+
+
+async def wait_for_job(request, job):
+    loop = asyncio.get_running_loop()
+    done = loop.create_future()
+    job.add_done_callback(lambda _job: loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None)))
+    await watch_job(request, job, done)
+    return job.wait(timeout=0)
+
+
+async def tts(request):
+    json_data, values = await read_request(request)
+    try:
+        fields = parse_tts_request(request.headers, values, json_data)
+    except (ValueError, TypeError) as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    error = validate_tts_request(fields)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    server.app.logger.info(f"Model input: {fields['text']}")
+    server.app.logger.info(f"Schedule: {fields['schedule_args']} stream={fields['stream']}")
+
+    if fields["stream"]:
+        return await tts_stream(request, fields)
+
+    try:
+        job = scheduler.submit(fields["text"], fields["synth_kwargs"], **fields["schedule_args"])
+    except QueueFull as e:
+        return queue_full_response(e)
+    try:
+        wavs = await wait_for_job(request, job)
+    except JobCancelled as e:
+        return cancelled_response(e)
+    finally:
+        scheduler.release(job)
+
+    out = io.BytesIO()
+    await asyncio.get_running_loop().run_in_executor(None, synthesizer.save_wav, wavs, out)
+    return Response(out.getvalue(), media_type="audio/wav")
+
+
+async def tts_stream(request, fields):
+    """Chunked WAV: the header right away, then PCM for every finished sentence."""
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+
+    def on_chunk(samples):
+        loop.call_soon_threadsafe(chunks.put_nowait, samples)
+
+    try:
+        job = scheduler.submit(fields["text"], fields["synth_kwargs"], on_chunk=on_chunk, **fields["schedule_args"])
+    except QueueFull as e:
+        return queue_full_response(e)
+    job.add_done_callback(lambda _job: loop.call_soon_threadsafe(chunks.put_nowait, None))
+
+    # hold the response until the first sentence so that errors, cancels and
+    # missed deadlines still get a proper status code
+    first = await watch_job(request, job, asyncio.ensure_future(chunks.get()))
+    if first is None:
+        scheduler.release(job)
+        try:
+            job.wait(timeout=0)
+        except JobCancelled as e:
+            return cancelled_response(e)
+
+    async def body():
+        try:
+            yield wav_stream_header(synthesizer.output_sample_rate)
+            item = first
+            while item is not None:
+                yield to_pcm16(item)
+                item = await chunks.get()
+        finally:
+            # no-op once finished; stops the remaining sentences when the client hung up
+            job.cancel("disconnected")
+            scheduler.release(job)
+
+    return StreamingResponse(body(), media_type="audio/wav")
+
+
+async def tts_cancel(request):
+    """Cancel queued / running synthesis, e.g. on barge-in: by request_id and/or session_id"""
+    json_data, values = await read_request(request)
+    request_id = server.get_request_field(request.headers, values, json_data, "request-id", "request_id")
+    session_id = server.get_request_field(request.headers, values, json_data, "session-id", "session_id")
+    if request_id is None and session_id is None:
+        return JSONResponse({"error": "request_id or session_id is required"}, status_code=400)
+    cancelled = scheduler.cancel(request_id=request_id, session_id=session_id)
+    return JSONResponse({"cancelled": cancelled})
+
+
+async def tts_stats(request):
+    return JSONResponse(scheduler.stats())
+
+
+asgi_app = Starlette(
+    debug=args.debug,
+    routes=[
+        Route("/api/tts", tts, methods=["GET", "POST"]),
+        Route("/api/tts/cancel", tts_cancel, methods=["POST"]),
+        Route("/api/tts/stats", tts_stats, methods=["GET"]),
+        # index / details / MaryTTS compatibility stay on Flask
+        Mount("/", app=WSGIMiddleware(server.app)),
+    ],
+)
+
+
+def main():
+    uvicorn.run(
+        asgi_app,
+        host="::",
+        port=args.port,
+        log_level="debug" if args.debug else "info",
+        limit_concurrency=args.max_connections if args.max_connections > 0 else None,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,91 @@
 import argparse
+import csv
+import glob
 import json
 import sys
 import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 
-from TTS.tts.models.xtts import Xtts
+from TTS.tts.models.xtts import Xtts, load_audio
 from TTS.tts.configs.xtts_config import XttsConfig
 
 # Your actual XTTS model dir in the container
 MODEL_DIR   = "/root/.local/share/tts/tts_models--multilingual--multi-dataset--xtts_v2"
 CONFIG_JSON = f"{MODEL_DIR}/config.json"
 
+# Speaker store read by server.py (same default as docker-compose)
+SPEAKERS_FILE = os.environ.get("COQUI_SPEAKERS_FILE", "/data/speakers.json")
+
+AUDIO_EXTENSIONS = (".wav", ".flac", ".mp3", ".m4a", ".ogg")
+
 
 def get_args():
     parser = argparse.ArgumentParser()
+
+    # Single-speaker mode (one process per voice, as before)
     parser.add_argument(
         "--input_wav",
         type=str,
-        required=True,
-        help="Path to input speaker WAV (or first of several)",
+        nargs="+",
+        default=None,
+        help="Path to input speaker WAV (or several clips of the same speaker, averaged)",
     )
     parser.add_argument(
         "--output_json",
         type=str,
-        required=True,
+        default=None,
         help="Where to write the embedding JSON",
     )
-    return parser.parse_args()
+
+    # Batch mode (one model load for all voices)
+    parser.add_argument(
+        "--input_dir",
+        type=str,
+        default=None,
+        help=(
+            "Batch mode: directory with one audio file per speaker (<speaker>.wav) "
+            "and/or one sub-directory per speaker holding several reference clips"
+        ),
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        default=None,
+        help=(
+            "Batch mode: CSV file with 'speaker,path' rows; repeat a speaker on "
+            "several rows to average several reference clips"
+        ),
+    )
+    parser.add_argument(
+        "--speakers_file",
+        type=str,
+        default=SPEAKERS_FILE,
+        help="Batch mode: speaker store to merge the new speakers into",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="Batch mode: also write one <speaker>.json per speaker into this folder",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Batch mode: number of threads loading / resampling reference audio",
+    )
+
+    args = parser.parse_args()
+
+    batch_mode = args.input_dir is not None or args.manifest is not None
+    if batch_mode and args.input_wav:
+        parser.error("--input_wav cannot be combined with --input_dir / --manifest")
+    if not batch_mode and not (args.input_wav and args.output_json):
+        parser.error("either --input_wav and --output_json, or --input_dir / --manifest are required")
+    return args
 
 
 def load_xtts_model():
@@ -49,47 +108,206 @@ def load_xtts_model():
     return model, config
 
 
-def main():
-    args = get_args()
+def get_conditioning_params(config):
+    """Same conditioning settings the single-file path always passed to XTTS."""
+    return {
+        "max_ref_length": getattr(config, "max_ref_len", 10),
+        "gpt_cond_len": getattr(config, "gpt_cond_len", 6),
+        "gpt_cond_chunk_len": getattr(config, "gpt_cond_chunk_len", 6),
+        "librosa_trim_db": getattr(config, "librosa_trim_db", None),
+        "sound_norm_refs": getattr(config, "sound_norm_refs", False),
+        "load_sr": getattr(config, "audio", {}).get("sample_rate", 22050)
+        if isinstance(getattr(config, "audio", {}), dict)
+        else 22050,
+    }
 
-    if not os.path.isfile(args.input_wav):
-        print(f"❌ WAV file not found: {args.input_wav}")
-        sys.exit(1)
 
-    model, config = load_xtts_model()
+def collect_from_dir(input_dir):
+    """<dir>/<speaker>.wav -> one clip, <dir>/<speaker>/*.wav -> several clips."""
+    speakers = OrderedDict()
+    for entry in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, entry)
+        if os.path.isdir(path):
+            clips = sorted(
+                p for p in glob.glob(os.path.join(path, "*")) if p.lower().endswith(AUDIO_EXTENSIONS)
+            )
+            if clips:
+                speakers.setdefault(entry, []).extend(clips)
+        elif entry.lower().endswith(AUDIO_EXTENSIONS):
+            speakers.setdefault(os.path.splitext(entry)[0], []).append(path)
+    return speakers
 
-    print(f"🎙️ Extracting speaker embedding from: {args.input_wav}")
 
-    # Use XTTS helper to do all audio loading / resampling / shaping correctly
+def collect_from_manifest(manifest_path):
+    """CSV rows 'speaker,path'; relative paths are resolved against the manifest folder."""
+    speakers = OrderedDict()
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, "r", encoding="utf-8", newline="") as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().startswith("#"):
+                continue
+            if len(row) < 2:
+                print(f"⚠️ Skipping malformed manifest row: {row}")
+                continue
+            name, path = row[0].strip(), row[1].strip()
+            if name.lower() == "speaker" and path.lower() == "path":
+                continue  # header
+            if not os.path.isabs(path):
+                path = os.path.join(base_dir, path)
+            speakers.setdefault(name, []).append(path)
+    return speakers
+
+
+def load_reference(path, params):
+    """Load + trim one reference clip exactly like Xtts.get_conditioning_latents does."""
+    load_sr = params["load_sr"]
+    audio = load_audio(path, load_sr)
+    audio = audio[:, : load_sr * params["max_ref_length"]]
+    if params["sound_norm_refs"]:
+        audio = (audio / torch.abs(audio).max()) * 0.75
+    if params["librosa_trim_db"] is not None:
+        import librosa
+
+        audio = torch.from_numpy(librosa.effects.trim(audio.numpy(), top_db=params["librosa_trim_db"])[0])
+    return audio
+
+
+def extract_latents(model, audios, params):
+    """Average speaker embeddings over clips; GPT latents over the concatenated clips."""
+    load_sr = params["load_sr"]
     with torch.no_grad():
-        gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
-            audio_path=args.input_wav,
-            max_ref_length=getattr(config, "max_ref_len", 10),
-            gpt_cond_len=getattr(config, "gpt_cond_len", 6),
-            gpt_cond_chunk_len=getattr(config, "gpt_cond_chunk_len", 6),
-            librosa_trim_db=getattr(config, "librosa_trim_db", None),
-            sound_norm_refs=getattr(config, "sound_norm_refs", False),
-            load_sr=getattr(config, "audio", {}).get("sample_rate", 22050)
-            if isinstance(getattr(config, "audio", {}), dict)
-            else 22050,
+        speaker_embeddings = [model.get_speaker_embedding(audio.to(model.device), load_sr) for audio in audios]
+        full_audio = torch.cat(audios, dim=-1).to(model.device)
+        gpt_cond_latent = model.get_gpt_cond_latents(
+            full_audio,
+            load_sr,
+            length=params["gpt_cond_len"],
+            chunk_length=params["gpt_cond_chunk_len"],
         )
+        speaker_embedding = torch.stack(speaker_embeddings).mean(dim=0)
+    return gpt_cond_latent, speaker_embedding
 
+
+def to_entry(gpt_cond_latent, speaker_embedding):
     # ❗ DO NOT squeeze – keep the exact shapes XTTS expects
-    out_data = {
+    return {
         "gpt_cond_latent": gpt_cond_latent.cpu().numpy().tolist(),
         "speaker_embedding": speaker_embedding.cpu().numpy().tolist(),
     }
 
-    out_dir = os.path.dirname(args.output_json)
+
+def write_json(path, data):
+    out_dir = os.path.dirname(path)
     if out_dir:
         os.makedirs(out_dir, exist_ok=True)
 
-    with open(args.output_json, "w", encoding="utf-8") as f:
-        json.dump(out_data, f)
+    # write next to the target and swap, so server.py never reads a half-written store
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def run_single(args):
+    for wav in args.input_wav:
+        if not os.path.isfile(wav):
+            print(f"❌ WAV file not found: {wav}")
+            sys.exit(1)
+
+    model, config = load_xtts_model()
+
+    print(f"🎙️ Extracting speaker embedding from: {args.input_wav}")
+
+    # Use XTTS helper to do all audio loading / resampling / shaping correctly
+    params = get_conditioning_params(config)
+    with torch.no_grad():
+        gpt_cond_latent, speaker_embedding = model.get_conditioning_latents(
+            audio_path=args.input_wav,
+            max_ref_length=params["max_ref_length"],
+            gpt_cond_len=params["gpt_cond_len"],
+            gpt_cond_chunk_len=params["gpt_cond_chunk_len"],
+            librosa_trim_db=params["librosa_trim_db"],
+            sound_norm_refs=params["sound_norm_refs"],
+            load_sr=params["load_sr"],
+        )
+
+    out_data = to_entry(gpt_cond_latent, speaker_embedding)
+    write_json(args.output_json, out_data)
 
     print(f"✅ Saved conditioning latents → {args.output_json}")
     print("   keys:", list(out_data.keys()))
 
 
+def run_batch(args):
+    speakers = OrderedDict()
+    if args.input_dir:
+        print(f"📂 Looking in: {args.input_dir}")
+        speakers.update(collect_from_dir(args.input_dir))
+    if args.manifest:
+        print(f"📄 Reading manifest: {args.manifest}")
+        for name, clips in collect_from_manifest(args.manifest).items():
+            speakers.setdefault(name, []).extend(clips)
+
+    for name in list(speakers.keys()):
+        missing = [p for p in speakers[name] if not os.path.isfile(p)]
+        if missing:
+            print(f"⚠️ {name}: missing files {missing} – skipping speaker")
+            del speakers[name]
+
+    if not speakers:
+        print("❌ No speakers found")
+        sys.exit(1)
+    print(f"🗂️ {len(speakers)} speakers, {sum(len(c) for c in speakers.values())} clips")
+
+    # load the checkpoint once for every speaker
+    model, config = load_xtts_model()
+    params = get_conditioning_params(config)
+
+    if os.path.isfile(args.speakers_file):
+        with open(args.speakers_file, "r", encoding="utf-8") as f:
+            store = json.load(f)
+        print(f"📖 Merging into {args.speakers_file} ({len(store)} existing speakers)")
+    else:
+        store = {}
+
+    # audio decoding / resampling runs ahead on the pool while the model
+    # extracts latents for the previous speaker
+    failed = []
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        pending = OrderedDict(
+            (name, [pool.submit(load_reference, p, params) for p in clips]) for name, clips in speakers.items()
+        )
+        for name, futures in pending.items():
+            try:
+                audios = [fut.result() for fut in futures]
+                gpt_cond_latent, speaker_embedding = extract_latents(model, audios, params)
+            except Exception as e:
+                print(f"⚠️ Failed to extract {name}: {e}")
+                failed.append(name)
+                continue
+
+            entry = to_entry(gpt_cond_latent, speaker_embedding)
+            store[name] = entry
+            if args.output_dir:
+                write_json(os.path.join(args.output_dir, f"{name}.json"), entry)
+            print(f"✅ {name} ({len(audios)} clip{'s' if len(audios) > 1 else ''})")
+
+    write_json(args.speakers_file, store)
+
+    print(f"\n🎉 Wrote {args.speakers_file} with {len(store)} speakers.")
+    if failed:
+        print(f"   Failed: {failed}")
+        sys.exit(1)
+
+
+def main():
+    args = get_args()
+
+    if args.input_dir or args.manifest:
+        run_batch(args)
+    else:
+        run_single(args)
+
+
 if __name__ == "__main__":
     main()
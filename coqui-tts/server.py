@@ -5,11 +5,10 @@ import json
 import os
 import sys
 from pathlib import Path
-from threading import Lock
 from typing import Union
 from urllib.parse import parse_qs
 
-from flask import Flask, render_template, render_template_string, request, send_file
+from flask import Flask, jsonify, render_template, render_template_string, request, send_file
 
 from TTS.config import load_config
 from TTS.utils.synthesizer import Synthesizer
@@ -17,6 +16,8 @@ from TTS.utils.synthesizer import Synthesizer
 # New: tensors for custom speakers
 import torch
 
+from tts_scheduler import JobCancelled, PRIORITY_NORMAL, QueueFull, TTSScheduler, parse_priority
+
 # -------------------------------------------------------------------
 # Argument parsing
 # -------------------------------------------------------------------
@@ -71,6 +72,24 @@ def create_argparser():
     parser.add_argument("--use_cuda", type=convert_boolean, default=False, help="true to use CUDA.")
     parser.add_argument("--debug", type=convert_boolean, default=False, help="true to enable Flask debug mode.")
     parser.add_argument("--show_details", type=convert_boolean, default=False, help="Generate model detail page.")
+    parser.add_argument(
+        "--interactive_max_chars",
+        type=int,
+        default=200,
+        help="Requests without an explicit priority up to this many characters are scheduled as interactive.",
+    )
+    parser.add_argument(
+        "--max_queue",
+        type=int,
+        default=16,
+        help="Maximum number of waiting TTS requests; more are rejected with 429 + Retry-After. 0 = unbounded.",
+    )
+    parser.add_argument(
+        "--max_connections",
+        type=int,
+        default=64,
+        help="(asgi_server.py) maximum concurrent connections before uvicorn answers 503. 0 = unlimited.",
+    )
     return parser
 
 
@@ -322,83 +341,170 @@ def details():
     )
 
 
-lock = Lock()
+# -------------------------------------------------------------------
+# Scheduling: one worker owns the synthesizer (replaces the old global lock)
+# -------------------------------------------------------------------
 
 
-@app.route("/api/tts", methods=["GET", "POST"])
-def tts():
-    with lock:
-        # Parse JSON once if present
-        json_data = None
-        if request.is_json:
-            json_data = request.get_json(silent=True) or {}
-
-        # 1️⃣ TEXT: header → values (query/form) → JSON
-        text = (
-            request.headers.get("text")
-            or request.values.get("text")
-            or (json_data.get("text") if json_data else "")
-        )
+def synthesize_sentence(sentence, **kwargs):
+    # sentences are split by the scheduler so it can yield / cancel between them;
+    # Synthesizer.tts pads each sentence with the same silence as when it splits itself
+    return synthesizer.tts(sentence, split_sentences=False, **kwargs)
 
-        # 2️⃣ SPEAKER_WAV: query/form/JSON
-        speaker_wav = (
-            request.args.get("speaker_wav")
-            or request.values.get("speaker_wav")
-            or (json_data.get("speaker_wav") if json_data else None)
-        )
 
-        # 3️⃣ SPEAKER IDX / NAME (for multi-speaker models)
-        speaker_idx = (
-            request.headers.get("speaker-id")
-            or request.values.get("speaker_id")
-            or request.values.get("speaker_idx")
-            or request.values.get("speaker_name")
-            or (json_data.get("speaker_id") if json_data else None)
-            or (json_data.get("speaker_idx") if json_data else None)
-            or (json_data.get("speaker_name") if json_data else None)
-        )
-        if not speaker_idx:
-            speaker_idx = None
-
-        # 4️⃣ LANGUAGE IDX / NAME
-        language_idx = (
-            request.headers.get("language-id")
-            or request.values.get("language_id")
-            or request.values.get("language_idx")
-            or request.values.get("language")
-            or (json_data.get("language_id") if json_data else None)
-            or (json_data.get("language_idx") if json_data else None)
-            or (json_data.get("language") if json_data else None)
-        )
-        if not language_idx:
-            language_idx = None
+scheduler = TTSScheduler(
+    synthesize_sentence,
+    split_fn=synthesizer.split_into_sentences,
+    max_queued=args.max_queue if args.max_queue > 0 else None,
+)
 
-        # 5️⃣ STYLE_WAV (if you use GST)
-        style_wav_val = (
-            request.headers.get("style-wav")
-            or request.values.get("style_wav", "")
-        )
-        style_wav = style_wav_uri_to_dict(style_wav_val)
 
-        app.logger.info(f"Model input: {text}")
-        app.logger.info(f"Speaker Idx: {speaker_idx}")
-        app.logger.info(f"Language Idx: {language_idx}")
-        app.logger.info(f"Speaker WAV: {speaker_wav}")
+def is_missing(value):
+    # not falsy: a JSON 0 (e.g. "priority": 0, interactive) is a value
+    return value is None or value == ""
+
+
+def get_request_field(headers, values, json_data, header, *names):
+    """header → values (query/form) → JSON, same precedence as the fields of /api/tts"""
+    value = headers.get(header) if header else None
+    for name in names:
+        if is_missing(value):
+            value = values.get(name)
+    for name in names:
+        if is_missing(value) and json_data:
+            value = json_data.get(name)
+    return None if is_missing(value) else value
+
+
+def parse_tts_request(headers, values, json_data):
+    """Pull the /api/tts fields out of any request (Flask here, Starlette in asgi_server.py).
+
+    headers / values only need a .get(); values holds query + form fields.
+    Raises ValueError / TypeError for malformed priority / deadline values.
+    """
+    # 1️⃣ TEXT: header → values (query/form) → JSON
+    text = get_request_field(headers, values, json_data, "text", "text") or ""
+
+    # 2️⃣ SPEAKER_WAV: query/form/JSON
+    speaker_wav = get_request_field(headers, values, json_data, None, "speaker_wav")
+
+    # 3️⃣ SPEAKER IDX / NAME (for multi-speaker models)
+    speaker_idx = get_request_field(headers, values, json_data, "speaker-id", "speaker_id", "speaker_idx", "speaker_name")
 
-        # Standard XTTS call
-        wavs = synthesizer.tts(
+    # 4️⃣ LANGUAGE IDX / NAME
+    language_idx = get_request_field(
+        headers, values, json_data, "language-id", "language_id", "language_idx", "language"
+    )
+
+    # 5️⃣ STYLE_WAV (if you use GST)
+    style_wav_val = headers.get("style-wav") or values.get("style_wav", "")
+    style_wav = style_wav_uri_to_dict(style_wav_val)
+
+    # 6️⃣ SCHEDULING: priority (interactive|normal|batch or int), deadline_ms, request/session ids
+    deadline_ms = get_request_field(headers, values, json_data, "deadline-ms", "deadline_ms")
+    schedule_args = {
+        "priority": parse_priority(
+            get_request_field(headers, values, json_data, "priority", "priority"),
             text,
-            speaker_name=speaker_idx,
-            language_name=language_idx,
-            style_wav=style_wav,
-            speaker_wav=speaker_wav,
-        )
-        out = io.BytesIO()
-        synthesizer.save_wav(wavs, out)
+            args.interactive_max_chars,
+        ),
+        "deadline_s": float(deadline_ms) / 1000.0 if deadline_ms is not None else None,
+        "request_id": get_request_field(headers, values, json_data, "request-id", "request_id"),
+        "session_id": get_request_field(headers, values, json_data, "session-id", "session_id"),
+    }
+
+    # 7️⃣ STREAM: chunked WAV, one chunk per sentence (asgi_server.py only)
+    stream = str(get_request_field(headers, values, json_data, "stream", "stream") or "").lower()
+
+    return {
+        "text": text,
+        "synth_kwargs": {
+            "speaker_name": speaker_idx,
+            "language_name": language_idx,
+            "style_wav": style_wav,
+            "speaker_wav": speaker_wav,
+        },
+        "schedule_args": schedule_args,
+        "stream": stream in ["true", "1", "yes"],
+    }
+
+
+def validate_tts_request(fields):
+    """Cheap checks done before queueing; returns an error message or None."""
+    if not fields["text"].strip():
+        return "No text provided for TTS"
+    speaker_name = fields["synth_kwargs"]["speaker_name"]
+    speakers = getattr(speaker_manager, "speakers", None) if speaker_manager is not None else None
+    if speaker_name and fields["synth_kwargs"]["speaker_wav"] is None and isinstance(speakers, dict):
+        if speaker_name not in speakers:
+            return f"Unknown speaker {speaker_name!r}"
+    return None
+
+
+def cancelled_response(e: JobCancelled):
+    # 504 when the deadline passed, 499 (client closed request) for explicit cancels
+    status = 504 if e.reason == "deadline" else 499
+    return jsonify({"error": str(e), "reason": e.reason}), status
+
+
+def queue_full_response(e: QueueFull):
+    return jsonify({"error": str(e)}), 429, {"Retry-After": str(e.retry_after)}
+
+
+@app.route("/api/tts", methods=["GET", "POST"])
+def tts():
+    # Parse JSON once if present
+    json_data = None
+    if request.is_json:
+        json_data = request.get_json(silent=True)
+        if not isinstance(json_data, dict):
+            json_data = {}
+
+    try:
+        fields = parse_tts_request(request.headers, request.values, json_data)
+    except (ValueError, TypeError) as e:
+        return jsonify({"error": str(e)}), 400
+    error = validate_tts_request(fields)
+    if error:
+        return jsonify({"error": error}), 400
+
+    app.logger.info(f"Model input: {fields['text']}")
+    app.logger.info(f"Speaker Idx: {fields['synth_kwargs']['speaker_name']}")
+    app.logger.info(f"Language Idx: {fields['synth_kwargs']['language_name']}")
+    app.logger.info(f"Speaker WAV: {fields['synth_kwargs']['speaker_wav']}")
+    app.logger.info(f"Schedule: {fields['schedule_args']}")
+
+    # Standard XTTS call, run by the scheduler worker
+    try:
+        wavs = scheduler.synthesize(fields["text"], fields["synth_kwargs"], **fields["schedule_args"])
+    except JobCancelled as e:
+        return cancelled_response(e)
+    except QueueFull as e:
+        return queue_full_response(e)
+    out = io.BytesIO()
+    synthesizer.save_wav(wavs, out)
 
     return send_file(out, mimetype="audio/wav")
 
 
+@app.route("/api/tts/cancel", methods=["POST"])
+def tts_cancel():
+    """Cancel queued / running synthesis, e.g. on barge-in: by request_id and/or session_id"""
+    json_data = request.get_json(silent=True) if request.is_json else None
+    request_id = get_request_field(request.headers, request.values, json_data, "request-id", "request_id")
+    session_id = get_request_field(request.headers, request.values, json_data, "session-id", "session_id")
+    if request_id is None and session_id is None:
+        return jsonify({"error": "request_id or session_id is required"}), 400
+    cancelled = scheduler.cancel(request_id=request_id, session_id=session_id)
+    app.logger.info(f"Cancelled {cancelled} job(s): request_id={request_id} session_id={session_id}")
+    return jsonify({"cancelled": cancelled})
+
+
+@app.route("/api/tts/stats", methods=["GET"])
+def tts_stats():
+    return jsonify(scheduler.stats())
+
+
 # Basic MaryTTS compatibility layer
 @app.route("/locales", methods=["GET"])
 def mary_tts_api_locales():
@@ -427,17 +533,21 @@ def mary_tts_api_voices():
 @app.route("/process", methods=["GET", "POST"])
 def mary_tts_api_process():
     """MaryTTS-compatible /process endpoint"""
-    with lock:
-        if request.method == "POST":
-            data = parse_qs(request.get_data(as_text=True))
-            # NOTE: we ignore param. LOCALE and VOICE for now since we have only one active model
-            text = data.get("INPUT_TEXT", [""])[0]
-        else:
-            text = request.args.get("INPUT_TEXT", "")
-        print(f" > Model input: {text}")
-        wavs = synthesizer.tts(text)
-        out = io.BytesIO()
-        synthesizer.save_wav(wavs, out)
+    if request.method == "POST":
+        data = parse_qs(request.get_data(as_text=True))
+        # NOTE: we ignore param. LOCALE and VOICE for now since we have only one active model
+        text = data.get("INPUT_TEXT", [""])[0]
+    else:
+        text = request.args.get("INPUT_TEXT", "")
+    print(f" > Model input: {text}")
+    try:
+        wavs = scheduler.synthesize(text, priority=PRIORITY_NORMAL)
+    except JobCancelled as e:
+        return cancelled_response(e)
+    except QueueFull as e:
+        return queue_full_response(e)
+    out = io.BytesIO()
+    synthesizer.save_wav(wavs, out)
     return send_file(out, mimetype="audio/wav")
 
 
@@ -0,0 +1,296 @@
+"""Deadline-aware priority scheduler for the (single, non thread-safe) XTTS synthesizer.
+
+One worker thread owns the model; this replaces the old global lock in server.py.
+Every request is split into sentences and each sentence is one scheduling quantum:
+between two sentences the worker re-checks cancellation and deadlines, and a short
+interactive request that arrived in the meantime runs before the rest of a long
+batch job.
+
+Ordering is (priority, deadline, arrival): lower priority value first, earliest
+deadline first within a priority, FIFO otherwise.
+
+The queue is bounded (max_queued): submit() raises QueueFull instead of letting
+waiting requests pile up, and retry_after() estimates when to come back.
+"""
+import heapq
+import itertools
+import math
+import threading
+import time
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BATCH = 2
+
+PRIORITY_NAMES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "high": PRIORITY_INTERACTIVE,
+    "normal": PRIORITY_NORMAL,
+    "batch": PRIORITY_BATCH,
+    "low": PRIORITY_BATCH,
+}
+
+
+class QueueFull(Exception):
+    """Raised by TTSScheduler.submit() when max_queued jobs are already waiting."""
+
+    def __init__(self, retry_after):
+        super().__init__(f"TTS queue is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class JobCancelled(Exception):
+    """Raised by TTSJob.wait() when the job was cancelled or missed its deadline."""
+
+    def __init__(self, reason):
+        super().__init__(f"TTS job cancelled ({reason})")
+        self.reason = reason
+
+
+def parse_priority(value, text="", interactive_max_chars=200):
+    """Map a request's priority field to an int; default by utterance length."""
+    if value is None or value == "":
+        return PRIORITY_INTERACTIVE if len(text or "") <= interactive_max_chars else PRIORITY_BATCH
+    if isinstance(value, str) and value.strip().lower() in PRIORITY_NAMES:
+        return PRIORITY_NAMES[value.strip().lower()]
+    return int(value)
+
+
+class TTSJob:
+    def __init__(self, text, synth_kwargs, priority, deadline, request_id, session_id, seq, on_chunk=None):
+        self.text = text
+        self.synth_kwargs = synth_kwargs
+        self.priority = priority
+        self.deadline = deadline  # time.monotonic() timestamp or None
+        self.request_id = request_id
+        self.session_id = session_id
+        self.seq = seq
+        self.on_chunk = on_chunk  # called from the worker with each sentence's samples
+
+        self.sentences = None  # split lazily by the worker
+        self.next_sentence = 0
+        self.wavs = []
+        self.error = None
+        self.cancel_reason = None
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self._done = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+
+    def sort_key(self):
+        return (self.priority, self.deadline if self.deadline is not None else math.inf, self.seq)
+
+    @property
+    def cancelled(self):
+        return self.cancel_reason is not None
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def expired(self, now=None):
+        return self.deadline is not None and (now if now is not None else time.monotonic()) > self.deadline
+
+    def cancel(self, reason="cancelled"):
+        """Cancel the job; waiters are released now, the worker drops it at its next check."""
+        if self.done:
+            return False
+        self.cancel_reason = reason
+        self._set_done()
+        return True
+
+    def add_done_callback(self, fn):
+        """fn(job) runs once the job completes, fails or is cancelled (possibly right away)."""
+        with self._callbacks_lock:
+            if not self.done:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set_done(self):
+        with self._callbacks_lock:
+            if self.done:
+                return
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+    def wait(self, timeout=None):
+        """Block until the job finishes and return the waveform (list of samples)."""
+        if timeout is None and self.deadline is not None:
+            timeout = max(0.0, self.deadline - time.monotonic())
+        if not self._done.wait(timeout):
+            self.cancel("deadline")
+        if self.cancelled:
+            raise JobCancelled(self.cancel_reason)
+        if self.error is not None:
+            raise self.error
+        return self.wavs
+
+
+class TTSScheduler:
+    def __init__(self, synthesize_fn, split_fn=None, max_queued=None, name="tts-scheduler"):
+        """
+        Args:
+            synthesize_fn: callable(sentence, **synth_kwargs) -> list of samples; only
+                ever called from the worker thread.
+            split_fn: callable(text) -> list of sentences; defaults to no splitting.
+            max_queued: maximum number of waiting (not yet finished) jobs, None = unbounded.
+        """
+        self.synthesize_fn = synthesize_fn
+        self.split_fn = split_fn
+        self.max_queued = max_queued
+        self._job_seconds = None  # moving average of per-job wall time, for Retry-After
+        self._queue = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._jobs = {}  # request_id -> job, for explicit cancellation
+        self._running = None
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "completed": 0,
+            "failed": 0,
+            "cancelled": 0,
+            "expired": 0,
+            "sentences_synthesized": 0,
+            "sentences_skipped": 0,
+        }
+        self._worker = threading.Thread(target=self._run, name=name, daemon=True)
+        self._worker.start()
+
+    # ------------------------------------------------------------------
+    # public API
+    # ------------------------------------------------------------------
+
+    def submit(self, text, synth_kwargs=None, priority=PRIORITY_NORMAL, deadline_s=None,
+               request_id=None, session_id=None, on_chunk=None):
+        """Queue a synthesis job. deadline_s is a budget in seconds from now."""
+        deadline = time.monotonic() + deadline_s if deadline_s is not None else None
+        with self._cond:
+            if self.max_queued is not None and self._queued() >= self.max_queued:
+                self._stats["rejected"] += 1
+                raise QueueFull(self._retry_after())
+            job = TTSJob(text, synth_kwargs or {}, priority, deadline, request_id, session_id,
+                         next(self._seq), on_chunk)
+            if request_id is not None:
+                self._jobs[request_id] = job
+            heapq.heappush(self._queue, (job.sort_key(), job))
+            self._stats["submitted"] += 1
+            self._cond.notify()
+        return job
+
+    def synthesize(self, text, synth_kwargs=None, **submit_kwargs):
+        """Submit and block until done (raises JobCancelled on cancel / deadline)."""
+        job = self.submit(text, synth_kwargs, **submit_kwargs)
+        try:
+            return job.wait()
+        finally:
+            self.release(job)
+
+    def cancel(self, request_id=None, session_id=None, reason="cancelled"):
+        """Cancel by request id and/or every job of a session (barge-in). Returns the count."""
+        with self._cond:
+            jobs = [job for _, job in self._queue]
+            jobs += [job for job in self._jobs.values() if job not in jobs]
+            if self._running is not None and self._running not in jobs:
+                jobs.append(self._running)
+        count = 0
+        for job in jobs:
+            if (request_id is not None and job.request_id == request_id) or \
+               (session_id is not None and job.session_id == session_id):
+                if job.cancel(reason):
+                    count += 1
+        return count
+
+    def release(self, job):
+        """Drop the request_id bookkeeping once the caller is done with a job."""
+        with self._cond:
+            if job.request_id is not None and self._jobs.get(job.request_id) is job:
+                del self._jobs[job.request_id]
+
+    def retry_after(self):
+        """Seconds until the current backlog is expected to drain (at least 1)."""
+        with self._cond:
+            return self._retry_after()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queued"] = self._queued()
+            stats["avg_job_seconds"] = self._job_seconds
+        return stats
+
+    # ------------------------------------------------------------------
+    # worker
+    # ------------------------------------------------------------------
+
+    def _queued(self):
+        return sum(1 for _, job in self._queue if not job.cancelled)
+
+    def _retry_after(self):
+        per_job = self._job_seconds if self._job_seconds is not None else 1.0
+        return max(1, int(math.ceil(per_job * max(1, self._queued()))))
+
+    def _drop(self, job, reason):
+        if job.cancel_reason is None:
+            job.cancel(reason)
+        key = "expired" if job.cancel_reason == "deadline" else "cancelled"
+        remaining = len(job.sentences) - job.next_sentence if job.sentences is not None else 1
+        with self._cond:
+            self._stats[key] += 1
+            self._stats["sentences_skipped"] += remaining
+        print(f"[tts_scheduler] dropped job {job.request_id or job.seq} ({job.cancel_reason}), "
+              f"{remaining} sentence(s) not synthesized")
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._running = None
+                while not self._queue:
+                    self._cond.wait()
+                _, job = heapq.heappop(self._queue)
+                self._running = job
+
+            if job.cancelled:
+                self._drop(job, job.cancel_reason)
+                continue
+            if job.expired():
+                self._drop(job, "deadline")
+                continue
+
+            try:
+                if job.sentences is None:
+                    job.started_at = time.monotonic()
+                    job.sentences = (self.split_fn(job.text) if self.split_fn else None) or [job.text]
+                sentence = job.sentences[job.next_sentence]
+                samples = list(self.synthesize_fn(sentence, **job.synth_kwargs))
+                job.wavs += samples
+                job.next_sentence += 1
+                with self._cond:
+                    self._stats["sentences_synthesized"] += 1
+                if job.on_chunk is not None and not job.cancelled:
+                    job.on_chunk(samples)
+            except Exception as e:  # surfaced to the waiting request handler
+                job.error = e
+                job._set_done()
+                with self._cond:
+                    self._stats["failed"] += 1
+                continue
+
+            if job.next_sentence < len(job.sentences):
+                # yield between sentences: re-queue with the original key so that
+                # anything more urgent that arrived meanwhile runs first
+                with self._cond:
+                    heapq.heappush(self._queue, (job.sort_key(), job))
+            elif not job.cancelled:
+                job._set_done()
+                elapsed = time.monotonic() - job.started_at
+                with self._cond:
+                    self._stats["completed"] += 1
+                    self._job_seconds = elapsed if self._job_seconds is None else \
+                        0.8 * self._job_seconds + 0.2 * elapsed
+            else:
+                self._drop(job, job.cancel_reason)
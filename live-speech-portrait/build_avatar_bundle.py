@@ -0,0 +1,47 @@
+"""Compiles the pre-defined data of a talking head (mean / tracked landmarks,
+headposes, normalized candidate images, shoulders, camera, APC feature base,
+id scale and the feature map image pad) into ./data/<id>/avatar.bundle.
+demo.py and streaming.py then load it with a single memory mapping instead of
+reading and decoding a dozen files; they fall back to the files when the bundle
+is missing, of another version or older than its sources.
+
+    python build_avatar_bundle.py --id May
+"""
+import os
+import time
+import argparse
+from os.path import join
+
+import numpy as np
+import yaml
+
+from util import avatar_bundle
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id', default='May', help="person name, e.g. Obama1, Obama2, May, Nadella, McStay")
+    parser.add_argument('--config_root', default='./config/')
+    parser.add_argument('--data_root', default='./data/')
+    opt = parser.parse_args()
+
+    with open(join(opt.config_root, opt.id + '.yaml')) as f:
+        config = yaml.load(f, Loader=yaml.SafeLoader)
+    data_root = join(opt.data_root, opt.id)
+
+    st = time.time()
+    path = avatar_bundle.build_bundle(config, data_root)
+    print('saved {} ({:.1f} MB) in {:.2f} s'.format(path, os.path.getsize(path) / 2 ** 20, time.time() - st))
+
+    # check the bundle against the source files
+    st = time.time()
+    bundle = avatar_bundle.AvatarBundle(path)
+    t_bundle = time.time() - st
+    st = time.time()
+    arrays, meta = avatar_bundle.compile_avatar(config, data_root)
+    t_files = time.time() - st
+    for name, value in arrays.items():
+        assert np.array_equal(bundle[name], value), name
+    assert bundle.meta == meta
+    print('{} arrays checked; loading: bundle {:.1f} ms, files {:.1f} ms'.format(
+        len(arrays), 1000 * t_bundle, 1000 * t_files))
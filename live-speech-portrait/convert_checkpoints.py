@@ -0,0 +1,59 @@
+"""Converts the checkpoints of the talking head configs to memory-mapped files in
+a content addressed store shared by all of them (see models/checkpoints.py):
+identical checkpoints, e.g. the APC model every config uses, are stored once
+and every model loading them on the CPU, in any process, shares one physical
+copy. Run again after a checkpoint changed; until then the original is loaded.
+The BatchNorm folded renderer (fold_bn) is written next to its checkpoint by the
+first run of demo.py / streaming.py afterwards and mapped as well; both print
+which part of every model's weights is shared.
+
+    python convert_checkpoints.py                  # all configs in ./config
+    python convert_checkpoints.py --id May Obama1
+"""
+import os
+import glob
+import argparse
+from os.path import join
+
+import yaml
+
+from models.checkpoints import convert_checkpoint
+
+
+def config_checkpoints(config):
+    params = config['model_params']
+    paths = [params['APC']['ckp_path'], params['Audio2Mouth']['ckp_path'], params['Headpose']['ckp_path'],
+             params['Image2Image']['ckp_path']]
+    paths += list((params['Image2Image'].get('adaptive_sizes') or {}).values())
+    return paths
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id', nargs='*', default=None, help="person names, default every config in config_root")
+    parser.add_argument('--config_root', default='./config/')
+    parser.add_argument('--store_dir', default='./data/checkpoint_store', help='content addressed checkpoint store')
+    opt = parser.parse_args()
+
+    names = opt.id or sorted(os.path.splitext(os.path.basename(p))[0] for p in glob.glob(join(opt.config_root, '*.yaml')))
+    paths = []
+    for name in names:
+        with open(join(opt.config_root, name + '.yaml')) as f:
+            config = yaml.load(f, Loader=yaml.SafeLoader)
+        paths += [p for p in config_checkpoints(config) if os.path.normpath(p) not in map(os.path.normpath, paths)]
+
+    unique, total, stored = set(), 0, 0
+    for path in paths:
+        if not os.path.exists(path):
+            print('missing {}, skipped'.format(path))
+            continue
+        sha, shared = convert_checkpoint(path, opt.store_dir)
+        size = os.path.getsize(path)
+        total += size
+        if sha not in unique:
+            stored += size
+        unique.add(sha)
+        print('{} -> {}{}'.format(path, sha[:12], ' (shared)' if shared else ''))
+    print('{} checkpoints of {} configs, {} unique: {:.1f} MB instead of {:.1f} MB'.format(
+        len(paths), len(names), len(unique), stored / 2 ** 20, total / 2 ** 20))
@@ -111,6 +111,7 @@ class AudioVisualDataset(BaseDataset):
         if opt.use_delta_pts:
             self.pts3d_mean = np.load(os.path.join(self.dataset_root, 'mean_pts3d.npy'))
         
+        apc_requests = []
         for i in range(self.clip_nums):
             name = self.clip_names[i]
             clip_root = os.path.join(self.dataset_root, name)
@@ -178,24 +179,8 @@ class AudioVisualDataset(BaseDataset):
                     print('dataset {} need to pre-compute APC features ...'.format(name))
                     print('first we compute mel spectram for dataset {} '.format(name))                    
                     mel80 = utils.compute_mel_one_sequence(self.audio[i])
-                    mel_nframe = mel80.shape[0]
-                    print('loading pre-trained model: ', self.opt.APC_model_path)
-                    APC_model = APC_encoder(self.opt.audiofeature_input_channels,
-                                            self.opt.APC_hidden_size,
-                                            self.opt.APC_rnn_layers,
-                                            self.opt.APC_residual)
-                    APC_model.load_state_dict(torch.load(self.opt.APC_model_path, map_location=str(self.device)), strict=False)
-#                    APC_model.load_state_dict(torch.load(self.opt.APC_model_path), strict=False)
-                    APC_model.cuda()
-                    APC_model.eval()
-                    with torch.no_grad():
-                        length = torch.Tensor([mel_nframe])
-#                        hidden_reps = torch.zeros([mel_nframe, self.opt.APC_hidden_size]).cuda()
-                        mel80_torch = torch.from_numpy(mel80.astype(np.float32)).cuda().unsqueeze(0)
-                        hidden_reps = APC_model.forward(mel80_torch, length)[0]   # [mel_nframe, 512]
-                        hidden_reps = hidden_reps.cpu().numpy()
-                        np.save(APC_feature_path, hidden_reps)
-                        self.audio_features[i] = hidden_reps
+                    # encoded with the other clips after the loop
+                    apc_requests.append((i, APC_feature_path, mel80))
 
 
             valid_frames = total_frames - self.start_point[i]
@@ -206,6 +191,32 @@ class AudioVisualDataset(BaseDataset):
                 self.sample_start.append(self.sample_start[-1] + self.len[i-1] - 1)
             self.total_len += np.int32(np.floor(self.len[i] / self.frame_jump_stride))
 
+        if apc_requests:
+            self.compute_APC_features(apc_requests)
+
+
+    def compute_APC_features(self, requests, batch_size=8):
+        ''' APC features of the clips [(index, feature path, mel80)], saved to the
+        feature paths. The clips are encoded batch_size at a time as packed
+        sequences (APC_encoder.forward_batch), with one model load for all. '''
+        print('loading pre-trained model: ', self.opt.APC_model_path)
+        APC_model = APC_encoder(self.opt.audiofeature_input_channels,
+                                self.opt.APC_hidden_size,
+                                self.opt.APC_rnn_layers,
+                                self.opt.APC_residual)
+        APC_model.load_state_dict(torch.load(self.opt.APC_model_path, map_location=str(self.device)), strict=False)
+        APC_model.cuda()
+        APC_model.eval()
+        for k in range(0, len(requests), batch_size):
+            batch = requests[k: k + batch_size]
+            with torch.no_grad():
+                mels = [torch.from_numpy(mel80.astype(np.float32)).cuda() for _, _, mel80 in batch]
+                hidden_reps = APC_model.forward_batch(mels)   # [mel_nframe, 512] each
+            for (i, APC_feature_path, _), reps in zip(batch, hidden_reps):
+                reps = reps.cpu().numpy()
+                np.save(APC_feature_path, reps)
+                self.audio_features[i] = reps
+
 
 
     def __getitem__(self, index):
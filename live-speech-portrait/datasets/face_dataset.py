@@ -11,6 +11,17 @@ import io
 import cv2
 import h5py
 import albumentations as A
+from concurrent.futures import ThreadPoolExecutor
+
+
+def draw_segments(img, points, segments):
+    ''' cv2.line(img, points[a], points[b], 255, 2) for every segment (a, b) in one
+    cv2.polylines call, the points truncated to int as before
+    '''
+    if len(segments) == 0:
+        return img
+    lines = np.asarray(points)[segments].astype(np.int32)   # [n_segments, 2, 2]
+    return cv2.polylines(img, lines, False, 255, 2)
 
 
 class FaceDataset(BaseDataset):
@@ -40,6 +51,9 @@ class FaceDataset(BaseDataset):
                           [range(46, 53), [52,53,54,55,56,57,46]],             # mouth
                           [[46,63,62,61,52], [52,60,59,58,46]]                 # tongue
                          ]
+        # the edges as flat [n_segments, 2] landmark indices, all drawn in one call per frame
+        self.edge_segments = np.array([[edge[i], edge[i + 1]] for edge_list in self.part_list
+                                       for edge in edge_list for i in range(len(edge) - 1)], np.int64)
         self.mouth_outer = [46, 47, 48, 49, 50, 51, 52, 53, 54, 55, 56, 57, 46]
         self.label_list = [1, 1, 2, 3, 3, 4, 5] # labeling for different facial parts
                 
@@ -159,6 +173,9 @@ class FaceDataset(BaseDataset):
                 self.total_len += self.sample_len[i]
         
         # test mode        
+        elif hasattr(opt, 'test_image_pad'):
+            # precomputed, see util.avatar_bundle
+            self.image_pad = opt.test_image_pad
         else:
             # if need padding
             example = imread(os.path.join(self.root, 'example.png'))
@@ -282,6 +299,26 @@ class FaceDataset(BaseDataset):
         return feature_map  
 
 
+    def get_data_test_mode_batch(self, landmarks, shoulders, pad=None, workers=4):
+        ''' get_data_test_mode of [N, 73, 2] landmarks and [N, 18, 2] shoulders -> [N, 1, H, W],
+        the frames are drawn by `workers` threads (cv2 releases the GIL)
+        '''
+        size = (self.opt.loadSize, self.opt.loadSize)
+        feature_maps = np.empty([len(landmarks), 1, size[1], size[0]], np.uint8)
+
+        def draw(k):
+            feature_maps[k, 0] = self.get_feature_image(landmarks[k], size, np.array(shoulders[k], copy=True), pad)
+
+        if workers > 1:
+            with ThreadPoolExecutor(workers) as pool:
+                list(pool.map(draw, range(len(landmarks))))
+        else:
+            for k in range(len(landmarks)):
+                draw(k)
+
+        return torch.from_numpy(feature_maps).float().div_(255.)
+
+
     def get_feature_image(self, landmarks, size, shoulders=None, image_pad=None):
         # draw edges
         im_edges = self.draw_face_feature_maps(landmarks, size)  
@@ -300,27 +337,17 @@ class FaceDataset(BaseDataset):
 
     def draw_shoulder_points(self, img, shoulder_points):
         num = int(shoulder_points.shape[0] / 2)
-        for i in range(2):
-            for j in range(num - 1):
-                pt1 = [int(flt) for flt in shoulder_points[i * num + j]]
-                pt2 = [int(flt) for flt in shoulder_points[i * num + j + 1]]
-                img = cv2.line(img, tuple(pt1), tuple(pt2), 255, 2)  # BGR
-        
-        return img
+        segments = np.array([[i * num + j, i * num + j + 1] for i in range(2) for j in range(num - 1)], np.int64)
+
+        return draw_segments(img, shoulder_points, segments)
 
     
     def draw_face_feature_maps(self, keypoints, size=(512, 512)):
         w, h = size
         # edge map for face region from keypoints
         im_edges = np.zeros((h, w), np.uint8) # edge map for all edges
-        for edge_list in self.part_list:
-            for edge in edge_list:
-                for i in range(len(edge)-1):
-                    pt1 = [int(flt) for flt in keypoints[edge[i]]]
-                    pt2 = [int(flt) for flt in keypoints[edge[i + 1]]]
-                    im_edges = cv2.line(im_edges, tuple(pt1), tuple(pt2), 255, 2)
 
-        return im_edges
+        return draw_segments(im_edges, keypoints, self.edge_segments)
 
 
     def get_crop_coords(self, keypoints, size, dataset_name, random_trans_scale=50): 
@@ -6,13 +6,9 @@ import numpy as np
 import torch
 from collections import OrderedDict
 import librosa
-from skimage.io import imread
 import cv2
-import scipy.io as sio
 import argparse
 import yaml
-import albumentations as A
-from albumentations.pytorch import ToTensorV2
 from pathlib import Path
 import soundfile as sf  # modern audio writer
 
@@ -23,8 +19,15 @@ from options.test_feature2face_options import TestOptions as RenderOptions
 from datasets import create_dataset
 from models import create_model
 from models.networks import APC_encoder
+from models import backends
+from models.checkpoints import load_checkpoint, sharing_report
 import util.util as util
 from util.visualizer import Visualizer
+from util.stage_executor import Stage, StageExecutor
+from util.frame_cache import FrameCache, renderer_namespace
+from util.roi_renderer import ROIRenderer
+from util.motion_matching import MotionMatchingHeadpose
+from util import avatar_bundle
 from funcs import utils
 from funcs import audio_funcs
 
@@ -32,25 +35,57 @@ import warnings
 warnings.filterwarnings("ignore")
 
 
-def write_video_with_audio(audio_path, output_path, prefix='pred_'):
-    fps, fourcc = 60, cv2.VideoWriter_fourcc(*('D', 'I', 'V', 'X'))
-    video_tmp_path = join(save_root, 'tmp.avi')
-    out = cv2.VideoWriter(video_tmp_path, fourcc, fps, (Renderopt.loadSize, Renderopt.loadSize))
-    for j in tqdm(range(nframe), position=0, desc='writing video'):
-        img = cv2.imread(join(save_root, prefix + str(j + 1) + '.jpg'))
-        out.write(img)
-    out.release()
-    cmd = f'ffmpeg -i "{video_tmp_path}" -i "{audio_path}" -codec copy -shortest "{output_path}"'
-    subprocess.call(cmd, shell=True)
-    os.remove(video_tmp_path)  # remove the template video
+# feature map drawing, module level so that it can also run in worker processes
+_draw_dataset = None
+
+
+def init_draw_worker(dataset):
+    global _draw_dataset
+    _draw_dataset = dataset
+
+
+def draw_feature_map(item):
+    if item is None:   # re-used frame
+        return None
+    landmarks, shoulders = item
+    # feature_map: [input_nc, h, w]
+    return _draw_dataset.get_data_test_mode(landmarks, shoulders, _draw_dataset.image_pad)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--id', default='May', help="person name, e.g. Obama1, Obama2, May, Nadella, McStay")
     parser.add_argument('--driving_audio', default='./data/input/00083.wav', help="path to driving audio")
-    parser.add_argument('--save_intermediates', default=0, help="whether to save intermediate results")
+    parser.add_argument('--save_intermediates', type=int, default=0, help="whether to save intermediate results")
     parser.add_argument('--device', type=str, default='cpu', help='use cuda for GPU or use cpu for CPU')
+    parser.add_argument('--draw_workers', type=int, default=2, help='concurrent feature map drawing workers')
+    parser.add_argument('--draw_mode', type=str, default='thread', help='run the drawing workers as thread or process')
+    parser.add_argument('--queue_size', type=int, default=8, help='frames buffered between the rendering stages')
+    parser.add_argument('--fold_bn', type=int, default=1, help='fold BatchNorm into the Feature2Face convolutions')
+    parser.add_argument('--channels_last', type=int, default=0, help='run Feature2Face in channels_last memory format')
+    parser.add_argument('--backend', type=str, default='torch', help='torch | torchscript | onnx (see export.py)')
+    parser.add_argument('--export_dir', type=str, default=None, help='exported models, default <checkpoints>/export')
+    parser.add_argument('--output_fps', type=float, default=60,
+                        help='frame rate of the rendered video, the audio models always run at 60 fps')
+    parser.add_argument('--vad', type=int, default=0,
+                        help='closed mouth and re-used renders in silent stretches (energy based detection)')
+    parser.add_argument('--silence_db', type=float, default=-40, help='vad: rms level (dBFS) below which audio is silent')
+    parser.add_argument('--min_silence', type=float, default=0.3, help='vad: shortest silent stretch in seconds')
+    parser.add_argument('--idle_px', type=float, default=0.5,
+                        help='vad: re-use the last render while the landmarks moved less than this (pixels)')
+    parser.add_argument('--frame_cache', type=int, default=0,
+                        help='re-use the renders of frames with the same quantized landmarks and shoulders')
+    parser.add_argument('--cache_step', type=float, default=1.0, help='frame cache: quantization step in pixels')
+    parser.add_argument('--cache_size', type=int, default=1024, help='frame cache: frames kept in memory')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='frame cache: directory of the disk tier kept across runs, e.g. ./data/May/frame_cache')
+    parser.add_argument('--cache_verify', type=int, default=0,
+                        help='frame cache: render every n-th hit anyway and report its PSNR, 0 for never')
+    parser.add_argument('--roi', type=int, default=0,
+                        help='render only a crop around the mouth while the rest of the head stays put')
+    parser.add_argument('--roi_threshold', type=float, default=1.0,
+                        help='roi: full render once a point outside of the crop moved more than this (pixels)')
+    parser.add_argument('--roi_full_every', type=int, default=30, help='roi: frames between forced full renders')
 
     ############################### I/O Settings ##############################
     # load config files
@@ -73,39 +108,27 @@ if __name__ == '__main__':
     eye_brow_indices = np.array(eye_brow_indices, np.int32)
 
     ############################ Pre-defined Data #############################
-    mean_pts3d = np.load(join(data_root, 'mean_pts3d.npy'))
-    fit_data = np.load(config['dataset_params']['fit_data_path'])
-    pts3d = np.load(config['dataset_params']['pts3d_path']) - mean_pts3d
-    trans = fit_data['trans'][:, :, 0].astype(np.float32)
-    mean_translation = trans.mean(axis=0)
-    candidate_eye_brow = pts3d[10:, eye_brow_indices]
-    std_mean_pts3d = np.load(config['dataset_params']['pts3d_path']).mean(axis=0)
-
-    # candidates images
-    img_candidates = []
-    tensor_aug = A.Compose([
-        A.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)),  # 0–255 -> [-1, 1]
-        ToTensorV2()
-    ])
-    for j in range(4):
-        output = imread(join(data_root, 'candidates', f'normalized_full_{j}.jpg'))  # RGB HWC uint8
-        output = tensor_aug(image=output)['image']  # CHW float32
-        img_candidates.append(output)
-    # Preserve original behavior: concatenate along channel dimension -> (1, 3*4, H, W)
-    img_candidates = torch.cat(img_candidates).unsqueeze(0).to(device)
+    # the compiled avatar.bundle (build_avatar_bundle.py) if up to date, else derived from the data files
+    avatar_data, avatar_meta = avatar_bundle.load_avatar_data(config, data_root)
+    mean_pts3d = avatar_data['mean_pts3d']
+    mean_translation = avatar_data['mean_translation']
+    candidate_eye_brow = avatar_data['candidate_eye_brow']
+    std_mean_pts3d = avatar_data['std_mean_pts3d']
+
+    # candidates images, normalized to [-1, 1]: (1, 3*4, H, W)
+    img_candidates = torch.from_numpy(avatar_data['img_candidates']).to(device)
 
     # shoulders
-    shoulders = np.load(join(data_root, 'normalized_shoulder_points.npy'))
-    shoulder3D = np.load(join(data_root, 'shoulder_points3D.npy'))[1]
-    ref_trans = trans[1]
+    shoulder3D = avatar_data['shoulder3D']
+    ref_trans = avatar_data['ref_trans']
 
     # camera matrix, we always use training set intrinsic parameters.
     camera = utils.camera()
-    camera_intrinsic = np.load(join(data_root, 'camera_intrinsic.npy')).astype(np.float32)
-    APC_feat_database = np.load(join(data_root, 'APC_feature_base.npy'))
+    camera_intrinsic = avatar_data['camera_intrinsic']
+    APC_feat_database = avatar_data['APC_feat_database']
 
     # load reconstruction data
-    scale = sio.loadmat(join(data_root, 'id_scale.mat'))['scale'][0, 0]
+    scale = avatar_meta['scale']
     # Audio2Mel_torch = audio_funcs.Audio2Mel(...)
 
     ########################### Experiment Settings ###########################
@@ -121,6 +144,7 @@ if __name__ == '__main__':
     Feat_AMPs = config['model_params']['Audio2Mouth']['AMP'][1:]
     rot_AMP, trans_AMP = config['model_params']['Headpose']['AMP']
     shoulder_AMP = config['model_params']['Headpose']['shoulder_AMP']
+    headpose_engine = config['model_params']['Headpose'].get('engine', 'wavenet')
     save_feature_maps = config['model_params']['Image2Image']['save_input']
 
     #### common settings
@@ -132,6 +156,7 @@ if __name__ == '__main__':
     Renderopt.dataroot = config['dataset_params']['root']
     Renderopt.load_epoch = config['model_params']['Image2Image']['ckp_path']
     Renderopt.size = config['model_params']['Image2Image']['size']
+    Renderopt.test_image_pad = avatar_meta['image_pad']
     ## GPU or CPU
     if opt.device == 'cpu':
         Featopt.gpu_ids = Headopt.gpu_ids = Renderopt.gpu_ids = []
@@ -143,8 +168,8 @@ if __name__ == '__main__':
                             config['model_params']['APC']['num_layers'],
                             config['model_params']['APC']['residual'])
     apc_ckpt_path = config['model_params']['APC']['ckp_path']
-    apc_state = torch.load(apc_ckpt_path, map_location=torch.device('cpu' if opt.device == 'cpu' else 'cuda'))
-    APC_model.load_state_dict(apc_state, strict=False)
+    apc_state, mapped = load_checkpoint(apc_ckpt_path, 'cpu' if opt.device == 'cpu' else 'cuda')
+    APC_model.load_state_dict(apc_state, strict=False, assign=mapped)
     if opt.device == 'cuda':
         APC_model.cuda()
     APC_model.eval()
@@ -169,13 +194,42 @@ if __name__ == '__main__':
     Feature2Face = create_model(Renderopt)
     Feature2Face.setup(Renderopt)
     Feature2Face.eval()
+    if opt.fold_bn:
+        Feature2Face.optimize_for_inference(channels_last=bool(opt.channels_last))
+    render_mode = opt.backend
+    if opt.backend == 'torch':
+        profile = render_mode = backends.config_profile(config)
+        print('---------- Inference profile: {} -------------'.format(profile))
+        APC_model = backends.apply_profile(profile, APC_model, Audio2Feature, Audio2Headpose, device=device,
+                                           Feature2Face=Feature2Face, config=config)
+    else:
+        export_dir = opt.export_dir or backends.default_export_dir(config)
+        print('---------- Backend: {} ({}) -------------'.format(opt.backend, export_dir))
+        APC_model = backends.apply_backend(opt.backend, export_dir, APC_model, Audio2Feature, Audio2Headpose,
+                                           Feature2Face, device=device)
+    print(sharing_report({'APC': APC_model, 'Audio2Mouth': Audio2Feature.Audio2Feature,
+                          'Headpose': Audio2Headpose.Audio2Headpose, 'Image2Image': Feature2Face.Feature2Face_G}))
     visualizer = Visualizer(Renderopt)
+    roi_renderer = None
+    if opt.roi:
+        roi_renderer = ROIRenderer(Feature2Face, opt.roi_threshold, opt.roi_full_every)
+        if not roi_renderer.enabled:
+            print('--roi needs the torch backend, rendering full frames')
+        render_mode += '|roi'
+    frame_cache = None
+    if opt.frame_cache:
+        frame_cache = FrameCache(opt.cache_step, opt.cache_size, opt.cache_dir,
+                                 renderer_namespace(Renderopt, render_mode), opt.cache_verify)
 
     ############################## Inference ##################################
     print('Processing audio: {} ...'.format(audio_name))
     # read audio
     audio, _ = librosa.load(opt.driving_audio, sr=sr)
     total_frames = np.int32(audio.shape[0] / sr * FPS)
+    silent = np.zeros(total_frames, bool)
+    if opt.vad:
+        silent = utils.detect_silence(audio, sr, FPS, silence_db=opt.silence_db, min_silence=opt.min_silence)
+        print('Voice activity detection: {:.1f}% of the frames are silent'.format(100 * silent.mean()))
 
     #### 1. compute APC features
     print('1. Computing APC features...')
@@ -191,6 +245,8 @@ if __name__ == '__main__':
     #### 2. manifold projection
     if use_LLE:
         print('2. Manifold projection...')
+        # on every frame, also the silent ones: Audio2Mouth carries their LSTM state into the
+        # following speech and Audio2Headpose moves the head with them
         ind = utils.KNN_with_torch(audio_feats, APC_feat_database, K=Knear)
         weights, feat_fuse = utils.compute_LLE_projection_all_frame(audio_feats, APC_feat_database, ind, audio_feats.shape[0])
         audio_feats = audio_feats * (1 - LLE_percent) + feat_fuse * LLE_percent
@@ -202,8 +258,12 @@ if __name__ == '__main__':
     #### 4. Audio2Headpose
     print('4. Headpose inference...')
     # set history headposes as zero
-    pre_headpose = np.zeros(Headopt.A2H_wavenet_input_channels, np.float32)
-    pred_Head = Audio2Headpose.generate_sequences(audio_feats, pre_headpose, fill_zero=True, sigma_scale=0.3, opt=Headopt)
+    if headpose_engine == 'motion_matching':
+        motion_matching = MotionMatchingHeadpose(avatar_data['headposes'])
+        pred_Head = motion_matching.generate_sequences(audio_feats, mel80, sigma_scale=0.3, opt=Headopt)
+    else:
+        pre_headpose = np.zeros(Headopt.A2H_wavenet_input_channels, np.float32)
+        pred_Head = Audio2Headpose.generate_sequences(audio_feats, pre_headpose, fill_zero=True, sigma_scale=0.3, opt=Headopt)
 
     #### 5. Post-Processing
     print('5. Post-processing...')
@@ -215,6 +275,12 @@ if __name__ == '__main__':
     pred_pts3d = utils.landmark_smooth_3d(pred_pts3d, Feat_smooth_sigma, area='only_mouth')
     pred_pts3d = utils.mouth_pts_AMP(pred_pts3d, True, AMP_method, Feat_AMPs)
     pred_pts3d = pred_pts3d + mean_pts3d
+    # silent stretches: the avatar's closed mouth, blended in over 0.1 s
+    silence_w = utils.silence_weights(silent[:nframe], blend_frames=int(0.1 * FPS))
+    if silent.any():
+        closed_mouth = avatar_data['closed_mouth'] + mean_pts3d
+        w = silence_w[:, None, None]
+        pred_pts3d[:, mouth_indices] = (1 - w) * pred_pts3d[:, mouth_indices] + w * closed_mouth[mouth_indices]
     pred_pts3d = utils.solve_intersect_mouth(pred_pts3d)  # solve intersect lips if exist
 
     ## headpose
@@ -224,13 +290,23 @@ if __name__ == '__main__':
     pred_headpose[:, 3:] += mean_translation
     pred_headpose[:, 0] += 180
 
+    ## resample to the output frame rate, only the output frames are drawn and rendered
+    out_fps = opt.output_fps
+    if out_fps != FPS:
+        pred_pts3d = utils.resample_frames(pred_pts3d[:nframe], FPS, out_fps)
+        pred_headpose = utils.resample_frames(pred_headpose[:nframe], FPS, out_fps)
+        silence_w = utils.resample_frames(silence_w, FPS, out_fps)
+        nframe = pred_pts3d.shape[0]
+    idle = silence_w >= 1
+
     ## compute projected landmarks
     pred_landmarks = np.zeros([nframe, 73, 2], dtype=np.float32)
     final_pts3d = np.zeros([nframe, 73, 3], dtype=np.float32)
     final_pts3d[:] = std_mean_pts3d.copy()
     final_pts3d[:, 46:64] = pred_pts3d[:nframe, 46:64]
     for k in tqdm(range(nframe)):
-        ind = k % candidate_eye_brow.shape[0]
+        if not (k > 0 and idle[k] and idle[k - 1]):   # the eye brows hold still in silent stretches
+            ind = int(k * FPS / out_fps) % candidate_eye_brow.shape[0]
         final_pts3d[k, eye_brow_indices] = candidate_eye_brow[ind] + mean_pts3d[eye_brow_indices]
         pred_landmarks[k], _, _ = utils.project_landmarks(
             camera_intrinsic, camera.relative_rotation,
@@ -249,40 +325,121 @@ if __name__ == '__main__':
         project[:2, :] /= project[2, :]  # divide z
         pred_shoulders[k] = project[:2, :].T
 
+    ## idle frames re-use the last rendered image while the landmarks move less than idle_px
+    reuse = np.zeros(nframe, bool)
+    ref = None
+    for k in range(nframe):
+        if idle[k] and ref is not None and \
+                max(np.abs(pred_landmarks[k] - pred_landmarks[ref]).max(),
+                    np.abs(pred_shoulders[k] - pred_shoulders[ref]).max()) < opt.idle_px:
+            reuse[k] = True
+        else:
+            ref = k
+
     #### 6. Image2Image translation & Save results
+    # drawing, Feature2Face, uint8 conversion and encoding run concurrently
     print('6. Image2Image translation & Saving results...')
-    for ind in tqdm(range(0, nframe), desc='Image2Image translation inference'):
-        # feature_map: [input_nc, h, w]
-        current_pred_feature_map = facedataset.dataset.get_data_test_mode(
-            pred_landmarks[ind],
-            pred_shoulders[ind],
-            facedataset.dataset.image_pad
-        )
+    video_tmp_path = join(save_root, 'tmp.avi')
+    feature_maps_tmp_path = join(save_root, 'tmp_feature_maps.avi')
+    fourcc = cv2.VideoWriter_fourcc(*('D', 'I', 'V', 'X'))
+    video_out = cv2.VideoWriter(video_tmp_path, fourcc, out_fps, (Renderopt.loadSize, Renderopt.loadSize))
+    if save_feature_maps:
+        feature_maps_out = cv2.VideoWriter(feature_maps_tmp_path, fourcc, out_fps, (Renderopt.loadSize, Renderopt.loadSize))
+    init_draw_worker(facedataset.dataset)
+
+    if frame_cache is not None:
+        cache_keys = [frame_cache.key(pred_landmarks[k], pred_shoulders[k]) for k in range(nframe)]
+    if roi_renderer is not None:
+        # drawing shifts the shoulders in place
+        roi_points = (pred_landmarks.copy(), pred_shoulders.copy())
+    last_render = [None]
+    render_index = [0]
+
+    def render_frame(current_pred_feature_map):
+        k = render_index[0]
+        render_index[0] += 1
+        if current_pred_feature_map is None:
+            return last_render[0]
+        cached = None
+        if frame_cache is not None:
+            cached = frame_cache.get(cache_keys[k])
+            if cached is not None and not frame_cache.verify():
+                last_render[0] = (current_pred_feature_map, cached)
+                return last_render[0]
         input_feature_maps = current_pred_feature_map.unsqueeze(0).to(device)
-        pred_fake = Feature2Face.inference(input_feature_maps, img_candidates)
-        # save results
-        visual_list = [('pred', util.tensor2im(pred_fake[0]))]
+        if roi_renderer is not None:
+            pred_fake = roi_renderer.inference(input_feature_maps, img_candidates, roi_points[0][k], roi_points[1][k])
+        else:
+            pred_fake = Feature2Face.inference(input_feature_maps, img_candidates)
+        if frame_cache is not None:
+            # the cache holds the uint8 frames
+            pred_fake = util.tensor2im(pred_fake[0])
+            if cached is None:
+                frame_cache.put(cache_keys[k], pred_fake)
+            else:
+                frame_cache.record_error(cached, pred_fake)
+                pred_fake = cached
+        last_render[0] = (current_pred_feature_map, pred_fake)
+        return last_render[0]
+
+    def to_uint8(item):
+        current_pred_feature_map, pred_fake = item
+        if not isinstance(pred_fake, np.ndarray):
+            pred_fake = util.tensor2im(pred_fake[0])
+        visual_list = [('pred', pred_fake)]
         if save_feature_maps:
             visual_list += [('input', np.uint8(current_pred_feature_map[0].cpu().numpy() * 255))]
-        visuals = OrderedDict(visual_list)
-        visualizer.save_images(save_root, visuals, str(ind + 1))
+        return OrderedDict(visual_list)
+
+    frame_count = [0]
+
+    def encode_frame(visuals):
+        frame_count[0] += 1
+        video_out.write(cv2.cvtColor(visuals['pred'], cv2.COLOR_RGB2BGR))
+        if save_feature_maps:
+            feature_maps_out.write(cv2.cvtColor(visuals['input'], cv2.COLOR_GRAY2BGR))
+        if opt.save_intermediates:
+            visualizer.save_images(save_root, visuals, str(frame_count[0]))
+
+    executor = StageExecutor([
+        Stage('draw', draw_feature_map, workers=opt.draw_workers, kind=opt.draw_mode,
+              initializer=init_draw_worker, initargs=(facedataset.dataset,)),
+        Stage('Feature2Face', render_frame),
+        Stage('to_uint8', to_uint8),
+        Stage('encode', encode_frame),
+    ], maxsize=opt.queue_size)
+    frames = (None if reuse[ind] else (pred_landmarks[ind], pred_shoulders[ind]) for ind in range(nframe))
+    for _ in tqdm(executor.run(frames), total=nframe, desc='Image2Image translation inference'):
+        pass
+    video_out.release()
+    if save_feature_maps:
+        feature_maps_out.release()
+    print(executor.report())
+    if frame_cache is not None:
+        print(frame_cache.report())
+    if roi_renderer is not None:
+        print(roi_renderer.report())
+    if opt.vad:
+        rendered = executor.counters['Feature2Face']
+        skipped = reuse.sum() * rendered['busy'] / max(nframe - reuse.sum(), 1)
+        print('VAD: {:.1f}% of the frames silent; skipped Feature2Face on {:.1f}% of the frames (~{:.1f} s)'.format(
+              100 * silent.mean(), 100 * reuse.mean(), skipped))
 
     ## make videos
     # generate corresponding audio, reused for all results
     tmp_audio_path = join(save_root, 'tmp.wav')
-    tmp_audio_clip = audio[:np.int32(nframe * sr / FPS)]
+    tmp_audio_clip = audio[:np.int32(nframe * sr / out_fps)]
     sf.write(tmp_audio_path, tmp_audio_clip, sr)  # replace deprecated librosa.output.write_wav
 
     final_path = join(save_root, audio_name + '.avi')
-    write_video_with_audio(tmp_audio_path, final_path, 'pred_')
-    feature_maps_path = join(save_root, audio_name + '_feature_maps.avi')
-    write_video_with_audio(tmp_audio_path, feature_maps_path, 'input_')
+    subprocess.call(f'ffmpeg -i "{video_tmp_path}" -i "{tmp_audio_path}" -codec copy -shortest "{final_path}"', shell=True)
+    os.remove(video_tmp_path)
+    if save_feature_maps:
+        feature_maps_path = join(save_root, audio_name + '_feature_maps.avi')
+        subprocess.call(f'ffmpeg -i "{feature_maps_tmp_path}" -i "{tmp_audio_path}" -codec copy -shortest "{feature_maps_path}"', shell=True)
+        os.remove(feature_maps_tmp_path)
 
     if os.path.exists(tmp_audio_path):
         os.remove(tmp_audio_path)
-    if not opt.save_intermediates:
-        _img_paths = list(map(lambda x: str(x), list(Path(save_root).glob('*.jpg'))))
-        for i in tqdm(range(len(_img_paths)), desc='deleting intermediate images'):
-            os.remove(_img_paths[i])
 
     print('Finish!')
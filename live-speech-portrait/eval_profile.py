@@ -0,0 +1,88 @@
+"""Compare an inference profile (yaml inference_params: profile) with fp32 on some
+driving audios: error of the predicted mouth landmarks and headposes, run time
+of the audio models (APC, Audio2Feature, Audio2Headpose) and, for scale, of
+the renderer per frame. Headposes are sampled with sigma 0 so that both
+profiles are deterministic.
+
+    python eval_profile.py --id May --profile dynamic_int8 --driving_audio ./data/input/00083.wav
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+import librosa
+
+from streaming import Avatar
+from models import backends
+from funcs import utils
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def audio_models(av, audio, APC_model):
+    ''' demo.py steps 1-4, returns (mouth landmarks [n, 25, 3], headposes [n, 12], seconds) '''
+    st = time.time()
+    mel80 = utils.compute_mel_one_sequence(audio, device='cpu')
+    with torch.no_grad():
+        mel80_torch = torch.from_numpy(mel80.astype(np.float32)).unsqueeze(0)
+        audio_feats = APC_model.forward(mel80_torch, torch.Tensor([mel80.shape[0]]))[0].numpy()
+    if av.use_LLE:
+        ind = utils.KNN_with_torch(audio_feats, av.APC_feat_database, K=av.Knear)
+        _, feat_fuse = utils.compute_LLE_projection_all_frame(audio_feats, av.APC_feat_database, ind, audio_feats.shape[0])
+        audio_feats = audio_feats * (1 - av.LLE_percent) + feat_fuse * av.LLE_percent
+    pred_Feat = av.Audio2Feature.generate_sequences(audio_feats, av.sr, av.FPS, fill_zero=True, opt=av.Featopt)
+    pre_headpose = np.zeros(av.Headopt.A2H_wavenet_input_channels, np.float32)
+    pred_Head = av.Audio2Headpose.generate_sequences(audio_feats, pre_headpose, fill_zero=True, sigma_scale=0.0, opt=av.Headopt)
+    nframe = min(pred_Feat.shape[0], pred_Head.shape[0])
+    return pred_Feat[:nframe].reshape(nframe, -1, 3), pred_Head[:nframe], time.time() - st
+
+
+def render_time(av, repeat=5):
+    size = av.Renderopt.loadSize
+    feature_map = torch.rand(1, 1, size, size, device=av.device)
+    av.Feature2Face.inference(feature_map, av.img_candidates)
+    st = time.time()
+    for _ in range(repeat):
+        av.Feature2Face.inference(feature_map, av.img_candidates)
+    return (time.time() - st) / repeat
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id', default='May', help="person name, e.g. Obama1, Obama2, May, Nadella, McStay")
+    parser.add_argument('--driving_audio', default='./data/input/00083.wav', help="comma separated driving audios")
+    parser.add_argument('--profile', default='dynamic_int8', help='profile to compare with fp32')
+    parser.add_argument('--repeat', type=int, default=3, help='timing runs per audio, the fastest counts')
+    opt = parser.parse_args()
+
+    av = Avatar(opt.id, 'cpu', profile='fp32')
+    fp32 = (av.APC_model, av.Audio2Feature.Audio2Feature, av.Audio2Headpose.Audio2Headpose)
+    APC_quant = backends.apply_profile(opt.profile, av.APC_model, av.Audio2Feature, av.Audio2Headpose)
+    quant = (APC_quant, av.Audio2Feature.Audio2Feature, av.Audio2Headpose.Audio2Headpose)
+
+    def run(models, audio):
+        APC_model, av.Audio2Feature.Audio2Feature, av.Audio2Headpose.Audio2Headpose = models
+        results = [audio_models(av, audio, APC_model) for _ in range(opt.repeat)]
+        return results[0][0], results[0][1], min(r[2] for r in results)
+
+    total = {'frames': 0, 'fp32': 0.0, opt.profile: 0.0}
+    print('{:<24s}{:>8s}{:>12s}{:>12s}{:>12s}{:>12s}{:>10s}'.format(
+        'audio', 'frames', 'mouth mean', 'mouth max', 'rot mean', 'trans mean', 'speedup'))
+    for path in opt.driving_audio.split(','):
+        audio, _ = librosa.load(path, sr=av.sr)
+        feat_ref, head_ref, t_ref = run(fp32, audio)
+        feat, head, t = run(quant, audio)
+        mouth_err = np.linalg.norm(feat - feat_ref, axis=-1)
+        print('{:<24s}{:>8d}{:>12.4f}{:>12.4f}{:>12.4f}{:>12.4f}{:>9.2f}x'.format(
+            path[-24:], len(feat), mouth_err.mean(), mouth_err.max(),
+            np.abs(head[:, 0:3] - head_ref[:, 0:3]).mean(), np.abs(head[:, 3:6] - head_ref[:, 3:6]).mean(), t_ref / t))
+        total['frames'] += len(feat)
+        total['fp32'] += t_ref
+        total[opt.profile] += t
+
+    render = render_time(av)
+    print('audio models per frame: fp32 {:.1f} ms, {} {:.1f} ms; renderer {:.1f} ms per frame'.format(
+        1000 * total['fp32'] / total['frames'], opt.profile, 1000 * total[opt.profile] / total['frames'], 1000 * render))
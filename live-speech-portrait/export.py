@@ -0,0 +1,76 @@
+"""Export the APC, Audio2Feature, Audio2Headpose and Feature2Face networks of one
+talking head to TorchScript and / or ONNX, then check every exported graph
+against the eager model on random inputs (other time lengths than the export
+example for the dynamic axes). Exits with 1 if a graph differs.
+
+    python export.py --id May --backends torchscript,onnx
+    python demo.py --id May --backend onnx
+"""
+import os
+import sys
+import argparse
+
+import torch
+
+from streaming import Avatar
+from models import backends
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def parity_inputs(inputs, dynamic_axes, input_names, length=160):
+    ''' random inputs like the export example, dynamic axes resized to length '''
+    parity = []
+    for name, x in zip(input_names, inputs):
+        shape = list(x.shape)
+        for axis in dynamic_axes.get(name, {}):
+            shape[axis] = length
+        parity.append(torch.randn(shape, device=x.device, dtype=x.dtype))
+    return tuple(parity)
+
+
+def check_parity(module, runtime, inputs):
+    ''' max abs difference over the outputs, relative to the output range if above 1 '''
+    with torch.no_grad():
+        ref = module(*inputs)
+    ref = ref if isinstance(ref, tuple) else (ref,)
+    out = runtime(*inputs)
+    return max((o.float().to(r.device) - r.float()).abs().max().item() / max(1.0, r.float().abs().max().item())
+               for o, r in zip(out, ref))
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id', default='May', help="person name, e.g. Obama1, Obama2, May, Nadella, McStay")
+    parser.add_argument('--device', type=str, default='cpu', help='use cuda for GPU or use cpu for CPU')
+    parser.add_argument('--backends', type=str, default='torchscript,onnx', help='comma separated: torchscript, onnx')
+    parser.add_argument('--export_dir', type=str, default=None, help='default <checkpoints>/export')
+    parser.add_argument('--fold_bn', type=int, default=1, help='export Feature2Face with BatchNorm folded')
+    parser.add_argument('--atol', type=float, default=1e-3, help='parity tolerance')
+    opt = parser.parse_args()
+
+    avatar = Avatar(opt.id, opt.device, fold_bn=bool(opt.fold_bn), profile='fp32')
+    export_dir = opt.export_dir or backends.default_export_dir(avatar.config)
+    os.makedirs(export_dir, exist_ok=True)
+    specs = backends.export_specs(avatar.APC_model, avatar.Audio2Feature, avatar.Audio2Headpose,
+                                  avatar.Feature2Face, device=avatar.device)
+
+    failed = []
+    for backend in opt.backends.split(','):
+        for name, (module, inputs, input_names, output_names, dynamic_axes) in specs.items():
+            path = os.path.join(export_dir, name)
+            print('exporting {} ({})...'.format(name, backend))
+            backends.export_model(module, inputs, path, backend, input_names, output_names, dynamic_axes)
+            runtime = backends.Runtime(path, backend, avatar.device)
+            diff = check_parity(module, runtime, parity_inputs(inputs, dynamic_axes, input_names))
+            ok = diff <= opt.atol
+            print('  {}{} max diff {:.2e} {}'.format(path, backends.EXTENSIONS[backend], diff, 'ok' if ok else 'FAILED'))
+            if not ok:
+                failed.append((name, backend))
+
+    if failed:
+        print('parity check failed: {}'.format(', '.join('{} ({})'.format(*f) for f in failed)))
+        sys.exit(1)
+    print('Finish! Run demo.py / streaming.py with --backend {}'.format(opt.backends.split(',')[0]))
@@ -67,11 +67,34 @@ class Audio2Feature(nn.Module):
             output, (hn, cn) = self.LSTM(down_audio_feats)
 #            output, (hn, cn) = self.LSTM(audio_features)
             pred = self.fc(output.reshape(-1, 256)).reshape(bs, int(item_len/2), -1)
-#            pred = self.fc(output.reshape(-1, 256)).reshape(bs, item_len, -1)[:, -self.opt.time_frame_length:, :] 
-        
+#            pred = self.fc(output.reshape(-1, 256)).reshape(bs, item_len, -1)[:, -self.opt.time_frame_length:, :]
+
         return pred
 
 
+    def forward_stream(self, audio_features, state=None):
+        '''
+        LSTM decoder over the next chunk of a sequence, state (hn, cn) is carried
+        across chunks so that chunked calls match one forward() over the whole sequence.
+        Args:
+            audio_features: [b, T, ndim], T even
+            state: state returned by the previous call, or None
+        Returns:
+            pred: [b, T/2, output_size]
+            state: (hn, cn) for the next call
+        '''
+        if self.opt.feature_decoder != 'LSTM':
+            # the WaveNet decoder only predicts the last time_frame_length frames
+            raise NotImplementedError('streaming inference needs the LSTM feature decoder')
+        bs, item_len, ndim = audio_features.shape
+        audio_features = audio_features.reshape(bs, -1, ndim*2)
+        down_audio_feats = self.downsample(audio_features.reshape(-1, ndim*2)).reshape(bs, int(item_len/2), ndim)
+        output, state = self.LSTM(down_audio_feats, state)
+        pred = self.fc(output.reshape(-1, 256)).reshape(bs, int(item_len/2), -1)
+
+        return pred, state
+
+
 
 
 
@@ -152,6 +152,49 @@ class Audio2FeatureModel(BaseModel):
                             
 
         return preds
-    
-    
-                                
\ No newline at end of file
+
+
+    def init_stream(self):
+        ''' state for generate_sequences_stream() '''
+        self.Audio2Feature.eval()
+        return {'pending': None,    # odd APC frame waiting for its pair
+                'last_feat': None,  # repeated frame_future times at the end, as generate_sequences
+                'hidden': None,     # LSTM (hn, cn)
+                'steps': 0}         # decoder steps taken so far
+
+
+    def generate_sequences_stream(self, state, audio_feats, last=False, opt=[]):
+        ''' incremental generate_sequences(): feed the next APC frames, get the
+        predictions whose frame_future look-ahead is now available. With last=True
+        the sequence end is padded like generate_sequences() does, so the
+        concatenated outputs equal its result for the whole sequence.
+        Args:
+            audio_feats: [n, ndim] next APC frames, in numpy (n may be 0 or odd)
+        Returns:
+            preds: [m, output_size] new frames, in numpy
+        '''
+        frame_future = opt.frame_future
+        if len(audio_feats):
+            state['last_feat'] = audio_feats[-1]
+        if state['pending'] is not None:
+            audio_feats = np.concatenate([state['pending'][None], audio_feats])
+            state['pending'] = None
+        if len(audio_feats) % 2 == 1:
+            state['pending'], audio_feats = audio_feats[-1], audio_feats[:-1]
+        if last and not frame_future == 0 and state['last_feat'] is not None:
+            audio_feats_insert = np.repeat(state['last_feat'][None], 2 * frame_future, axis=0)
+            audio_feats = np.concatenate([audio_feats, audio_feats_insert])
+        if len(audio_feats) == 0:
+            return np.zeros([0, self.opt.A2L_GMM_ndim * self.opt.predict_length], np.float32)
+
+        net = getattr(self.Audio2Feature, 'module', self.Audio2Feature)
+        with torch.no_grad():
+            input = torch.from_numpy(audio_feats).unsqueeze(0).float().to(self.device)
+            preds, state['hidden'] = net.forward_stream(input, state['hidden'])
+        preds = preds[0].cpu().detach().numpy()
+
+        # drop first frame future results
+        skip = max(0, frame_future - state['steps'])
+        state['steps'] += preds.shape[0]
+
+        return preds[skip:]
@@ -50,6 +50,31 @@ class Audio2Headpose(nn.Module):
 
 
         return pred
+
+
+    def precompute_cond(self, audio_features):
+        '''
+        audio downsampling and the WaveNet condition convolutions for a whole
+        sequence at once; all of them work per time step, so slicing the result
+        [..., t:t + receptive_field] equals processing that window in forward().
+        Args:
+            audio_features: [b, T, nfeas]
+        Returns:
+            cond_proj: [nblocks, b, 2 * dilation_channels, T]
+        '''
+        bs, item_len, ndim = audio_features.shape
+        down_audio_feats = self.audio_downsample(audio_features.reshape(-1, ndim)).reshape(bs, item_len, -1)
+        return self.WaveNet.cond_projection(down_audio_feats.transpose(1,2))
+
+
+    def forward_cached(self, history_info, cond_proj):
+        '''
+        forward() with the audio part taken from a precompute_cond() slice
+        Args:
+            history_info: [b, T, ndim]
+            cond_proj: precompute_cond() output sliced to the same T steps
+        '''
+        return self.WaveNet.forward(history_info.permute(0,2,1), cond_proj=cond_proj)
     
 
 
@@ -165,17 +165,23 @@ class Audio2HeadposeModel(BaseModel):
                       
             # evaluate mode
             self.Audio2Headpose.eval()
+            net = getattr(self.Audio2Headpose, 'module', self.Audio2Headpose)
                     
             with torch.no_grad():
+                if self.opt.feature_decoder == 'WaveNet':
+                    # audio downsampling & condition convolutions once for the whole
+                    # sequence, the loop below only slices its window
+                    cond_proj = net.precompute_cond(torch.from_numpy(audio_feats).unsqueeze(0).float().to(self.device))
                 for i in tqdm(range(infer_start, nframe), desc='generating headpose'):
                     history_start = i - infer_start
-                    input_audio_feats = audio_feats[history_start + frame_future: history_start + frame_future + opt.A2H_receptive_field]
-                    input_audio_feats = torch.from_numpy(input_audio_feats).unsqueeze(0).float().to(self.device) 
+                    window_start = history_start + frame_future
+                    window_end = window_start + opt.A2H_receptive_field
 
                     if self.opt.feature_decoder == 'WaveNet':
-                        preds = self.Audio2Headpose.forward(history_headpose, input_audio_feats) 
+                        preds = net.forward_cached(history_headpose, cond_proj[..., window_start:window_end])
                     elif self.opt.feature_decoder == 'LSTM':
-                        preds = self.Audio2Headpose.forward(input_audio_feats) 
+                        input_audio_feats = torch.from_numpy(audio_feats[window_start:window_end]).unsqueeze(0).float().to(self.device)
+                        preds = self.Audio2Headpose.forward(input_audio_feats)
                          
                     if opt.loss == 'GMM':
                         pred_data = Sample_GMM(preds, opt.A2H_GMM_ncenter, opt.A2H_GMM_ndim, sigma_scale=sigma_scale)  
@@ -201,8 +207,79 @@ class Audio2HeadposeModel(BaseModel):
                 pred_headpose = pred_data[0].cpu().detach().numpy()  
             
             return pred_headpose
-    
-    
-            
-    
-    
\ No newline at end of file
+
+
+    def init_stream(self, pre_headpose, opt=[]):
+        ''' state for generate_sequences_stream(), with the same zero-filled
+        history and first-frame audio padding as generate_sequences(fill_zero=True)
+        '''
+        if opt.feature_decoder != 'WaveNet':
+            raise NotImplementedError('streaming inference needs the WaveNet headpose decoder')
+        self.Audio2Headpose.eval()
+        history_headpose = np.repeat(pre_headpose, opt.A2H_receptive_field)
+        history_headpose = history_headpose.reshape(-1, opt.A2H_receptive_field).T
+        return {'history': torch.from_numpy(history_headpose).unsqueeze(0).float().to(self.device),
+                'pending': None,     # odd APC frame waiting for its pair
+                'cond_proj': None,   # precompute_cond() of the padded audio features from index 'offset' on
+                'offset': 0,
+                'next': 0}           # next frame to predict
+
+
+    def generate_sequences_stream(self, state, audio_feats, sigma_scale=0.0, opt=[]):
+        ''' incremental generate_sequences(): feed the next APC frames, get the
+        headposes of all frames whose frame_future look-ahead is now available.
+        As in generate_sequences(), the last frame_future frames are never predicted.
+        Args:
+            audio_feats: [n, 512] next APC frames, in numpy (n may be 0 or odd)
+        Returns:
+            pred_headpose: [m, A2H_GMM_ndim] new frames, in numpy
+        '''
+        frame_future = opt.frame_future
+        if state['pending'] is not None:
+            audio_feats = np.concatenate([state['pending'][None], audio_feats])
+            state['pending'] = None
+        if len(audio_feats) % 2 == 1:
+            state['pending'], audio_feats = audio_feats[-1], audio_feats[:-1]
+        audio_feats = audio_feats.reshape(-1, 512 * 2)
+        net = getattr(self.Audio2Headpose, 'module', self.Audio2Headpose)
+
+        with torch.no_grad():
+            if len(audio_feats):
+                if state['cond_proj'] is None:
+                    audio_feats_insert = np.repeat(audio_feats[:1], opt.A2H_receptive_field - 1, axis=0)
+                    audio_feats = np.concatenate([audio_feats_insert, audio_feats])
+                # only the new frames go through the downsampling & condition convolutions
+                cond_proj = net.precompute_cond(torch.from_numpy(audio_feats).unsqueeze(0).float().to(self.device))
+                if state['cond_proj'] is not None:
+                    cond_proj = torch.cat([state['cond_proj'], cond_proj], dim=-1)
+                state['cond_proj'] = cond_proj
+        if state['cond_proj'] is None:
+            return np.zeros([0, opt.A2H_GMM_ndim])
+
+        # frame i needs padded frames [i + frame_future, i + frame_future + receptive_field)
+        nframe = state['offset'] + state['cond_proj'].shape[-1] - opt.A2H_receptive_field - frame_future + 1
+        start = state['next']
+        pred_headpose = np.zeros([max(0, nframe - start), opt.A2H_GMM_ndim])
+        history_headpose = state['history']
+        with torch.no_grad():
+            for i in range(start, nframe):
+                window_start = i + frame_future - state['offset']
+                window_end = window_start + opt.A2H_receptive_field
+                preds = net.forward_cached(history_headpose, state['cond_proj'][..., window_start:window_end])
+
+                if opt.loss == 'GMM':
+                    pred_data = Sample_GMM(preds, opt.A2H_GMM_ncenter, opt.A2H_GMM_ndim, sigma_scale=sigma_scale)
+                elif opt.loss == 'L2':
+                    pred_data = preds
+
+                pred_headpose[i - start] = pred_data[0,0].cpu().detach().numpy()
+                history_headpose = torch.cat((history_headpose[:,1:,:], pred_data.to(self.device)), dim=1)  # add in time-axis
+        state['history'] = history_headpose
+        if nframe > start:
+            state['next'] = nframe
+            # keep what the next frame's window still needs
+            drop = nframe + frame_future - state['offset']
+            state['cond_proj'] = state['cond_proj'][..., drop:]
+            state['offset'] += drop
+
+        return pred_headpose
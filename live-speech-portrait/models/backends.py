@@ -0,0 +1,333 @@
+"""Export of the four inference networks to TorchScript / ONNX, and drop-in
+replacements of the eager modules that run the exported graphs.
+
+    APC                  mel [1, T, 80], hidden [L, 1, H]      -> feats [1, T, H], hidden
+    Audio2Feature        feats [1, T, 512], h0, c0 (LSTM)      -> pred [1, T/2, n], hn, cn
+    Audio2Headpose_cond  feats [1, T, 1024]                    -> cond_proj [nblocks, 1, 2C, T]
+    Audio2Headpose_step  history [1, RF, 12], cond_proj window -> pred [1, 1, n]
+    Feature2Face         feature map, candidate response       -> image [1, 3, H, W]
+
+The time axes (T) are dynamic. The sequence graphs take the recurrent states as
+inputs, so the same graph serves whole sequences and streaming chunks. The
+candidate images' part of the Feature2Face first layer is still computed (once)
+by the eager generator, see CandidateCacheMixin.
+"""
+import inspect
+import os
+from os.path import join
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from . import networks
+
+
+BACKENDS = ['torch', 'torchscript', 'onnx']
+EXTENSIONS = {'torchscript': '.pt', 'onnx': '.onnx'}
+PROFILES = ['fp32', 'dynamic_int8', 'int8']
+
+
+def default_export_dir(config):
+    ''' per talking head, next to its checkpoints '''
+    return join(os.path.dirname(config['model_params']['Image2Image']['ckp_path']), 'export')
+
+
+def quantized_renderer_path(config):
+    ''' Feature2Face.pkl -> Feature2Face_int8.pt, written by quantize_renderer.py '''
+    return os.path.splitext(config['model_params']['Image2Image']['ckp_path'])[0] + '_int8.pt'
+
+
+def config_profile(config):
+    ''' inference_params: profile of the talking head yaml, fp32 if not given '''
+    return (config.get('inference_params') or {}).get('profile', 'fp32')
+
+
+def apply_profile(profile, APC_model, Audio2Feature, Audio2Headpose, device='cpu', Feature2Face=None, config=None):
+    ''' fp32: nothing to do. dynamic_int8: int8 GRU / LSTM / Linear weights in APC,
+    Audio2Feature and Audio2Headpose (the renderer is convolutional and stays fp32).
+    int8: dynamic_int8 plus the calibrated static int8 renderer (quantize_renderer.py),
+    if Feature2Face and config are given.
+    Returns the APC model to use, the others are changed in place.
+    '''
+    if profile not in PROFILES:
+        raise ValueError('unknown inference profile: %s' % profile)
+    if profile == 'fp32':
+        return APC_model
+    if torch.device(device).type != 'cpu':
+        raise ValueError('the %s profile runs on CPU only' % profile)
+    if profile == 'int8' and Feature2Face is not None:
+        path = quantized_renderer_path(config)
+        if not os.path.exists(path):
+            raise FileNotFoundError('{} not found, run quantize_renderer.py first'.format(path))
+        Feature2Face.load_quantized(path)
+    Audio2Feature.Audio2Feature = networks.quantize_dynamic_int8(Audio2Feature.Audio2Feature)
+    Audio2Headpose.Audio2Headpose = networks.quantize_dynamic_int8(Audio2Headpose.Audio2Headpose)
+    return networks.quantize_dynamic_int8(APC_model)
+
+
+############################## export wrappers ################################
+class APCExport(nn.Module):
+    ''' APC_encoder.forward_stream() with the per-layer states stacked in one tensor '''
+    def __init__(self, apc):
+        super(APCExport, self).__init__()
+        self.apc = apc
+
+    def forward(self, mel, hidden):
+        rnn_inputs = mel
+        hiddens = []
+        for i, layer in enumerate(self.apc.rnns):
+            rnn_outputs, h = layer(rnn_inputs, hidden[i:i + 1])
+            hiddens.append(h)
+            if i + 1 < len(self.apc.rnns):
+                if self.apc.rnn_residual and rnn_inputs.size(-1) == rnn_outputs.size(-1):
+                    rnn_outputs = rnn_outputs + rnn_inputs
+                rnn_inputs = rnn_outputs
+        return rnn_outputs, torch.cat(hiddens)
+
+
+class Audio2FeatureExport(nn.Module):
+    ''' Audio2Feature.forward_stream() without python ints in the shapes '''
+    def __init__(self, net):
+        super(Audio2FeatureExport, self).__init__()
+        if net.opt.feature_decoder != 'LSTM':
+            raise NotImplementedError('export needs the LSTM feature decoder')
+        self.net = net
+
+    def forward(self, audio_features, h0, c0):
+        bs, ndim = audio_features.shape[0], audio_features.shape[2]
+        audio_features = audio_features.reshape(-1, ndim * 2)
+        down_audio_feats = self.net.downsample(audio_features).reshape(bs, -1, ndim)
+        output, (hn, cn) = self.net.LSTM(down_audio_feats, (h0, c0))
+        pred = self.net.fc(output.reshape(-1, 256)).reshape(bs, output.shape[1], -1)
+        return pred, hn, cn
+
+
+class Audio2HeadposeCondExport(nn.Module):
+    def __init__(self, net):
+        super(Audio2HeadposeCondExport, self).__init__()
+        self.net = net
+
+    def forward(self, audio_features):
+        return self.net.precompute_cond(audio_features)
+
+
+class Audio2HeadposeStepExport(nn.Module):
+    def __init__(self, net):
+        super(Audio2HeadposeStepExport, self).__init__()
+        self.net = net
+
+    def forward(self, history_info, cond_proj):
+        return self.net.forward_cached(history_info, cond_proj)
+
+
+class Feature2FaceExport(nn.Module):
+    def __init__(self, netG):
+        super(Feature2FaceExport, self).__init__()
+        self.netG = netG
+
+    def forward(self, feature_map, cand_response):
+        return self.netG.forward_response(feature_map, cand_response)
+
+
+def export_specs(APC_model, Audio2Feature, Audio2Headpose, Feature2Face, device='cpu'):
+    ''' {name: (module, example inputs, input names, output names, dynamic axes)}
+    for the eager models as set up by demo.py / streaming.Avatar.
+    '''
+    device = torch.device(device)
+    a2f = getattr(Audio2Feature.Audio2Feature, 'module', Audio2Feature.Audio2Feature)
+    a2h = getattr(Audio2Headpose.Audio2Headpose, 'module', Audio2Headpose.Audio2Headpose)
+    G = getattr(Feature2Face.Feature2Face_G, 'module', Feature2Face.Feature2Face_G)
+    netG = G.netG
+    rnns = APC_model.rnns
+    RF = a2h.WaveNet.receptive_field
+    n_blocks = len(a2h.WaveNet.residual_blocks)
+    cond_channels = 2 * a2h.WaveNet.dilation_channels
+    first_conv = netG.first_conv()
+    size = Feature2Face.opt.loadSize
+    n_cand = 12
+    with torch.no_grad():
+        cand_response = netG.candidate_response(torch.zeros(1, n_cand, size, size, device=device))
+    lstm = a2f.LSTM if a2f.opt.feature_decoder == 'LSTM' else None
+
+    specs = {
+        'APC': (APCExport(APC_model),
+                (torch.randn(1, 100, rnns[0].input_size, device=device),
+                 torch.zeros(len(rnns), 1, rnns[0].hidden_size, device=device)),
+                ['mel', 'hidden'], ['feats', 'hidden_out'],
+                {'mel': {1: 'T'}, 'feats': {1: 'T'}}),
+        'Audio2Headpose_cond': (Audio2HeadposeCondExport(a2h),
+                (torch.randn(1, 100, a2h.opt.APC_hidden_size * 2, device=device),),
+                ['audio_feats'], ['cond_proj'],
+                {'audio_feats': {1: 'T'}, 'cond_proj': {3: 'T'}}),
+        'Audio2Headpose_step': (Audio2HeadposeStepExport(a2h),
+                (torch.randn(1, RF, a2h.opt.A2H_GMM_ndim, device=device),
+                 torch.randn(n_blocks, 1, cond_channels, RF, device=device)),
+                ['history', 'cond_proj'], ['preds'], {}),
+        'Feature2Face': (Feature2FaceExport(netG),
+                (torch.randn(1, first_conv.in_channels - n_cand, size, size, device=device), cand_response),
+                ['feature_map', 'cand_response'], ['image'], {}),
+    }
+    if lstm is not None:
+        state = torch.zeros(lstm.num_layers, 1, lstm.hidden_size, device=device)
+        specs['Audio2Feature'] = (Audio2FeatureExport(a2f),
+                (torch.randn(1, 100, a2f.opt.APC_hidden_size, device=device), state, state),
+                ['audio_feats', 'h0', 'c0'], ['preds', 'hn', 'cn'],
+                {'audio_feats': {1: 'T'}, 'preds': {1: 'T2'}})
+    return specs
+
+
+def export_model(module, inputs, path, backend, input_names, output_names, dynamic_axes):
+    ''' writes path + '.pt' (TorchScript) or path + '.onnx' '''
+    module.eval()
+    with torch.no_grad():
+        if backend == 'torchscript':
+            traced = torch.jit.trace(module, inputs, check_trace=False)
+            traced = torch.jit.freeze(traced)
+            traced.save(path + EXTENSIONS[backend])
+        elif backend == 'onnx':
+            kwargs = {}
+            if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+                kwargs['dynamo'] = False   # the TorchScript based exporter handles the GRU / LSTM states
+            torch.onnx.export(module, inputs, path + EXTENSIONS[backend], input_names=input_names,
+                              output_names=output_names, dynamic_axes=dynamic_axes, opset_version=17, **kwargs)
+        else:
+            raise ValueError('unknown export backend: %s' % backend)
+
+
+############################## runtimes #######################################
+class Runtime(object):
+    ''' an exported graph, called with torch tensors, returns a tuple of torch tensors '''
+    def __init__(self, path, backend, device='cpu'):
+        self.backend = backend
+        self.device = torch.device(device)
+        path = path + EXTENSIONS[backend]
+        if not os.path.exists(path):
+            raise FileNotFoundError('{} not found, run export.py first'.format(path))
+        if backend == 'torchscript':
+            self.module = torch.jit.load(path, map_location=self.device)
+            self.module.eval()
+        elif backend == 'onnx':
+            try:
+                import onnxruntime as ort
+            except ImportError:
+                raise ImportError('the onnx backend needs onnxruntime: pip install onnxruntime')
+            providers = ['CPUExecutionProvider']
+            if self.device.type == 'cuda':
+                providers.insert(0, 'CUDAExecutionProvider')
+            self.session = ort.InferenceSession(path, providers=providers)
+            self.input_names = [i.name for i in self.session.get_inputs()]
+        else:
+            raise ValueError('unknown backend: %s' % backend)
+
+    def __call__(self, *inputs):
+        if self.backend == 'torchscript':
+            with torch.no_grad():
+                outputs = self.module(*inputs)
+            return outputs if isinstance(outputs, tuple) else (outputs,)
+        feed = {name: np.ascontiguousarray(x.detach().cpu().numpy().astype(np.float32))
+                for name, x in zip(self.input_names, inputs)}
+        return tuple(torch.from_numpy(y).to(self.device) for y in self.session.run(None, feed))
+
+
+class _Backend(object):
+    ''' stands in for an eager module; unknown attributes go to the eager one '''
+    training = False
+
+    def __init__(self, eager, **runtimes):
+        self.eager = eager
+        self.runtimes = runtimes
+
+    def eval(self):
+        return self
+
+    def train(self, mode=True):
+        if mode:
+            raise RuntimeError('exported models are inference only')
+        return self
+
+    def __getattr__(self, name):
+        if name in ('eager', 'runtimes'):
+            raise AttributeError(name)
+        return getattr(self.eager, name)
+
+
+class APCBackend(_Backend):
+    def _zeros(self, inputs):
+        rnns = self.eager.rnns
+        return inputs.new_zeros(len(rnns), inputs.shape[0], rnns[0].hidden_size)
+
+    def forward(self, inputs, lengths):
+        if inputs.shape[0] != 1 or int(lengths[0]) != inputs.shape[1]:
+            # padded batches need the packed sequences of the eager model
+            return self.eager.forward(inputs, lengths)
+        return self.runtimes['APC'](inputs, self._zeros(inputs))[0]
+
+    def forward_batch(self, mels):
+        if len(mels) != 1:
+            # the exported graph runs one sequence, packed batches run eager
+            return self.eager.forward_batch(mels)
+        return [self.runtimes['APC'](mels[0][None], self._zeros(mels[0][None]))[0][0]]
+
+    def forward_stream(self, inputs, hiddens=None):
+        hidden = self._zeros(inputs) if hiddens is None else torch.cat(hiddens)
+        rnn_outputs, hidden = self.runtimes['APC'](inputs, hidden)
+        return rnn_outputs, list(hidden.split(1))
+
+
+class Audio2FeatureBackend(_Backend):
+    def _zeros(self, audio_features):
+        lstm = self.eager.LSTM
+        state = audio_features.new_zeros(lstm.num_layers, audio_features.shape[0], lstm.hidden_size)
+        return state, state
+
+    def forward(self, audio_features):
+        return self.forward_stream(audio_features)[0]
+
+    def forward_stream(self, audio_features, state=None):
+        h0, c0 = self._zeros(audio_features) if state is None else state
+        pred, hn, cn = self.runtimes['Audio2Feature'](audio_features, h0, c0)
+        return pred, (hn, cn)
+
+
+class Audio2HeadposeBackend(_Backend):
+    def precompute_cond(self, audio_features):
+        return self.runtimes['Audio2Headpose_cond'](audio_features)[0]
+
+    def forward_cached(self, history_info, cond_proj):
+        return self.runtimes['Audio2Headpose_step'](history_info, cond_proj.contiguous())[0]
+
+
+class Feature2FaceBackend(_Backend):
+    # the exported graph has a fixed batch size of 1 (see util.render_scheduler)
+    batch_inference = False
+
+    def inference(self, feature_map, cand_image):
+        # the candidate part of the first layer stays eager, it runs once per avatar
+        cand_response = self.eager.netG.candidate_response(cand_image)
+        return self.runtimes['Feature2Face'](feature_map.float(), cand_response.float())[0]
+
+
+def apply_backend(backend, export_dir, APC_model, Audio2Feature, Audio2Headpose, Feature2Face, device='cpu'):
+    ''' swaps the networks of the models for runtimes of the exported graphs in
+    export_dir. Returns the APC model to use, the others are changed in place.
+    '''
+    if backend == 'torch':
+        return APC_model
+    path = lambda name: join(export_dir, name)
+    a2f = getattr(Audio2Feature.Audio2Feature, 'module', Audio2Feature.Audio2Feature)
+    a2h = getattr(Audio2Headpose.Audio2Headpose, 'module', Audio2Headpose.Audio2Headpose)
+    G = getattr(Feature2Face.Feature2Face_G, 'module', Feature2Face.Feature2Face_G)
+
+    APC_model = APCBackend(APC_model, APC=Runtime(path('APC'), backend, device))
+    if a2f.opt.feature_decoder == 'LSTM':
+        Audio2Feature.Audio2Feature = Audio2FeatureBackend(
+            a2f, Audio2Feature=Runtime(path('Audio2Feature'), backend, device))
+    Audio2Headpose.Audio2Headpose = Audio2HeadposeBackend(
+        a2h, Audio2Headpose_cond=Runtime(path('Audio2Headpose_cond'), backend, device),
+        Audio2Headpose_step=Runtime(path('Audio2Headpose_step'), backend, device))
+    Feature2Face.Feature2Face_G = Feature2FaceBackend(
+        G, Feature2Face=Runtime(path('Feature2Face'), backend, device))
+    # fp32 graphs, and the channels_last conversion is up to the runtime
+    Feature2Face.channels_last = False
+    return APC_model
@@ -4,6 +4,7 @@ import numpy as np
 from collections import OrderedDict
 from abc import ABC, abstractmethod
 from . import networks
+from .checkpoints import load_checkpoint
 
 
 class BaseModel(ABC):
@@ -198,6 +199,8 @@ class BaseModel(ABC):
         """
         
             
+        # checkpoint of every network loaded memory mapped, for checkpoints.map_derived
+        self.mapped_checkpoints = {}
         for name in self.model_names:
             if isinstance(name, str):
                 if epoch[-3:] == 'pkl':
@@ -209,14 +212,18 @@ class BaseModel(ABC):
 #                if isinstance(net, torch.nn.DataParallel):
 #                    net = net.module
                 if os.path.exists(load_path):
-                    state_dict = torch.load(load_path, map_location=str(self.device))
+                    # memory mapped if converted by convert_checkpoints.py
+                    state_dict, mapped = load_checkpoint(load_path, self.device)
                     if self.device == torch.device('cpu'):
                         for key in list(state_dict.keys()):
                             state_dict[key[7:]] = state_dict.pop(key)
                     if hasattr(state_dict, '_metadata'):
                         del state_dict._metadata
                     print('loading the model from %s' % load_path)
-                    net.load_state_dict(state_dict, strict=False)
+                    # the optimizers hold the current parameters, only replace them for inference
+                    net.load_state_dict(state_dict, strict=False, assign=mapped and not self.isTrain)
+                    if mapped and not self.isTrain:
+                        self.mapped_checkpoints[name] = load_path
                 else:
                     print('No model weight file:', load_path, 'initialize model without pre-trained weights.')
                     if self.isTrain == False:
@@ -0,0 +1,161 @@
+"""Memory-mapped checkpoints shared across talking heads and processes.
+
+convert_checkpoints.py re-saves every checkpoint of the configs once, in
+torch's zip format, into a content addressed store (<store>/<sha256>.pt, the
+hash of the original file) and hard links it next to the original as
+<checkpoint>.mmap.pt. Identical checkpoints (the APC model of every config, a
+renderer used by several heads) become one file, and load_checkpoint() maps it
+instead of reading it into private memory: every model of every process that
+loads it shares the page cache, as long as it does not write to the weights.
+Weights derived from a checkpoint at load time (the BatchNorm folded renderer)
+are written once next to it and mapped as well, see map_derived().
+"""
+import os
+import hashlib
+import tempfile
+
+import torch
+
+
+def mmap_path(path):
+    return path + '.mmap.pt'
+
+
+def derived_path(path, tag):
+    return path + '.{}.mmap.pt'.format(tag)
+
+
+def is_current(path, source):
+    return os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+
+
+def file_hash(path, chunk=1 << 20):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def save_atomic(obj, path):
+    ''' torch.save(obj, path) through a temporary file of its own, so that processes
+    writing the same path at once each install a complete file '''
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        torch.save(obj, tmp)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def convert_checkpoint(path, store_dir):
+    ''' the store file of checkpoint path, written if it is new, linked as mmap_path(path).
+    Returns (sha256, whether the store already had it) '''
+    sha = file_hash(path)
+    blob = os.path.join(store_dir, sha + '.pt')
+    shared = os.path.exists(blob)
+    if not shared:
+        os.makedirs(store_dir, exist_ok=True)
+        state_dict = torch.load(path, map_location='cpu')
+        save_atomic(state_dict, blob)
+    link = mmap_path(path)
+    if os.path.lexists(link):
+        os.remove(link)
+    try:
+        os.link(blob, link)
+    except OSError:
+        # other file system, the store file is not shared with this one
+        torch.save(torch.load(blob, map_location='cpu'), link)
+    # newer than path, also when the store file is older
+    os.utime(link)
+    return sha, shared
+
+
+def load_checkpoint(path, device='cpu'):
+    ''' torch.load(path, map_location=device), memory mapped from mmap_path(path)
+    when convert_checkpoint() was run after the last change of path.
+    Returns (state_dict, mapped): load mapped state dicts with
+    load_state_dict(..., assign=True) for the module to use the mapped weights.
+    '''
+    device = torch.device(device)
+    mapped = mmap_path(path)
+    if is_current(mapped, path):
+        state_dict = torch.load(mapped, map_location='cpu', mmap=True)
+        if device.type == 'cpu':
+            return state_dict, True
+        return {key: value.to(device) if torch.is_tensor(value) else value
+                for key, value in state_dict.items()}, False
+    return torch.load(path, map_location=device), False
+
+
+def map_derived(module, path, tag):
+    ''' replaces the weights of module, derived at load time from the memory mapped
+    checkpoint path (e.g. with BatchNorm folded), by a memory mapped copy: the first
+    process that derives them after convert_checkpoint() writes derived_path(path, tag),
+    every later one maps it. tag names the derivation, a different one is another file.
+    CPU modules only. Returns whether module is mapped now; if the file cannot be
+    written or loaded, module keeps its private weights.
+    '''
+    mapped = mmap_path(path)
+    tensors = list(module.state_dict().values())
+    if not is_current(mapped, path) or any(t.device.type != 'cpu' for t in tensors):
+        return False
+    derived = derived_path(path, tag)
+    if not is_current(derived, mapped):
+        try:
+            save_atomic(module.state_dict(), derived)
+        except OSError as e:
+            print('{} not written ({}), the derived weights stay private'.format(derived, e))
+            return False
+    try:
+        state_dict = torch.load(derived, map_location='cpu', mmap=True)
+        module.load_state_dict(state_dict, assign=True)
+    except Exception as e:
+        print('{} not loaded ({}), the derived weights stay private'.format(derived, e))
+        return False
+    return True
+
+
+def mapped_regions():
+    ''' (start, end) address ranges of the checkpoint files mapped into this process (Linux) '''
+    regions = []
+    try:
+        with open('/proc/self/maps') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 6 and fields[-1].endswith('.pt'):
+                    start, end = fields[0].split('-')
+                    regions.append((int(start, 16), int(end, 16)))
+    except OSError:
+        pass
+    return regions
+
+
+def mapped_bytes(module, regions=None):
+    ''' (bytes of the weights of module in mapped checkpoint files, bytes of all its weights) '''
+    regions = mapped_regions() if regions is None else regions
+    mapped = total = 0
+    seen = set()
+    for t in list(module.parameters()) + list(module.buffers()):
+        if t.data_ptr() in seen or t.numel() == 0:
+            continue
+        seen.add(t.data_ptr())
+        n = t.numel() * t.element_size()
+        total += n
+        if any(start <= t.data_ptr() < end for start, end in regions):
+            mapped += n
+    return mapped, total
+
+
+def sharing_report(modules):
+    ''' one line on which part of the weights of the {name: module} are shared '''
+    regions = mapped_regions()
+    parts = []
+    for name, module in modules.items():
+        if not isinstance(module, torch.nn.Module):
+            continue
+        mapped, total = mapped_bytes(module, regions)
+        parts.append('{} {:.0f}% of {:.1f} MB'.format(name, 100 * mapped / max(total, 1), total / 2 ** 20))
+    return 'memory mapped (shared) weights: ' + ', '.join(parts)
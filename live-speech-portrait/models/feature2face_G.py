@@ -33,6 +33,33 @@ class Feature2Face_G(nn.Module):
                       
         return fake_pred
 
+
+    def inference(self, feature_map, cand_image):
+        ''' forward of cat([feature_map, cand_image]), with the candidate images'
+        part of the first layer cached across frames.
+        '''
+        if self.opt.fp16:
+            with autocast():
+                fake_pred = self.netG.forward_cached(feature_map, cand_image)
+        else:
+            fake_pred = self.netG.forward_cached(feature_map, cand_image)
+
+        return fake_pred
+
+
+    def inference_crop(self, feature_map, cand_image, y0, x0):
+        ''' inference() of the feature_map crop at (y0, x0) of the frame cand_image
+        (full size) belongs to, see CandidateCacheMixin.forward_crop.
+        '''
+        cand_response = self.netG.candidate_response(cand_image)
+        if self.opt.fp16:
+            with autocast():
+                fake_pred = self.netG.forward_crop(feature_map, cand_response, y0, x0)
+        else:
+            fake_pred = self.netG.forward_crop(feature_map, cand_response, y0, x0)
+
+        return fake_pred
+
     
 
 
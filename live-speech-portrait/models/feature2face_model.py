@@ -7,6 +7,7 @@ from torch.cuda.amp import autocast as autocast
 
 from . import networks
 from . import feature2face_G
+from .checkpoints import map_derived
 from .base_model import BaseModel
 from .losses import GANLoss, MaskedL1Loss, VGGLoss
 
@@ -222,9 +223,50 @@ class Feature2FaceModel(BaseModel):
             self.scaler.update()
             
 
+    def optimize_for_inference(self, channels_last=False):
+        """ fold BatchNorm into the generator convs, drop dropout, optionally channels_last,
+        checked against the original generator on a random input """
+        G = getattr(self.Feature2Face_G, 'module', self.Feature2Face_G)
+        first_conv = G.netG.model.model[0]
+        example_input = torch.randn(1, first_conv.in_channels, 256, 256, device=first_conv.weight.device)
+        G.netG = networks.optimize_for_inference(G.netG, example_input, channels_last=channels_last)
+        self.channels_last = channels_last
+        # the folded weights are new tensors, map them like the checkpoint they come from
+        path = getattr(self, 'mapped_checkpoints', {}).get('Feature2Face_G')
+        if path is not None:
+            map_derived(G.netG, path, 'fold_bn_channels_last' if channels_last else 'fold_bn')
+
+
+    def load_quantized(self, path):
+        """ replace the generator by the int8 one written by quantize_renderer.py (CPU) """
+        G = getattr(self.Feature2Face_G, 'module', self.Feature2Face_G)
+        body = torch.jit.load(path, map_location='cpu')
+        G.netG = networks.QuantizedFeature2FaceGenerator(G.netG.first_conv(), body).eval()
+        self.channels_last = False
+
+
+    def inference_crop(self, feature_map, cand_image, y0, x0):
+        """ inference of the feature_map crop at (y0, x0) of a full frame, cand_image
+        full size; the crop size is a multiple of 2 ** n_downsample_G (see util.roi_renderer)
+        """
+        with torch.no_grad():
+            if getattr(self, 'channels_last', False):
+                feature_map = feature_map.contiguous(memory_format=torch.channels_last)
+            net = getattr(self.Feature2Face_G, 'module', self.Feature2Face_G)
+            return net.inference_crop(feature_map, cand_image, y0, x0)
+
     def inference(self, feature_map, cand_image):
         """ inference process """
         with torch.no_grad():      
+            if getattr(self, 'channels_last', False):
+                feature_map = feature_map.contiguous(memory_format=torch.channels_last)
+            if cand_image is not None and not self.Feature2Face_G.training:
+                # the candidate images are the same every frame, skip their part of the first layer;
+                # the cache is keyed on cand_image itself, it is converted on a cache miss only
+                net = getattr(self.Feature2Face_G, 'module', self.Feature2Face_G)
+                return net.inference(feature_map, cand_image)
+            if cand_image is not None and getattr(self, 'channels_last', False):
+                cand_image = cand_image.contiguous(memory_format=torch.channels_last)
             if cand_image == None:
                 input_feature_maps = feature_map
             else:
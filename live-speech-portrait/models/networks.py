@@ -1,4 +1,5 @@
 import os
+import copy
 import numpy as np
 import torch
 import torch.nn as nn
@@ -9,7 +10,7 @@ import functools
 
 
 from torch.nn.parallel import DistributedDataParallel as DDP
-from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence
+from torch.nn.utils.rnn import pad_packed_sequence, pack_padded_sequence, pack_sequence
 
 
 
@@ -47,26 +48,78 @@ class APC_encoder(nn.Module):
         '''
         with torch.no_grad():
             seq_len = inputs.size(1)
-            packed_rnn_inputs = pack_padded_sequence(inputs, lengths, True)
-        
+            packed_rnn_outputs = self.forward_packed(pack_padded_sequence(inputs, lengths, True))
+            rnn_outputs, _ = pad_packed_sequence(packed_rnn_outputs, True, total_length=seq_len)
+            # outputs: (batch_size, seq_len, rnn_hidden_size)
+
+        return rnn_outputs
+
+
+    def forward_packed(self, packed_rnn_inputs):
+        '''
+        forward() of a PackedSequence, the sequences stay packed between the layers:
+        the residual connections add the packed data of the layer inputs & outputs,
+        which line up as both have the same batch_sizes.
+        '''
+        with torch.no_grad():
             for i, layer in enumerate(self.rnns):
                 packed_rnn_outputs, _ = layer(packed_rnn_inputs)
-                
-                rnn_outputs, _ = pad_packed_sequence(
-                        packed_rnn_outputs, True, total_length=seq_len)
-                # outputs: (batch_size, seq_len, rnn_hidden_size)
-                
                 if i + 1 < len(self.rnns):
-                    rnn_inputs, _ = pad_packed_sequence(
-                            packed_rnn_inputs, True, total_length=seq_len)
-                    # rnn_inputs: (batch_size, seq_len, rnn_hidden_size)
+                    if self.rnn_residual and packed_rnn_inputs.data.size(-1) == packed_rnn_outputs.data.size(-1):
+                        # Residual connections
+                        packed_rnn_outputs = packed_rnn_outputs._replace(
+                                data=packed_rnn_outputs.data + packed_rnn_inputs.data)
+                    packed_rnn_inputs = packed_rnn_outputs
+
+        return packed_rnn_outputs
+
+
+    def forward_batch(self, mels):
+        '''
+        forward() of several sequences of different lengths at once, e.g. of
+        concurrent requests: they are sorted & packed, every layer is one GRU call
+        over all of them, and the outputs are split back per sequence.
+        input:
+            mels: list of (seq_len_i, mel_dim) tensors
+        return:
+            list of (seq_len_i, rnn_hidden_size) tensors, in the order of mels
+        '''
+        if len(mels) == 0:
+            return []
+        with torch.no_grad():
+            packed_rnn_outputs = self.forward_packed(pack_sequence(list(mels), enforce_sorted=False))
+            rnn_outputs, lengths = pad_packed_sequence(packed_rnn_outputs, True)
+
+        return [rnn_outputs[i, :length] for i, length in enumerate(lengths.tolist())]
+
+
+    def forward_stream(self, inputs, hiddens=None):
+        '''
+        causal forward over the next chunk of one sequence, the GRU states are
+        carried across chunks so that chunked calls give the same features as
+        a single forward() over the whole sequence.
+        input:
+            inputs: (batch_size, chunk_len, mel_dim)
+            hiddens: per-layer GRU states returned by the previous call, or None
+        return:
+            rnn_outputs: (batch_size, chunk_len, rnn_hidden_size)
+            hiddens: per-layer GRU states for the next call
+        '''
+        with torch.no_grad():
+            if hiddens is None:
+                hiddens = [None] * len(self.rnns)
+            new_hiddens = []
+            rnn_inputs = inputs
+            for i, layer in enumerate(self.rnns):
+                rnn_outputs, hidden = layer(rnn_inputs, hiddens[i])
+                new_hiddens.append(hidden)
+                if i + 1 < len(self.rnns):
                     if self.rnn_residual and rnn_inputs.size(-1) == rnn_outputs.size(-1):
                         # Residual connections
                         rnn_outputs = rnn_outputs + rnn_inputs
-                    packed_rnn_inputs = pack_padded_sequence(rnn_outputs, lengths, True)
-        
-        
-        return rnn_outputs
+                    rnn_inputs = rnn_outputs
+
+        return rnn_outputs, new_hiddens
 
 
 
@@ -183,11 +236,21 @@ class WaveNet(nn.Module):
         s = sum([np.prod(list(d.size())) for d in par])
         return s
     
-    def forward(self, input, cond=None):
+    def cond_projection(self, cond):
+        ''' condition convolutions of every residual block, see residual_block.cond_projection
+        Args:
+            cond: [b, nfeature, T]
+        Returns:
+            cond_proj: [nblocks, b, 2 * dilation_channels, T]
+        '''
+        return torch.stack([block.cond_projection(cond) for block in self.residual_blocks])
+    
+    def forward(self, input, cond=None, cond_proj=None):
         '''
         Args:
             input: [b, ndim, T]
             cond: [b, nfeature, T]
+            cond_proj: optional cond_projection() output for the same T steps, replaces cond
         Returns:
             res: [b, T, ndim]
         '''
@@ -198,10 +261,19 @@ class WaveNet(nn.Module):
         x = self.activation(self.start_conv1(x))
         x = self.activation(self.start_conv2(x))
         skip = 0
-#        for i in range(self.blocks * self.layers):
-        for i, dilation_block in enumerate(self.residual_blocks):
-            x, current_skip = self.residual_blocks[i](x, cond)
-            skip += current_skip
+        if self.residual_blocks[0]._use_fused():
+            # one left zero-padded buffer for the whole stack, updated in place by
+            # every block, see residual_block.forward_buffer
+            offset = max(block.padding[0] for block in self.residual_blocks)
+            buffer = x.new_zeros(x.shape[0], x.shape[1], offset + x.shape[2])
+            buffer[:, :, offset:] = x
+            for i, block in enumerate(self.residual_blocks):
+                skip += block.forward_buffer(buffer, offset, cond, None if cond_proj is None else cond_proj[i])
+        else:
+#            for i in range(self.blocks * self.layers):
+            for i, dilation_block in enumerate(self.residual_blocks):
+                x, current_skip = self.residual_blocks[i](x, cond, None if cond_proj is None else cond_proj[i])
+                skip += current_skip
         
         # postprocess
         res = self.end_conv_1(self.activation(skip))
@@ -296,9 +368,93 @@ class residual_block(nn.Module):
                                    bias = True)
         
     
-    def forward(self, input, cond=None):
-        if self.cond is True and cond is None:
+    def cond_projection(self, cond):
+        ''' the 1x1 condition convolutions. They work per time step, so they can be
+        computed once for a whole sequence and sliced, instead of once per window.
+        Returns:
+            [b, 2 * dilation_channels, T], filter part first
+        '''
+        if self._use_fused():
+            weights = self.fused_weights()
+            return F.conv1d(cond, weights['cond_weight'], weights['cond_bias'])
+        return torch.cat([self.cond_filter_conv(cond), self.cond_gate_conv(cond)], dim=1)
+    
+    def _use_fused(self):
+        # eval mode under torch.no_grad(), as every inference path runs: the fused
+        # weights are detached copies and forward_buffer works in place, with
+        # autograd on the unfused path keeps the gradients of the weights
+        return not self.training and not torch.is_grad_enabled()
+    
+    def fused_weights(self):
+        ''' weights of the inference path: filter & gate dilated convs as one conv,
+        both condition convs as one conv, residual & skip 1x1 convs as one conv.
+        Built on first use after eval(), dropped by train(), .to() & co and
+        load_state_dict().
+        '''
+        if getattr(self, '_fused', None) is None:
+            with torch.no_grad():
+                weights = {'weight': torch.cat([self.filter_conv.weight, self.gate_conv.weight], dim=0),
+                           'bias': _cat_bias(self.filter_conv, self.gate_conv),
+                           'out_weight': torch.cat([self.residual_conv.weight, self.skip_conv.weight], dim=0),
+                           'out_bias': _cat_bias(self.residual_conv, self.skip_conv)}
+                if self.cond == True:
+                    weights['cond_weight'] = torch.cat([self.cond_filter_conv.weight, self.cond_gate_conv.weight], dim=0)
+                    weights['cond_bias'] = _cat_bias(self.cond_filter_conv, self.cond_gate_conv)
+            self._fused = weights
+        return self._fused
+    
+    def train(self, mode=True):
+        self._fused = None
+        return super(residual_block, self).train(mode)
+    
+    def _apply(self, fn, *args, **kwargs):
+        self._fused = None
+        return super(residual_block, self)._apply(fn, *args, **kwargs)
+    
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._fused = None
+        return super(residual_block, self)._load_from_state_dict(*args, **kwargs)
+    
+    def forward_buffer(self, buffer, offset, cond=None, cond_proj=None):
+        ''' fused forward without F.pad, 3 instead of 6 convolutions.
+        Args:
+            buffer: [b, residual_channels, offset + T], the input in its last T steps
+                and at least padding[0] zeros before them
+        Returns:
+            skip: [b, skip_channels, T]; the input steps of buffer are replaced
+            in place by the residual output
+        '''
+        weights = self.fused_weights()
+        x = F.conv1d(buffer[:, :, offset - self.padding[0]:], weights['weight'], weights['bias'], dilation=self.dilation)
+        filter, gate = x.chunk(2, dim=1)
+        
+        if self.cond == True and (cond is not None or cond_proj is not None):
+            filter_cond, gate_cond = (cond_proj if cond_proj is not None else self.cond_projection(cond)).chunk(2, dim=1)
+            filter = filter + filter_cond
+            gate = gate + gate_cond
+        
+        x = torch.tanh(filter) * torch.sigmoid(gate)
+        
+        out = F.conv1d(x, weights['out_weight'], weights['out_bias'])
+        buffer[:, :, offset:] += out[:, :self.residual_channels]
+        
+        return out[:, self.residual_channels:]
+    
+    def forward_fused(self, input, cond=None, cond_proj=None):
+        ''' same result as the unfused forward, through forward_buffer() on a buffer
+        of this block only; WaveNet shares one over the stack. '''
+        offset = self.padding[0]
+        buffer = input.new_zeros(input.shape[0], input.shape[1], offset + input.shape[2])
+        buffer[:, :, offset:] = input
+        skip = self.forward_buffer(buffer, offset, cond, cond_proj)
+        
+        return buffer[:, :, offset:], skip
+    
+    def forward(self, input, cond=None, cond_proj=None):
+        if self.cond is True and cond is None and cond_proj is None:
             raise RuntimeError("set using condition to true, but no cond tensor inputed")
+        if self._use_fused():
+            return self.forward_fused(input, cond, cond_proj)
             
         x_pad = F.pad(input, self.padding)
         # filter
@@ -306,9 +462,8 @@ class residual_block(nn.Module):
         # gate
         gate = self.gate_conv(x_pad)
         
-        if self.cond == True and cond is not None:
-            filter_cond = self.cond_filter_conv(cond)
-            gate_cond = self.cond_gate_conv(cond)
+        if self.cond == True and (cond is not None or cond_proj is not None):
+            filter_cond, gate_cond = (cond_proj if cond_proj is not None else self.cond_projection(cond)).chunk(2, dim=1)
             # add cond results
             filter = filter + filter_cond
             gate = gate + gate_cond
@@ -326,6 +481,16 @@ class residual_block(nn.Module):
         return residual, skip
 
 
+def _cat_bias(*convs):
+    ''' concatenated biases of convs stacked along the output channels, zeros for
+    convs without bias, None if none of them has one.
+    '''
+    if all(conv.bias is None for conv in convs):
+        return None
+    return torch.cat([conv.bias if conv.bias is not None else conv.weight.new_zeros(conv.out_channels)
+                      for conv in convs])
+
+
 
 
 ## 2D convolution layers
@@ -451,11 +616,213 @@ def print_network(net):
         num_params += param.numel()
     print(net)
     print('Total number of parameters: %d' % num_params)
+
+
+def fold_batchnorm(conv, bn):
+    ''' conv (Conv2d or ConvTranspose2d) followed by an eval mode BatchNorm2d as one conv with bias '''
+    fused = copy.deepcopy(conv)
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps) if bn.affine else 1 / torch.sqrt(bn.running_var + bn.eps)
+        shift = (bn.bias if bn.affine else 0) - bn.running_mean * scale
+        bias = conv.bias if conv.bias is not None else torch.zeros_like(bn.running_mean)
+        if isinstance(conv, nn.ConvTranspose2d):
+            # weight: [in, out / groups, kh, kw]
+            groups = conv.groups
+            weight = conv.weight.reshape(groups, -1, *conv.weight.shape[1:])
+            weight = weight * scale.reshape(groups, 1, -1, 1, 1)
+            fused.weight = nn.Parameter(weight.reshape(conv.weight.shape))
+        else:
+            # weight: [out, in / groups, kh, kw]
+            fused.weight = nn.Parameter(conv.weight * scale.reshape(-1, 1, 1, 1))
+        fused.bias = nn.Parameter(bias * scale + shift)
+    return fused
+
+
+def _foldable(conv, bn):
+    return (isinstance(conv, (nn.Conv2d, nn.ConvTranspose2d)) and isinstance(bn, nn.BatchNorm2d)
+            and bn.track_running_stats and bn.running_mean is not None)
+
+
+def _optimize_module(module):
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Dropout, nn.Dropout2d, nn.Dropout3d)):
+            setattr(module, name, nn.Identity())
+        else:
+            _optimize_module(child)
+    if isinstance(module, nn.Sequential):
+        layers = []
+        for layer in module:
+            if isinstance(layer, nn.Identity):
+                continue
+            if layers and _foldable(layers[-1], layer):
+                layers[-1] = fold_batchnorm(layers[-1], layer)
+            else:
+                layers.append(layer)
+        # keep the container (and its index 0, see CandidateCacheMixin), only refill it
+        for name in list(module._modules):
+            del module._modules[name]
+        for i, layer in enumerate(layers):
+            module.add_module(str(i), layer)
+
+
+def quantize_dynamic_int8(net):
+    ''' copy of net with int8 weights in its GRU / LSTM / Linear layers, activations
+    are quantized on the fly. CPU only; convolutions stay fp32.
+    '''
+    net = getattr(net, 'module', net)
+    return torch.quantization.quantize_dynamic(copy.deepcopy(net).cpu().eval(), {nn.GRU, nn.LSTM, nn.Linear},
+                                               dtype=torch.qint8)
+
+
+def optimize_for_inference(net, example_input=None, channels_last=False, atol=1e-3):
+    ''' eval-mode copy of net for faster inference:
+        - BatchNorm2d folded into the preceding Conv2d / ConvTranspose2d of a Sequential
+        - dropout layers replaced by / Identity layers removed from Sequentials
+        - optionally channels_last memory format (inputs should then be channels_last too)
+    If example_input is given, the outputs of the copy and of net are compared and
+    a RuntimeError is raised when they differ by more than atol (relative to the
+    output range). net itself is not modified.
+    '''
+    optimized = copy.deepcopy(net).eval()
+    _optimize_module(optimized)
+    if channels_last:
+        optimized = optimized.to(memory_format=torch.channels_last)
+    for param in optimized.parameters():
+        param.requires_grad_(False)
+
+    if example_input is not None:
+        training = net.training
+        net.eval()
+        with torch.no_grad():
+            ref = net(example_input)
+            out = optimized(example_input.contiguous(memory_format=torch.channels_last) if channels_last else example_input)
+        net.train(training)
+        diff = (out.float() - ref.float()).abs().max().item() / max(1.0, ref.float().abs().max().item())
+        if diff > atol:
+            raise RuntimeError('optimized network differs from the original by %g (atol %g)' % (diff, atol))
+    return optimized
     
 
 
         
-class Feature2FaceGenerator_normal(nn.Module):
+class CandidateCacheMixin(object):
+    ''' The candidate images are the last input channels of the generators and the
+    same for every frame of a talking head. The first layer is a convolution
+    (linear, zero padded), so their part of it can be computed once:
+        conv(cat([feature_map, cand])) = conv_feature(feature_map) + conv_cand(cand)
+    forward_cached() only convolves the feature map channels and adds the cached
+    candidate response. Needs an outermost block whose Sequential starts with the conv.
+    '''
+    tanh_output = False
+
+    def first_conv(self):
+        return self.model.model[0]
+
+    def candidate_response(self, cand_image):
+        ''' conv_cand(cand), cached until cand_image or the conv weights change '''
+        conv = self.first_conv()
+        key = (id(cand_image), cand_image._version, cand_image.device, conv.weight.data_ptr(), conv.weight._version)
+        if getattr(self, '_cand_key', None) != key:
+            n_cand = cand_image.shape[1]
+            source = cand_image
+            if conv.weight.is_contiguous(memory_format=torch.channels_last):
+                cand_image = cand_image.contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                self._cand_response = F.conv2d(cand_image, conv.weight[:, -n_cand:], None,
+                                               conv.stride, conv.padding, conv.dilation)
+            # keep the tensor alive, so that its id is not reused by another one
+            self._cand_source, self._cand_key = source, key
+        return self._cand_response
+
+    def forward_cached(self, feature_map, cand_image):
+        ''' same as forward(torch.cat([feature_map, cand_image], dim=1)), inference only '''
+        return self.forward_response(feature_map, self.candidate_response(cand_image))
+
+    def first_layer(self, feature_map, cand_response):
+        ''' output of the first conv, from the feature map and the candidate_response() '''
+        conv = self.first_conv()
+        x = F.conv2d(feature_map, conv.weight[:, :feature_map.shape[1]], conv.bias,
+                     conv.stride, conv.padding, conv.dilation)
+        return x + cand_response.to(x.dtype)
+
+    def forward_crop(self, feature_map, cand_response, y0, x0):
+        ''' forward_response() of the crop at (y0, x0) of a full frame, cand_response of
+        that frame: the candidate part of the first layer is cropped to match.
+        y0, x0 and the crop size are multiples of the first conv's stride.
+        '''
+        stride = self.first_conv().stride
+        h, w = feature_map.shape[-2:]
+        cand_response = cand_response[..., y0 // stride[0]: (y0 + h) // stride[0], x0 // stride[1]: (x0 + w) // stride[1]]
+        return self.forward_response(feature_map, cand_response)
+
+    def forward_response(self, feature_map, cand_response):
+        ''' forward_cached() with the candidate_response() given '''
+        x = self.first_layer(feature_map, cand_response)
+        for layer in list(self.model.model)[1:]:
+            x = layer(x)
+        if self.tanh_output:
+            x = torch.tanh(x)   # scale to [-1, 1]
+
+        return x
+
+
+
+class Feature2FaceGeneratorBody(nn.Module):
+    ''' everything of a CandidateCacheMixin generator after its first conv, the
+    part that static quantization converts to int8.
+    '''
+    def __init__(self, netG):
+        super(Feature2FaceGeneratorBody, self).__init__()
+        self.layers = nn.Sequential(*list(netG.model.model)[1:])
+        self.tanh_output = netG.tanh_output
+
+    def forward(self, x):
+        x = self.layers(x)
+        if self.tanh_output:
+            x = torch.tanh(x)   # scale to [-1, 1]
+        return x
+
+
+class QuantizedFeature2FaceGenerator(CandidateCacheMixin, nn.Module):
+    ''' fp32 first conv (so that the candidate response stays cached) followed
+    by a quantized Feature2FaceGeneratorBody, e.g. loaded with torch.jit.load.
+    '''
+    def __init__(self, first_conv, body):
+        super(QuantizedFeature2FaceGenerator, self).__init__()
+        self.conv = first_conv
+        self.body = body
+
+    def first_conv(self):
+        return self.conv
+
+    def forward(self, input):
+        return self.body(self.conv(input))
+
+    def forward_response(self, feature_map, cand_response):
+        return self.body(self.first_layer(feature_map, cand_response))
+
+
+def quantize_static_int8(net, example_input, calibrate):
+    ''' post-training static int8 quantization (FX graph mode, CPU) of net.
+    calibrate(prepared) runs representative inputs through the observed model.
+    Returns a frozen TorchScript module.
+    '''
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+    net = copy.deepcopy(net).cpu().eval()
+    qconfig_mapping = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(net, qconfig_mapping, example_inputs=(example_input,))
+    with torch.no_grad():
+        calibrate(prepared)
+        quantized = convert_fx(prepared)
+        return torch.jit.freeze(torch.jit.trace(quantized, (example_input,)))
+
+
+
+class Feature2FaceGenerator_normal(CandidateCacheMixin, nn.Module):
+    tanh_output = True
+
     def __init__(self, input_nc=4, output_nc=3, num_downs=8, ngf=64, norm_layer=nn.BatchNorm2d, use_dropout=False):
         super(Feature2FaceGenerator_normal, self).__init__()
         # construct unet structure
@@ -551,7 +918,9 @@ class ResUnetSkipConnectionBlock_small(nn.Module):
 
    
 
-class Feature2FaceGenerator_large(nn.Module):
+class Feature2FaceGenerator_large(CandidateCacheMixin, nn.Module):
+    tanh_output = True
+
     def __init__(self, input_nc=4, output_nc=3, num_downs=8, ngf=64, norm_layer=nn.BatchNorm2d, use_dropout=False):
         super(Feature2FaceGenerator_large, self).__init__()
         # construct unet structure
@@ -677,7 +1046,7 @@ class ResidualBlock(nn.Module):
 
 
 
-class Feature2FaceGenerator_Unet(nn.Module):
+class Feature2FaceGenerator_Unet(CandidateCacheMixin, nn.Module):
     def __init__(self, input_nc=4, output_nc=3, num_downs=8, ngf=64, norm_layer=nn.BatchNorm2d, use_dropout=False):
         super(Feature2FaceGenerator_Unet, self).__init__()
         
@@ -0,0 +1,92 @@
+"""Post-training static int8 quantization of the Feature2Face generator of one
+talking head (CPU). The activation ranges are calibrated on feature maps drawn
+from the avatar's own tracked landmarks and headposes; the first conv stays
+fp32 so that the candidate images' response is still computed once.
+Writes Feature2Face_int8.pt next to Feature2Face.pkl and reports PSNR / SSIM
+against the fp32 generator on held-out tracked frames. Use it with
+inference_params: profile: 'int8' in the talking head yaml.
+
+    python quantize_renderer.py --id May --calib_frames 300 --eval_frames 50
+"""
+import time
+import argparse
+
+import numpy as np
+import torch
+from tqdm import tqdm
+from skimage.metrics import peak_signal_noise_ratio, structural_similarity
+
+from streaming import Avatar
+from models import backends
+from models import networks
+import util.util as util
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+def tracked_frames(av):
+    ''' tracked landmarks [n, 73, 3] and headposes [n, 6] of the training video '''
+    pts3d = np.load(av.config['dataset_params']['pts3d_path']).astype(np.float32)
+    fit_data = np.load(av.config['dataset_params']['fit_data_path'])
+    rot_angles = fit_data['rot_angles'].astype(np.float32)
+    rot_angles[rot_angles[:, 0] < 0, 0] += 360   # x around 180, as the predicted headposes
+    trans = fit_data['trans'][:, :, 0].astype(np.float32)
+    n = min(len(pts3d), len(rot_angles))
+    return pts3d[:n], np.concatenate([rot_angles[:n], trans[:n]], axis=1)
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id', default='May', help="person name, e.g. Obama1, Obama2, May, Nadella, McStay")
+    parser.add_argument('--calib_frames', type=int, default=300, help='tracked frames used for calibration')
+    parser.add_argument('--eval_frames', type=int, default=50, help='other tracked frames used for PSNR / SSIM')
+    opt = parser.parse_args()
+
+    av = Avatar(opt.id, 'cpu', profile='fp32')
+    G = getattr(av.Feature2Face.Feature2Face_G, 'module', av.Feature2Face.Feature2Face_G)
+    netG = G.netG
+    cand_response = netG.candidate_response(av.img_candidates)
+
+    pts3d, headposes = tracked_frames(av)
+    calib_index = np.unique(np.linspace(0, len(pts3d) - 1, opt.calib_frames).astype(np.int64))
+    rest = np.setdiff1d(np.arange(len(pts3d)), calib_index)
+    eval_index = rest[np.linspace(0, len(rest) - 1, min(opt.eval_frames, len(rest))).astype(np.int64)]
+
+    def first_layer(k):
+        feature_map = av.draw(*av.project(pts3d[k], headposes[k])).unsqueeze(0)
+        with torch.no_grad():
+            return feature_map, netG.first_layer(feature_map, cand_response)
+
+    def calibrate(prepared):
+        for k in tqdm(calib_index, desc='calibration'):
+            prepared(first_layer(k)[1])
+
+    body = networks.Feature2FaceGeneratorBody(netG)
+    quantized = networks.quantize_static_int8(body, first_layer(calib_index[0])[1], calibrate)
+    path = backends.quantized_renderer_path(av.config)
+    quantized.save(path)
+    print('saved {}'.format(path))
+
+    # evaluate the saved checkpoint the way the int8 profile loads it
+    netG_int8 = networks.QuantizedFeature2FaceGenerator(netG.first_conv(), torch.jit.load(path)).eval()
+    psnr, ssim, t_fp32, t_int8 = [], [], 0.0, 0.0
+    with torch.no_grad():
+        for k in tqdm(eval_index, desc='evaluation'):
+            feature_map, _ = first_layer(k)
+            st = time.time()
+            ref = netG.forward_response(feature_map, cand_response)
+            t_fp32 += time.time() - st
+            st = time.time()
+            out = netG_int8.forward_response(feature_map, cand_response)
+            t_int8 += time.time() - st
+            ref, out = util.tensor2im(ref[0]), util.tensor2im(out[0])
+            psnr.append(peak_signal_noise_ratio(ref, out, data_range=255))
+            ssim.append(structural_similarity(ref, out, channel_axis=2, data_range=255))
+
+    n = max(len(eval_index), 1)
+    print('int8 vs fp32 on {} frames: PSNR mean {:.2f} dB (min {:.2f}), SSIM mean {:.4f} (min {:.4f})'.format(
+        len(eval_index), np.mean(psnr), np.min(psnr), np.mean(ssim), np.min(ssim)))
+    print('generator per frame: fp32 {:.1f} ms, int8 {:.1f} ms ({:.2f}x)'.format(
+        1000 * t_fp32 / n, 1000 * t_int8 / n, t_fp32 / max(t_int8, 1e-9)))
@@ -0,0 +1,626 @@
+import os
+import subprocess
+import time
+import copy
+import threading
+from collections import namedtuple, OrderedDict
+from os.path import join
+
+import numpy as np
+import torch
+import librosa
+import cv2
+import argparse
+import yaml
+import soundfile as sf  # modern audio writer
+
+from options.test_audio2feature_options import TestOptions as FeatureOptions
+from options.test_audio2headpose_options import TestOptions as HeadposeOptions
+from options.test_feature2face_options import TestOptions as RenderOptions
+
+from datasets import create_dataset
+from models import create_model
+from models.networks import APC_encoder
+from models import backends
+from models.checkpoints import load_checkpoint, sharing_report
+import util.util as util
+from util.quality_scheduler import QualityScheduler
+from util.frame_cache import FrameCache, renderer_namespace
+from util.roi_renderer import ROIRenderer
+from util.render_scheduler import RenderScheduler
+from util.motion_matching import MotionMatchingHeadpose
+from util import avatar_bundle
+from funcs import utils
+from funcs import audio_funcs
+
+import warnings
+warnings.filterwarnings("ignore")
+
+
+# one rendered frame; landmarks / shoulders are the projected 2d points it was drawn from
+StreamFrame = namedtuple('StreamFrame', ['index', 'image', 'feature_map', 'landmarks', 'shoulders'])
+
+mouth_indices = np.concatenate([np.arange(4, 11), np.arange(46, 64)])
+eye_brow_indices = np.array([27, 65, 28, 68, 29, 67, 30, 66, 31, 72, 32, 69, 33, 70, 34, 71], np.int32)
+# Feature2Face generator sizes, best quality first
+generator_sizes = ['large', 'normal', 'small']
+
+
+def generator(Feature2Face):
+    ''' the generator network of a Feature2FaceModel '''
+    G = Feature2Face.Feature2Face_G
+    return getattr(G, 'module', G).netG
+
+
+class Avatar(object):
+    ''' models, options and pre-defined data of one talking head, as set up by demo.py.
+    Loaded once and shared by every StreamingPipeline of that person.
+    fold_bn / channels_last: see Feature2FaceModel.optimize_for_inference
+    backend: torch | torchscript | onnx, the latter run the graphs written by export.py
+    profile: fp32 | dynamic_int8 | int8 for the torch backend, default from the yaml inference_params
+    renderers: the Feature2Face models by generator size, best first; besides Image2Image size it
+        holds the yaml Image2Image adaptive_sizes ({size: ckp_path}, torch backend only), among
+        which StreamingPipeline picks per frame to hold the frame rate
+    frame_cache: None, or a FrameCache of this avatar's renders shared by all its pipelines
+        (see enable_frame_cache)
+    '''
+    def __init__(self, name, device='cpu', config_root='./config/', data_root='./data/', fold_bn=True, channels_last=False,
+                 backend='torch', export_dir=None, profile=None):
+        self.name = name
+        self.device = torch.device(device)
+        with open(join(config_root, name + '.yaml')) as f:
+            config = yaml.load(f, Loader=yaml.SafeLoader)
+        self.config = config
+        data_root = join(data_root, name)
+        self.h, self.w, self.sr, self.FPS = 512, 512, 16000, 60
+
+        ############################ Pre-defined Data #############################
+        # the compiled avatar.bundle (build_avatar_bundle.py) if up to date, else derived from the data files
+        avatar_data, avatar_meta = avatar_bundle.load_avatar_data(config, data_root)
+        self.mean_pts3d = avatar_data['mean_pts3d']
+        self.mean_translation = avatar_data['mean_translation']
+        self.candidate_eye_brow = avatar_data['candidate_eye_brow']
+        self.std_mean_pts3d = avatar_data['std_mean_pts3d']
+        self.tracked_headposes = avatar_data['headposes']
+
+        # candidates images, normalized to [-1, 1]
+        self.img_candidates = torch.from_numpy(avatar_data['img_candidates']).to(self.device)
+
+        # shoulders
+        self.shoulder3D = avatar_data['shoulder3D']
+        self.ref_trans = avatar_data['ref_trans']
+
+        # camera matrix, we always use training set intrinsic parameters.
+        self.camera = utils.camera()
+        self.camera_intrinsic = avatar_data['camera_intrinsic']
+        self.APC_feat_database = avatar_data['APC_feat_database']
+        self.scale = avatar_meta['scale']
+        self.image_pad = avatar_meta['image_pad']
+
+        ########################### Experiment Settings ###########################
+        self.use_LLE = config['model_params']['APC']['use_LLE']
+        self.Knear = config['model_params']['APC']['Knear']
+        self.LLE_percent = config['model_params']['APC']['LLE_percent']
+        self.Feat_smooth_sigma = config['model_params']['Audio2Mouth']['smooth']
+        self.Head_smooth_sigma = config['model_params']['Headpose']['smooth']
+        self.AMP_method = config['model_params']['Audio2Mouth']['AMP'][0]
+        self.Feat_AMPs = config['model_params']['Audio2Mouth']['AMP'][1:]
+        self.rot_AMP, self.trans_AMP = config['model_params']['Headpose']['AMP']
+        self.shoulder_AMP = config['model_params']['Headpose']['shoulder_AMP']
+        self.headpose_engine = config['model_params']['Headpose'].get('engine', 'wavenet')
+        self.motion_matching = None
+        if self.headpose_engine == 'motion_matching':
+            self.motion_matching = MotionMatchingHeadpose(self.tracked_headposes)
+
+        self.Featopt = FeatureOptions().parse()
+        self.Headopt = HeadposeOptions().parse()
+        self.Renderopt = RenderOptions().parse()
+        self.Featopt.load_epoch = config['model_params']['Audio2Mouth']['ckp_path']
+        self.Headopt.load_epoch = config['model_params']['Headpose']['ckp_path']
+        self.Renderopt.dataroot = config['dataset_params']['root']
+        self.Renderopt.load_epoch = config['model_params']['Image2Image']['ckp_path']
+        self.Renderopt.size = config['model_params']['Image2Image']['size']
+        self.Renderopt.test_image_pad = self.image_pad
+        if self.device.type == 'cpu':
+            self.Featopt.gpu_ids = self.Headopt.gpu_ids = self.Renderopt.gpu_ids = []
+
+        ############################# Load Models #################################
+        print('---------- Loading Model: APC-------------')
+        self.APC_model = APC_encoder(config['model_params']['APC']['mel_dim'],
+                                     config['model_params']['APC']['hidden_size'],
+                                     config['model_params']['APC']['num_layers'],
+                                     config['model_params']['APC']['residual'])
+        apc_state, mapped = load_checkpoint(config['model_params']['APC']['ckp_path'], self.device)
+        self.APC_model.load_state_dict(apc_state, strict=False, assign=mapped)
+        self.APC_model.to(self.device).eval()
+
+        print('---------- Loading Model: {} -------------'.format(self.Featopt.task))
+        self.Audio2Feature = create_model(self.Featopt)
+        self.Audio2Feature.setup(self.Featopt)
+        self.Audio2Feature.eval()
+
+        print('---------- Loading Model: {} -------------'.format(self.Headopt.task))
+        self.Audio2Headpose = create_model(self.Headopt)
+        self.Audio2Headpose.setup(self.Headopt)
+        self.Audio2Headpose.eval()
+        if self.Headopt.feature_decoder == 'WaveNet':
+            net = getattr(self.Audio2Headpose.Audio2Headpose, 'module', self.Audio2Headpose.Audio2Headpose)
+            self.Headopt.A2H_receptive_field = net.WaveNet.receptive_field
+
+        print('---------- Loading Model: {} -------------'.format(self.Renderopt.task))
+        self.facedataset = create_dataset(self.Renderopt)
+        self.Feature2Face = create_model(self.Renderopt)
+        self.Feature2Face.setup(self.Renderopt)
+        self.Feature2Face.eval()
+        if fold_bn:
+            self.Feature2Face.optimize_for_inference(channels_last=channels_last)
+        self.renderers = OrderedDict([(self.Renderopt.size, self.Feature2Face)])
+        adaptive_sizes = config['model_params']['Image2Image'].get('adaptive_sizes') or {}
+        if adaptive_sizes and backend != 'torch':
+            print('adaptive_sizes ignored with the {} backend'.format(backend))
+        elif adaptive_sizes:
+            input_nc = generator(self.Feature2Face).first_conv().in_channels
+            for size in sorted(adaptive_sizes, key=generator_sizes.index):
+                if size in self.renderers:
+                    continue
+                print('---------- Loading Model: {} ({}) -------------'.format(self.Renderopt.task, size))
+                opt = copy.copy(self.Renderopt)
+                opt.size, opt.load_epoch = size, adaptive_sizes[size]
+                renderer = create_model(opt)
+                renderer.setup(opt)
+                renderer.eval()
+                if generator(renderer).first_conv().in_channels != input_nc:
+                    raise ValueError('Feature2Face size {} takes other inputs than size {}'.format(size, self.Renderopt.size))
+                if fold_bn:
+                    renderer.optimize_for_inference(channels_last=channels_last)
+                self.renderers[size] = renderer
+            self.renderers = OrderedDict(sorted(self.renderers.items(), key=lambda item: generator_sizes.index(item[0])))
+
+        self.render_mode = backend
+        self.frame_cache = None
+        if backend == 'torch':
+            self.profile = self.render_mode = profile or backends.config_profile(config)
+            print('---------- Inference profile: {} -------------'.format(self.profile))
+            self.APC_model = backends.apply_profile(self.profile, self.APC_model, self.Audio2Feature,
+                                                    self.Audio2Headpose, device=self.device,
+                                                    Feature2Face=self.Feature2Face, config=config)
+        else:
+            export_dir = export_dir or backends.default_export_dir(config)
+            print('---------- Backend: {} ({}) -------------'.format(backend, export_dir))
+            self.APC_model = backends.apply_backend(backend, export_dir, self.APC_model, self.Audio2Feature,
+                                                    self.Audio2Headpose, self.Feature2Face, device=self.device)
+        print(sharing_report(OrderedDict([('APC', self.APC_model), ('Audio2Mouth', self.Audio2Feature.Audio2Feature),
+                                          ('Headpose', self.Audio2Headpose.Audio2Headpose)] +
+                                         [('Image2Image {}'.format(size), renderer.Feature2Face_G)
+                                          for size, renderer in self.renderers.items()])))
+
+        self.Audio2Mel_torch = audio_funcs.Audio2Mel(n_fft=512, hop_length=int(16000/120), win_length=int(16000/60),
+                                                     sampling_rate=16000, n_mel_channels=80,
+                                                     mel_fmin=90, mel_fmax=7600.0).to(self.device)
+
+    def enable_frame_cache(self, step=1.0, capacity=1024, disk_dir=None, verify_every=0):
+        ''' see util.frame_cache.FrameCache '''
+        self.frame_cache = FrameCache(step, capacity, disk_dir, renderer_namespace(self.Renderopt, self.render_mode),
+                                      verify_every)
+        return self.frame_cache
+
+    def project(self, pts3d, headpose):
+        ''' 2d landmarks and shoulder points of one frame
+        Args:
+            pts3d: [73, 3] landmarks in the normalized space
+            headpose: [6+] rotation angles (x around 180) and translation
+        '''
+        landmarks, _, _ = utils.project_landmarks(self.camera_intrinsic, self.camera.relative_rotation,
+                                                  self.camera.relative_translation, self.scale, headpose, pts3d)
+        diff_trans = headpose[3:6] - self.ref_trans
+        shoulders3D = self.shoulder3D + diff_trans * self.shoulder_AMP
+        project = self.camera_intrinsic.dot(shoulders3D.T)
+        project[:2, :] /= project[2, :]  # divide z
+        shoulders = project[:2, :].T
+
+        return landmarks.astype(np.float32), shoulders.astype(np.float32)
+
+    def draw(self, landmarks, shoulders):
+        ''' feature_map: [input_nc, h, w] '''
+        return self.facedataset.dataset.get_data_test_mode(landmarks, shoulders.copy(), self.facedataset.dataset.image_pad)
+
+    def draw_batch(self, landmarks, shoulders):
+        ''' draw() of [N, 73, 2] landmarks and [N, 18, 2] shoulders at once -> [N, input_nc, h, w] '''
+        return self.facedataset.dataset.get_data_test_mode_batch(landmarks, shoulders, self.facedataset.dataset.image_pad)
+
+
+
+class StreamingPipeline(object):
+    ''' demo.py's inference as a stream: push() audio chunks (16 kHz mono) and
+    iterate the frames that became ready, flush() at the end of the utterance.
+
+    Every stage runs incrementally and only waits for the look-ahead it needs:
+        mel             one 1/60 s window
+        APC / LLE       none (causal GRU, per-frame projection)
+        Audio2Mouth     Featopt.frame_future frames (LSTM state carried over)
+        Audio2Headpose  Headopt.frame_future frames (autoregressive WaveNet), with the
+                        motion_matching engine one segment hop
+        smoothing       see below
+        drawing / Feature2Face  none
+    smoothing='gaussian' waits for the full gaussian radius (4 * sigma frames, 40
+    for the head translation) and, apart from the random headpose sampling and
+    solve_intersect_mouth() (which averages over the frames it is given), gives
+    the offline demo.py result. 'truncated' bounds the look-ahead (`lookahead`
+    frames, default 2 * sigma), 'one_euro' and 'critically_damped' need none;
+    see utils.make_smoother(). The causal methods lag fast motion too much for the
+    lips and apply to the headpose only, the mouth then uses 'truncated'.
+    output_fps: frame rate of the StreamFrames (default avatar.FPS), the landmarks and
+    headposes are resampled from the 60 fps audio models before drawing.
+    With several avatar.renderers and adaptive_quality, every frame is rendered with the
+    generator size of a QualityScheduler fed with the measured render latency.
+    roi: None, or the keyword arguments of the util.roi_renderer.ROIRenderer (one per
+    generator size) that renders only a crop around the mouth while the head stays put.
+    scheduler: None, or a util.render_scheduler.RenderScheduler shared by concurrent
+    pipelines (one thread each), which renders their frames in batches ordered by
+    playback deadline; session names the pipeline in its report. The roi crops are
+    rendered by the pipeline itself.
+    One pipeline per utterance; the Avatar models are shared.
+    '''
+    def __init__(self, avatar, sigma_scale=0.3, pre_headpose=None, smoothing='gaussian', lookahead=None,
+                 adaptive_quality=True, output_fps=None, roi=None, scheduler=None, session=None):
+        self.avatar = avatar
+        self.output_fps = output_fps or avatar.FPS
+        self.resampler = None
+        if self.output_fps != avatar.FPS:
+            self.resampler = utils.FrameResampler(avatar.FPS, self.output_fps)
+        self.quality = None
+        if adaptive_quality and len(avatar.renderers) > 1:
+            self.quality = QualityScheduler(list(avatar.renderers), fps=self.output_fps)
+        self.roi = roi
+        self.roi_renderers = OrderedDict()
+        self.roi_tier = None
+        self.render_session = None
+        if scheduler is not None:
+            self.render_session = scheduler.session(session, fps=self.output_fps)
+        self.sigma_scale = sigma_scale
+        av = avatar
+        # set history headposes as zero
+        if pre_headpose is None:
+            pre_headpose = np.zeros(av.Headopt.A2H_wavenet_input_channels, np.float32)
+
+        # mel framing as utils.compute_mel_one_sequence
+        self.mel_frame_len = int(av.sr * (1 / 60))
+        self.mel_frame_step = av.sr * (0.5 / 60)
+        self.audio = np.zeros(0, np.float32)
+        self.audio_offset = 0   # sample index of self.audio[0]
+        self.n_samples = 0
+        self.mel_next = 0
+
+        self.apc_hidden = None
+        self.feat_state = av.Audio2Feature.init_stream()
+        if av.motion_matching is not None:
+            self.head_state = av.motion_matching.init_stream()
+        else:
+            self.head_state = av.Audio2Headpose.init_stream(pre_headpose, opt=av.Headopt)
+
+        self.mouth_raw = np.zeros([0, 25 * 3])   # predicted, waiting for their headpose
+        self.n_mouth = 0                         # mouth frames handed to the smoother
+        self.n_head = 0
+        mouth_smoothing = smoothing if smoothing in ('gaussian', 'truncated') else 'truncated'
+        self.mouth_smoother = utils.make_smoother(mouth_smoothing, av.Feat_smooth_sigma, lookahead, av.FPS)
+        self.rot_smoother = utils.make_smoother(smoothing, av.Head_smooth_sigma[0], lookahead, av.FPS)
+        self.trans_smoother = utils.make_smoother(smoothing, av.Head_smooth_sigma[1], lookahead, av.FPS)
+        self.mouth_ready = np.zeros([0, 73, 3])
+        self.rot_ready = np.zeros([0, 3])
+        self.trans_ready = np.zeros([0, 3])
+        self.prev_mouth = None   # last frame before AMP, for the 'delta' method
+        self.n_frames = 0        # frames handed out so far
+        self.finished = False
+
+    def push(self, audio_chunk):
+        ''' audio_chunk: [n,] float waveform. Yields the StreamFrames that became ready. '''
+        for frame in self.render_frames(self.process(audio_chunk)):
+            yield frame
+
+    def flush(self):
+        ''' end of the utterance, yields the remaining StreamFrames. '''
+        for frame in self.render_frames(self.process(None, final=True)):
+            yield frame
+
+    def render_frames(self, frames):
+        # the feature maps of all frames that became ready are drawn in one batch
+        if len(frames) == 0:
+            return
+        feature_maps = self.avatar.draw_batch(np.stack([landmarks for _, landmarks, _ in frames]),
+                                              np.stack([shoulders for _, _, shoulders in frames]))
+        for (index, landmarks, shoulders), feature_map in zip(frames, feature_maps):
+            yield self.render(index, landmarks, shoulders, feature_map)
+
+    def stream(self, audio_chunks):
+        for chunk in audio_chunks:
+            yield from self.push(chunk)
+        yield from self.flush()
+
+    ############################## Stages ##################################
+    def process(self, audio_chunk, final=False):
+        ''' everything up to the 2d landmarks; returns [(index, landmarks, shoulders)] '''
+        assert not self.finished, 'flush() was already called'
+        if audio_chunk is not None and len(audio_chunk):
+            audio_chunk = np.asarray(audio_chunk, np.float32)
+            self.audio = np.concatenate([self.audio, audio_chunk])
+            self.n_samples += len(audio_chunk)
+        self.finished = final
+
+        mel80 = self.compute_mel(final)
+        audio_feats = self.compute_APC(mel80)
+        pred_Feat = self.avatar.Audio2Feature.generate_sequences_stream(
+            self.feat_state, audio_feats, last=final, opt=self.avatar.Featopt)
+        if self.avatar.motion_matching is not None:
+            pred_Head = self.avatar.motion_matching.generate_sequences_stream(
+                self.head_state, audio_feats, mel80, sigma_scale=self.sigma_scale, last=final, opt=self.avatar.Headopt)
+        else:
+            pred_Head = self.avatar.Audio2Headpose.generate_sequences_stream(
+                self.head_state, audio_feats, sigma_scale=self.sigma_scale, opt=self.avatar.Headopt)
+
+        return self.post_process(pred_Feat, pred_Head, final)
+
+    def compute_mel(self, final=False):
+        av = self.avatar
+        if final:
+            mel_nframe = 2 * int(self.n_samples / av.sr * av.FPS)
+        else:
+            mel_nframe = self.mel_next
+            max_nframe = 2 * int(self.n_samples / av.sr * av.FPS)
+            while mel_nframe < max_nframe and \
+                    int(mel_nframe * self.mel_frame_step) + self.mel_frame_len <= self.n_samples:
+                mel_nframe += 1
+        if mel_nframe <= self.mel_next:
+            return np.zeros([0, 80])
+
+        audio_clips = np.zeros([mel_nframe - self.mel_next, self.mel_frame_len], np.float32)
+        for k, i in enumerate(range(self.mel_next, mel_nframe)):
+            st = int(i * self.mel_frame_step) - self.audio_offset
+            audio_clip = self.audio[st: st + self.mel_frame_len]
+            audio_clips[k, :len(audio_clip)] = audio_clip   # zero padded at the end
+        self.mel_next = mel_nframe
+        # drop the samples no further window needs
+        drop = int(self.mel_next * self.mel_frame_step) - self.audio_offset
+        self.audio = self.audio[drop:]
+        self.audio_offset += drop
+
+        with torch.no_grad():
+            audio_clips = torch.from_numpy(audio_clips).unsqueeze(1).to(av.device)
+            mel80 = av.Audio2Mel_torch(audio_clips).cpu().numpy()[:, :, 0]   # [n, 80]
+
+        return mel80.astype(np.float64)
+
+    def compute_APC(self, mel80):
+        av = self.avatar
+        if len(mel80) == 0:
+            return np.zeros([0, av.config['model_params']['APC']['hidden_size']], np.float32)
+        mel80_torch = torch.from_numpy(mel80.astype(np.float32)).to(av.device).unsqueeze(0)
+        hidden_reps, self.apc_hidden = av.APC_model.forward_stream(mel80_torch, self.apc_hidden)
+        audio_feats = hidden_reps[0].cpu().numpy()
+
+        # manifold projection
+        if av.use_LLE:
+            ind = utils.KNN_with_torch(audio_feats, av.APC_feat_database, K=av.Knear)
+            feat_fuse = np.zeros_like(audio_feats)
+            for i in range(audio_feats.shape[0]):
+                _, feat_fuse[i] = utils.solve_LLE_projection(audio_feats[i], av.APC_feat_database[ind[i]])
+            audio_feats = audio_feats * (1 - av.LLE_percent) + feat_fuse * av.LLE_percent
+
+        return audio_feats
+
+    def post_process(self, pred_Feat, pred_Head, final=False):
+        av = self.avatar
+
+        ## headpose
+        pred_Head = pred_Head.copy()
+        pred_Head[:, 0:3] *= av.rot_AMP
+        pred_Head[:, 3:6] *= av.trans_AMP
+        self.n_head += pred_Head.shape[0]
+        rot = self.rot_smoother.push(pred_Head[:, 0:3])
+        trans = self.trans_smoother.push(pred_Head[:, 3:6])
+
+        ## mouth, only frames that get a headpose (nframe = min of both in demo.py) are smoothed
+        self.mouth_raw = np.concatenate([self.mouth_raw, pred_Feat.reshape(-1, 25 * 3)])
+        n_push = max(0, min(self.n_mouth + self.mouth_raw.shape[0], self.n_head) - self.n_mouth)
+        mouth = self.mouth_smoother.push(self.mouth_raw[:n_push])
+        self.mouth_raw = self.mouth_raw[n_push:]
+        self.n_mouth += n_push
+        if final:
+            rot = np.concatenate([rot, self.rot_smoother.flush()])
+            trans = np.concatenate([trans, self.trans_smoother.flush()])
+            mouth = np.concatenate([mouth, self.mouth_smoother.flush()])
+
+        if mouth.shape[0]:
+            pred_pts3d = np.zeros([mouth.shape[0], 73, 3])
+            pred_pts3d[:, mouth_indices] = mouth.reshape(-1, 25, 3)
+            if self.prev_mouth is not None:
+                pred_pts3d = np.concatenate([self.prev_mouth[None], pred_pts3d])
+            prev_mouth = pred_pts3d[-1].copy()
+            pred_pts3d = utils.mouth_pts_AMP(pred_pts3d, True, av.AMP_method, av.Feat_AMPs)
+            if self.prev_mouth is not None:
+                pred_pts3d = pred_pts3d[1:]
+            self.prev_mouth = prev_mouth
+            pred_pts3d = pred_pts3d + av.mean_pts3d
+            pred_pts3d = utils.solve_intersect_mouth(pred_pts3d)  # solve intersect lips if exist
+            self.mouth_ready = np.concatenate([self.mouth_ready, pred_pts3d])
+        self.rot_ready = np.concatenate([self.rot_ready, rot])
+        self.trans_ready = np.concatenate([self.trans_ready, trans])
+
+        nready = min(self.mouth_ready.shape[0], self.rot_ready.shape[0], self.trans_ready.shape[0])
+        pred_pts3d, self.mouth_ready = self.mouth_ready[:nready], self.mouth_ready[nready:]
+        pred_headpose = np.concatenate([self.rot_ready[:nready], self.trans_ready[:nready]], axis=1).astype(np.float32)
+        self.rot_ready, self.trans_ready = self.rot_ready[nready:], self.trans_ready[nready:]
+        pred_headpose[:, 3:] += av.mean_translation
+        pred_headpose[:, 0] += 180
+
+        ## resample to the output frame rate
+        if self.resampler is not None:
+            frames = np.concatenate([pred_pts3d.reshape(nready, 73 * 3), pred_headpose], axis=1)
+            frames = self.resampler.push(frames)
+            if final:
+                frames = np.concatenate([frames, self.resampler.flush()])
+            nready = frames.shape[0]
+            pred_pts3d = frames[:, :73 * 3].reshape(nready, 73, 3)
+            pred_headpose = frames[:, 73 * 3:].astype(np.float32)
+
+        ## compute projected landmarks & upper body motion
+        frames = []
+        for k in range(nready):
+            index = self.n_frames + k
+            final_pts3d = av.std_mean_pts3d.astype(np.float32)
+            final_pts3d[46:64] = pred_pts3d[k, 46:64]
+            ind = int(index * av.FPS / self.output_fps) % av.candidate_eye_brow.shape[0]
+            final_pts3d[eye_brow_indices] = av.candidate_eye_brow[ind] + av.mean_pts3d[eye_brow_indices]
+            pred_landmarks, pred_shoulders = av.project(final_pts3d, pred_headpose[k])
+            frames.append((index, pred_landmarks, pred_shoulders))
+        self.n_frames += nready
+
+        return frames
+
+    def render(self, index, landmarks, shoulders, feature_map=None):
+        ''' feature map drawing (unless given) & Image2Image translation of one frame '''
+        av = self.avatar
+        current_pred_feature_map = av.draw(landmarks, shoulders) if feature_map is None else feature_map
+        key = image = None
+        if av.frame_cache is not None:
+            tag = '' if self.quality is None else self.quality.tier
+            if self.roi is not None:
+                tag += '|roi'
+            key = av.frame_cache.key(landmarks, shoulders, tag)
+            image = av.frame_cache.get(key)
+        if image is None:
+            image = self.generate(current_pred_feature_map, landmarks, shoulders, index)
+            if key is not None:
+                av.frame_cache.put(key, image)
+        elif av.frame_cache.verify():
+            av.frame_cache.record_error(image, self.generate(current_pred_feature_map, landmarks, shoulders, index))
+
+        return StreamFrame(index, image,
+                           np.uint8(current_pred_feature_map[0].cpu().numpy() * 255),
+                           landmarks, shoulders)
+
+    def generate(self, feature_map, landmarks, shoulders, index=None):
+        ''' Image2Image translation of one feature map (of output frame index), uint8 [h, w, 3] '''
+        av = self.avatar
+        input_feature_maps = feature_map.unsqueeze(0).to(av.device)
+        tier = None if self.quality is None else self.quality.tier
+        model = av.Feature2Face if tier is None else av.renderers[tier]
+        st = time.time()
+        if self.roi is None and self.render_session is not None:
+            pred_fake = self.render_session.render(model, input_feature_maps, av.img_candidates, index).result()
+        elif self.roi is None:
+            pred_fake = model.inference(input_feature_maps, av.img_candidates)
+        else:
+            if tier not in self.roi_renderers:
+                self.roi_renderers[tier] = ROIRenderer(model, **self.roi)
+            if tier != self.roi_tier:
+                # the last full render of this tier is outdated
+                self.roi_renderers[tier].reset()
+                self.roi_tier = tier
+            pred_fake = self.roi_renderers[tier].inference(input_feature_maps, av.img_candidates, landmarks, shoulders)
+        if self.quality is not None:
+            if av.device.type == 'cuda':
+                torch.cuda.synchronize(av.device)
+            self.quality.record(time.time() - st)
+
+        return util.tensor2im(pred_fake[0])
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--id', default='May', help="person name, e.g. Obama1, Obama2, May, Nadella, McStay")
+    parser.add_argument('--driving_audio', default='./data/input/00083.wav', help="path to driving audio")
+    parser.add_argument('--chunk_ms', type=int, default=200, help="size of the audio chunks fed to the pipeline")
+    parser.add_argument('--device', type=str, default='cpu', help='use cuda for GPU or use cpu for CPU')
+    parser.add_argument('--smoothing', type=str, default='truncated',
+                        help='gaussian (as demo.py) | truncated | one_euro | critically_damped; '
+                             'the last two smooth the headpose only, the mouth then uses truncated')
+    parser.add_argument('--smooth_lookahead', type=int, default=None, help='look-ahead frames of the truncated smoothing')
+    parser.add_argument('--fold_bn', type=int, default=1, help='fold BatchNorm into the Feature2Face convolutions')
+    parser.add_argument('--channels_last', type=int, default=0, help='run Feature2Face in channels_last memory format')
+    parser.add_argument('--backend', type=str, default='torch', help='torch | torchscript | onnx (see export.py)')
+    parser.add_argument('--export_dir', type=str, default=None, help='exported models, default <checkpoints>/export')
+    parser.add_argument('--output_fps', type=float, default=60,
+                        help='frame rate of the rendered video, the audio models always run at 60 fps')
+    parser.add_argument('--frame_cache', type=int, default=0,
+                        help='re-use the renders of frames with the same quantized landmarks and shoulders')
+    parser.add_argument('--cache_step', type=float, default=1.0, help='frame cache: quantization step in pixels')
+    parser.add_argument('--cache_dir', type=str, default=None, help='frame cache: directory of the disk tier')
+    parser.add_argument('--adaptive_quality', type=int, default=1,
+                        help='switch between the generator sizes of Image2Image adaptive_sizes to hold the frame rate')
+    parser.add_argument('--roi', type=int, default=0,
+                        help='render only a crop around the mouth while the rest of the head stays put')
+    parser.add_argument('--roi_threshold', type=float, default=1.0,
+                        help='roi: full render once a point outside of the crop moved more than this (pixels)')
+    parser.add_argument('--roi_full_every', type=int, default=30, help='roi: frames between forced full renders')
+    parser.add_argument('--sessions', type=int, default=1,
+                        help='concurrent sessions on the driving audio, rendered in shared batches; the first is saved')
+    parser.add_argument('--render_batch', type=int, default=8, help='sessions: frames per generator forward')
+    opt = parser.parse_args()
+
+    avatar = Avatar(opt.id, opt.device, fold_bn=bool(opt.fold_bn), channels_last=bool(opt.channels_last),
+                    backend=opt.backend, export_dir=opt.export_dir)
+    if opt.frame_cache:
+        avatar.enable_frame_cache(opt.cache_step, disk_dir=opt.cache_dir)
+    audio_name = os.path.split(opt.driving_audio)[1][:-4]
+    save_root = join('./results/', opt.id, audio_name)
+    os.makedirs(save_root, exist_ok=True)
+
+    audio, _ = librosa.load(opt.driving_audio, sr=avatar.sr)
+    chunk = int(avatar.sr * opt.chunk_ms / 1000)
+
+    # simulate a live input: a chunk becomes available every chunk_ms
+    print('Streaming audio: {} in {} ms chunks ...'.format(audio_name, opt.chunk_ms))
+    video_tmp_path = join(save_root, 'tmp_stream.avi')
+    out = cv2.VideoWriter(video_tmp_path, cv2.VideoWriter_fourcc(*('D', 'I', 'V', 'X')), opt.output_fps,
+                          (avatar.Renderopt.loadSize, avatar.Renderopt.loadSize))
+    scheduler = RenderScheduler(max_batch=opt.render_batch) if opt.sessions > 1 else None
+    pipelines = [StreamingPipeline(avatar, smoothing=opt.smoothing, lookahead=opt.smooth_lookahead,
+                                   adaptive_quality=bool(opt.adaptive_quality), output_fps=opt.output_fps,
+                                   roi=dict(threshold=opt.roi_threshold, full_every=opt.roi_full_every) if opt.roi else None,
+                                   scheduler=scheduler) for _ in range(opt.sessions)]
+    pipeline = pipelines[0]
+
+    def drain(other):
+        for k in range(0, len(audio), chunk):
+            for _ in other.push(audio[k: k + chunk]):
+                pass
+        for _ in other.flush():
+            pass
+    threads = [threading.Thread(target=drain, args=(other,)) for other in pipelines[1:]]
+    st = time.time()
+    for thread in threads:
+        thread.start()
+    first_frame, nframe = None, 0
+    for k in range(0, len(audio), chunk):
+        for frame in pipeline.push(audio[k: k + chunk]):
+            if first_frame is None:
+                first_frame = time.time() - st
+                print('first frame after {:.0f} ms of audio, {:.0f} ms wall time'.format(
+                    1000 * min(k + chunk, len(audio)) / avatar.sr, 1000 * first_frame))
+            out.write(cv2.cvtColor(frame.image, cv2.COLOR_RGB2BGR))
+            nframe += 1
+    for frame in pipeline.flush():
+        out.write(cv2.cvtColor(frame.image, cv2.COLOR_RGB2BGR))
+        nframe += 1
+    out.release()
+    for thread in threads:
+        thread.join()
+    print('{} frames in {:.1f} s'.format(nframe * opt.sessions, time.time() - st))
+    if scheduler is not None:
+        scheduler.close()
+        print(scheduler.report())
+    if avatar.frame_cache is not None:
+        print(avatar.frame_cache.report())
+    if pipeline.quality is not None:
+        print('render quality: {} switches, ended at {}'.format(len(pipeline.quality.switches), pipeline.quality.tier))
+    for tier, roi_renderer in pipeline.roi_renderers.items():
+        print(roi_renderer.report() if tier is None else '{}: {}'.format(tier, roi_renderer.report()))
+
+    tmp_audio_path = join(save_root, 'tmp_stream.wav')
+    sf.write(tmp_audio_path, audio[:np.int32(nframe * avatar.sr / opt.output_fps)], avatar.sr)
+    final_path = join(save_root, audio_name + '_stream.avi')
+    subprocess.call(f'ffmpeg -y -i "{video_tmp_path}" -i "{tmp_audio_path}" -codec copy -shortest "{final_path}"', shell=True)
+    os.remove(video_tmp_path)
+    os.remove(tmp_audio_path)
+    print('Finish!')
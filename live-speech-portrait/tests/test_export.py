@@ -0,0 +1,60 @@
+"""Parity of the TorchScript / ONNX graphs of models.backends against the eager
+networks, with random weights (no avatar data or checkpoints needed) and time
+lengths other than the export example's on the dynamic axes.
+
+    python -m pytest tests/test_export.py
+"""
+import sys
+
+import pytest
+import torch
+
+from models import backends, create_model
+from models.networks import APC_encoder
+from export import parity_inputs, check_parity
+
+
+BACKENDS = ['torchscript', 'onnx']
+NETWORKS = ['APC', 'Audio2Feature', 'Audio2Headpose_cond', 'Audio2Headpose_step', 'Feature2Face']
+
+
+@pytest.fixture(scope='module')
+def specs():
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        from options.test_audio2feature_options import TestOptions as FeatureOptions
+        from options.test_audio2headpose_options import TestOptions as HeadposeOptions
+        from options.test_feature2face_options import TestOptions as RenderOptions
+        Featopt, Headopt, Renderopt = FeatureOptions().parse(), HeadposeOptions().parse(), RenderOptions().parse()
+    finally:
+        sys.argv = argv
+    torch.manual_seed(0)
+    Featopt.gpu_ids = Headopt.gpu_ids = Renderopt.gpu_ids = []
+    Featopt.feature_decoder = 'LSTM'
+    # a small generator, the export does not depend on its size
+    Renderopt.size, Renderopt.loadSize, Renderopt.ngf = 'normal', 256, 16
+
+    APC_model = APC_encoder(80, 512, 3, True).eval()
+    Audio2Feature = create_model(Featopt)
+    Audio2Feature.eval()
+    Audio2Headpose = create_model(Headopt)
+    Audio2Headpose.eval()
+    Feature2Face = create_model(Renderopt)
+    Feature2Face.eval()
+    Feature2Face.optimize_for_inference()
+    return backends.export_specs(APC_model, Audio2Feature, Audio2Headpose, Feature2Face)
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+@pytest.mark.parametrize('name', NETWORKS)
+def test_parity(specs, backend, name, tmp_path):
+    if backend == 'onnx':
+        pytest.importorskip('onnxruntime')
+    module, inputs, input_names, output_names, dynamic_axes = specs[name]
+    path = str(tmp_path / name)
+    backends.export_model(module, inputs, path, backend, input_names, output_names, dynamic_axes)
+    runtime = backends.Runtime(path, backend)
+    # the export example has T = 100; even T, Audio2Feature takes APC frame pairs
+    for length in (160, 38) if dynamic_axes else (None,):
+        parity = parity_inputs(inputs, dynamic_axes, input_names, length) if length else inputs
+        assert check_parity(module, runtime, parity) <= 1e-3, (name, backend, length)
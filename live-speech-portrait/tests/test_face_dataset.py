@@ -0,0 +1,81 @@
+"""The feature map rasterizer of datasets/face_dataset.py against the per-segment
+cv2.line loop it replaced, on random frames (no avatar data needed).
+
+    python -m pytest tests/test_face_dataset.py
+"""
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+from datasets.face_dataset import FaceDataset
+
+
+@pytest.fixture(scope='module')
+def dataset():
+    argv, sys.argv = sys.argv, sys.argv[:1]
+    try:
+        from options.test_feature2face_options import TestOptions
+        opt = TestOptions().parse()
+    finally:
+        sys.argv = argv
+    opt.dataset_names, opt.test_dataset_names = ['test'], []
+    opt.test_image_pad = None   # as util.avatar_bundle sets it, no data files needed
+    return FaceDataset(opt)
+
+
+def draw_face_feature_maps_loop(part_list, keypoints, size=(512, 512)):
+    w, h = size
+    im_edges = np.zeros((h, w), np.uint8)
+    for edge_list in part_list:
+        for edge in edge_list:
+            for i in range(len(edge) - 1):
+                pt1 = [int(flt) for flt in keypoints[edge[i]]]
+                pt2 = [int(flt) for flt in keypoints[edge[i + 1]]]
+                im_edges = cv2.line(im_edges, tuple(pt1), tuple(pt2), 255, 2)
+    return im_edges
+
+
+def draw_shoulder_points_loop(img, shoulder_points):
+    num = int(shoulder_points.shape[0] / 2)
+    for i in range(2):
+        for j in range(num - 1):
+            pt1 = [int(flt) for flt in shoulder_points[i * num + j]]
+            pt2 = [int(flt) for flt in shoulder_points[i * num + j + 1]]
+            img = cv2.line(img, tuple(pt1), tuple(pt2), 255, 2)
+    return img
+
+
+def random_frames(rng, n):
+    ''' landmarks around the face with a few points outside of the image, and shoulders '''
+    landmarks = rng.normal(256, 60, size=(n, 73, 2)).astype(np.float32)
+    outside = rng.random(size=(n, 73)) < 0.05
+    landmarks[outside] = rng.uniform(-200, 700, size=(outside.sum(), 2))
+    shoulders = rng.uniform(-50, 560, size=(n, 18, 2)).astype(np.float32)
+    return landmarks, shoulders
+
+
+def test_draw_segments(dataset):
+    rng = np.random.default_rng(0)
+    landmarks, shoulders = random_frames(rng, 300)
+    for k in range(len(landmarks)):
+        ref = draw_face_feature_maps_loop(dataset.part_list, landmarks[k])
+        out = dataset.draw_face_feature_maps(landmarks[k])
+        assert np.array_equal(out, ref)
+        assert np.array_equal(dataset.draw_shoulder_points(out, shoulders[k]),
+                              draw_shoulder_points_loop(ref, shoulders[k]))
+
+
+@pytest.mark.parametrize('pad', [None, [10, 0, 0, 24]])
+def test_get_data_test_mode_batch(dataset, pad):
+    rng = np.random.default_rng(1)
+    landmarks, shoulders = random_frames(rng, 10)
+    shoulders_in = shoulders.copy()
+    ref = np.stack([dataset.get_data_test_mode(landmarks[k], shoulders[k].copy(), pad).numpy() for k in range(10)])
+    for workers in [1, 4]:
+        out = dataset.get_data_test_mode_batch(landmarks, shoulders, pad, workers=workers)
+        assert out.shape == ref.shape and np.array_equal(out.numpy(), ref)
+    # the shoulders are shifted by the padding on copies only
+    assert np.array_equal(shoulders, shoulders_in)
+    assert dataset.get_data_test_mode_batch(landmarks[:0], shoulders[:0], pad).shape == (0,) + ref.shape[1:]
@@ -0,0 +1,87 @@
+"""The streaming helpers of funcs/utils.py against their offline counterparts.
+
+    python -m pytest tests/test_utils.py
+"""
+import numpy as np
+import pytest
+
+from funcs import utils
+
+
+def chunked(stream, x, rng, max_chunk=7):
+    ''' concatenated outputs of stream.push() over random chunks of x, some of
+    them empty, then flush(); x is pushed at least once, also when empty '''
+    outputs, k = [], 0
+    while k < len(x) or not outputs:
+        c = int(rng.integers(0, max_chunk + 1))
+        outputs.append(stream.push(x[k: k + c]))
+        k += c
+    outputs.append(stream.flush())
+    return np.concatenate(outputs)
+
+
+@pytest.mark.parametrize('fps, out_fps', [(60, 25), (60, 30), (60, 24), (60, 59.94), (25, 60), (30, 60)])
+def test_frame_resampler(fps, out_fps):
+    rng = np.random.default_rng(0)
+    for n in list(range(12)) + [100, 257]:
+        x = rng.normal(size=(n, 3))
+        ref = utils.resample_frames(x, fps, out_fps)
+        assert len(ref) == int(n * out_fps / fps + 1e-6)
+        for _ in range(5):
+            out = chunked(utils.FrameResampler(fps, out_fps), x, rng)
+            assert out.shape == ref.shape and np.allclose(out, ref)
+
+
+def test_frame_resampler_empty():
+    # a clip too short for any output frame, as streaming.py concatenates it
+    resampler = utils.FrameResampler(60, 25)
+    frames = resampler.push(np.zeros((0, 225), np.float32))
+    assert frames.shape == (0, 225)
+    frames = np.concatenate([frames, resampler.push(np.ones((1, 225), np.float32))])
+    frames = np.concatenate([frames, resampler.flush()])
+    assert frames.shape == (0, 225) and frames.dtype == np.float32
+
+
+def relative_error(y, ref):
+    ''' RMS of the difference over the RMS variation of the reference '''
+    return np.sqrt(((y - ref) ** 2).mean()) / np.sqrt(((ref - ref.mean(0)) ** 2).mean())
+
+
+def head_motion(rng, n=600):
+    return np.cumsum(rng.normal(size=(n, 6)), axis=0)
+
+
+def mouth_motion(rng, n=600):
+    t = np.arange(n)[:, None]
+    return np.sin(2 * np.pi * t / rng.uniform(8, 30, size=(1, 6))) + 0.3 * rng.normal(size=(n, 6))
+
+
+@pytest.mark.parametrize('sigma', [0.5, 1.5, 2, 5, 10])
+def test_streaming_gaussian_filter(sigma):
+    from scipy.ndimage import gaussian_filter1d
+    rng = np.random.default_rng(0)
+    for n in [1, 2, 5, 17, 100, 257]:
+        x = rng.normal(size=(n, 3))
+        ref = gaussian_filter1d(x, sigma, axis=0)
+        for max_chunk in [1, 7, 50]:
+            out = chunked(utils.StreamingGaussianFilter(sigma), x, rng, max_chunk)
+            assert out.shape == ref.shape and np.allclose(out, ref)
+
+
+# the bounds stated in the docstrings of TruncatedGaussianSmoother and make_smoother
+@pytest.mark.parametrize('method, motion, sigmas, tolerance', [
+    ('truncated', head_motion, (5, 10), 0.02),
+    ('truncated', mouth_motion, (1.5, 2), 0.03),
+    ('one_euro', head_motion, (5, 10), 0.3),
+    ('critically_damped', head_motion, (5, 10), 0.3),
+])
+def test_smoother_tolerance(method, motion, sigmas, tolerance):
+    from scipy.ndimage import gaussian_filter1d
+    rng = np.random.default_rng(0)
+    for sigma in sigmas:
+        for _ in range(10):
+            x = motion(rng)
+            ref = gaussian_filter1d(x, sigma, axis=0)
+            out = chunked(utils.make_smoother(method, sigma), x, rng)
+            assert out.shape == ref.shape
+            assert relative_error(out, ref) < tolerance
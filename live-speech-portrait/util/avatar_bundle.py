@@ -0,0 +1,177 @@
+import os
+import json
+import struct
+from os.path import join
+
+import numpy as np
+import scipy.io as sio
+import albumentations as A
+from albumentations.pytorch import ToTensorV2
+from skimage.io import imread
+
+from funcs import utils
+from util.motion_matching import tracked_headposes
+
+
+BUNDLE_VERSION = 1
+MAGIC = b'LSPAVTR\0'
+ALIGN = 64
+eye_brow_indices = np.array([27, 65, 28, 68, 29, 67, 30, 66, 31, 72, 32, 69, 33, 70, 34, 71], np.int32)
+
+
+def bundle_path(data_root):
+    return join(data_root, 'avatar.bundle')
+
+
+def source_files(config, data_root):
+    ''' the files the bundle of a talking head is compiled from '''
+    dataset_root = config['dataset_params']['root']
+    return [join(data_root, 'mean_pts3d.npy'),
+            config['dataset_params']['fit_data_path'],
+            config['dataset_params']['pts3d_path']] + \
+           [join(data_root, 'candidates', f'normalized_full_{j}.jpg') for j in range(4)] + \
+           [join(data_root, 'shoulder_points3D.npy'),
+            join(data_root, 'camera_intrinsic.npy'),
+            join(data_root, 'APC_feature_base.npy'),
+            join(data_root, 'id_scale.mat'),
+            join(dataset_root, 'example.png'),
+            join(dataset_root, 'change_paras.npz')]
+
+
+def source_signature(paths):
+    ''' {path: [size, mtime_ns]}, None for missing files '''
+    signature = {}
+    for path in paths:
+        st = os.stat(path) if os.path.exists(path) else None
+        signature[os.path.normpath(path)] = None if st is None else [st.st_size, st.st_mtime_ns]
+    return signature
+
+
+def test_image_pad(dataset_root):
+    ''' FaceDataset test mode's image_pad, from example.png and change_paras.npz '''
+    example = imread(join(dataset_root, 'example.png'))
+    h, w, _ = example.shape
+    change_paras = np.load(join(dataset_root, 'change_paras.npz'))
+    scale, xc, yc = change_paras['scale'], change_paras['xc'], change_paras['yc']
+    x_min, x_max, y_min, y_max = xc-256, xc+256, yc-256, yc+256
+    x_min, x_max, y_min, y_max = max(x_min, 0), min(x_max, w), max(y_min, 0), min(y_max, h)
+    if x_min == 0 or x_max == 512 or y_min == 0 or y_max == 512:
+        top, bottom, left, right = abs(yc-256-y_min), abs(yc+256-y_max), abs(xc-256-x_min), abs(xc+256-x_max)
+        return [int(top), int(bottom), int(left), int(right)]
+    return None
+
+
+def compile_avatar(config, data_root):
+    ''' the pre-defined data of a talking head as demo.py derives it from its files:
+    (arrays, meta) with the arrays by name and the json serializable scalars
+    '''
+    mean_pts3d = np.load(join(data_root, 'mean_pts3d.npy'))
+    fit_data = np.load(config['dataset_params']['fit_data_path'])
+    tracked_pts3d = np.load(config['dataset_params']['pts3d_path'])
+    pts3d = tracked_pts3d - mean_pts3d
+    trans = fit_data['trans'][:, :, 0].astype(np.float32)
+
+    # candidates images, normalized to [-1, 1], [1, 3 * 4, H, W]
+    tensor_aug = A.Compose([
+        A.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)),
+        ToTensorV2()
+    ])
+    img_candidates = [tensor_aug(image=imread(join(data_root, 'candidates', f'normalized_full_{j}.jpg')))['image'].numpy()
+                      for j in range(4)]
+
+    arrays = {
+        'mean_pts3d': mean_pts3d,
+        'std_mean_pts3d': tracked_pts3d.mean(axis=0),
+        'candidate_eye_brow': pts3d[10:, eye_brow_indices],
+        'closed_mouth': utils.closed_mouth_template(pts3d),
+        'mean_translation': trans.mean(axis=0),
+        'ref_trans': trans[1],
+        'headposes': tracked_headposes(fit_data),
+        'img_candidates': np.concatenate(img_candidates)[None].astype(np.float32),
+        'shoulder3D': np.load(join(data_root, 'shoulder_points3D.npy'))[1],
+        'camera_intrinsic': np.load(join(data_root, 'camera_intrinsic.npy')).astype(np.float32),
+        'APC_feat_database': np.load(join(data_root, 'APC_feature_base.npy')),
+    }
+    meta = {'scale': float(sio.loadmat(join(data_root, 'id_scale.mat'))['scale'][0, 0]),
+            'image_pad': test_image_pad(config['dataset_params']['root'])}
+
+    return arrays, meta
+
+
+def write_bundle(path, arrays, meta, sources=None):
+    ''' one file: magic, header length, json header, then the arrays ALIGN byte aligned '''
+    entries, offset = {}, 0
+    arrays = {name: np.ascontiguousarray(value) for name, value in arrays.items()}
+    for name, value in arrays.items():
+        entries[name] = {'dtype': value.dtype.str, 'shape': list(value.shape), 'offset': offset}
+        offset += -(-value.nbytes // ALIGN) * ALIGN
+    header = json.dumps({'version': BUNDLE_VERSION, 'arrays': entries, 'meta': meta,
+                         'sources': sources or {}}).encode()
+    start = -(-(len(MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + struct.pack('<Q', len(header)) + header)
+        for name, value in arrays.items():
+            f.seek(start + entries[name]['offset'])
+            f.write(value.tobytes())
+        f.truncate(start + offset)
+    os.replace(tmp_path, path)
+
+
+class AvatarBundle(object):
+    ''' a bundle written by build_avatar_bundle.py, memory mapped (copy on write):
+    bundle['img_candidates'] etc. are views into the one mapping, bundle.meta the scalars
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not an avatar bundle'.format(path))
+            header_len, = struct.unpack('<Q', f.read(8))
+            header = json.loads(f.read(header_len).decode())
+        if header['version'] != BUNDLE_VERSION:
+            raise ValueError('{} has bundle version {}, expected {}: rebuild it with build_avatar_bundle.py'.format(
+                path, header['version'], BUNDLE_VERSION))
+        self.path = path
+        self.meta = header['meta']
+        self.sources = header['sources']
+        start = -(-(len(MAGIC) + 8 + header_len) // ALIGN) * ALIGN
+        self.buffer = np.memmap(path, np.uint8, mode='c')
+        self.arrays = {}
+        for name, entry in header['arrays'].items():
+            dtype = np.dtype(entry['dtype'])
+            nbytes = dtype.itemsize * int(np.prod(entry['shape']))
+            offset = start + entry['offset']
+            self.arrays[name] = self.buffer[offset: offset + nbytes].view(dtype).reshape(entry['shape'])
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def is_current(self, config, data_root):
+        ''' whether the source files are unchanged since the bundle was built '''
+        return self.sources == source_signature(source_files(config, data_root))
+
+
+def build_bundle(config, data_root, path=None):
+    path = path or bundle_path(data_root)
+    sources = source_signature(source_files(config, data_root))
+    arrays, meta = compile_avatar(config, data_root)
+    write_bundle(path, arrays, meta, sources)
+    return path
+
+
+def load_avatar_data(config, data_root):
+    ''' the compiled bundle of a talking head if it is there and up to date, else
+    the same data derived from the source files (see compile_avatar)
+    '''
+    path = bundle_path(data_root)
+    if os.path.exists(path):
+        try:
+            bundle = AvatarBundle(path)
+        except ValueError as e:
+            print(e)
+        else:
+            if bundle.is_current(config, data_root):
+                return bundle.arrays, bundle.meta
+            print('{} is older than its source files, rebuild it with build_avatar_bundle.py'.format(path))
+    return compile_avatar(config, data_root)
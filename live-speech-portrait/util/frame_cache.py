@@ -0,0 +1,109 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FrameCache(object):
+    ''' rendered frames of one talking head, keyed by a hash of the quantized
+    projected landmarks and shoulders the feature map is drawn from: frames whose
+    points fall into the same grid cells share one Feature2Face run. The feature
+    map is drawn from the points truncated to int, so with step 1 (the default)
+    a hit is exactly the frame that would be rendered; coarser steps trade
+    accuracy for more hits (see verify_every).
+    Args:
+        step(float): quantization step of the points in pixels
+        capacity(int): frames kept in memory, least recently used ones are dropped
+        disk_dir(str): optional second tier, one .npy per frame, kept across runs
+        namespace(str): identifies the renderer (checkpoint, profile, ...), part of
+            every key so that frames of another renderer are never returned
+        verify_every(int): re-render every n-th hit and measure the error of the
+            cached frame (see verify / record_error), 0 for never
+    '''
+    def __init__(self, step=1.0, capacity=1024, disk_dir=None, namespace='', verify_every=0):
+        assert step > 0 and capacity > 0
+        self.step = step
+        self.capacity = capacity
+        self.salt = hashlib.sha1('{}|{}'.format(namespace, step).encode()).digest()
+        self.disk_dir = None
+        if disk_dir is not None:
+            self.disk_dir = os.path.join(disk_dir, self.salt.hex()[:12])
+            os.makedirs(self.disk_dir, exist_ok=True)
+        self.verify_every = verify_every
+        self.frames = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.disk_hits = self.misses = 0
+        self.errors = []   # PSNR of verified hits
+
+    def key(self, landmarks, shoulders, tag=''):
+        points = np.concatenate([np.asarray(landmarks, np.float64).reshape(-1),
+                                 np.asarray(shoulders, np.float64).reshape(-1)])
+        grid = np.floor(points / self.step).astype(np.int64)
+        return hashlib.sha1(self.salt + tag.encode() + grid.tobytes()).hexdigest()
+
+    def get(self, key):
+        ''' the cached uint8 image or None '''
+        with self.lock:
+            image = self.frames.get(key)
+            if image is not None:
+                self.frames.move_to_end(key)
+                self.hits += 1
+                return image
+        path = self._path(key)
+        if path is not None and os.path.exists(path):
+            image = np.load(path)
+            with self.lock:
+                self.disk_hits += 1
+                self.hits += 1
+                self._insert(key, image)
+            return image
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, image):
+        with self.lock:
+            self._insert(key, image)
+        path = self._path(key)
+        if path is not None and not os.path.exists(path):
+            tmp_path = '{}.{}.tmp.npy'.format(path[:-4], threading.get_ident())
+            np.save(tmp_path, image)
+            os.replace(tmp_path, path)
+
+    def verify(self):
+        ''' whether the current hit should be rendered again to measure its error '''
+        return self.verify_every > 0 and self.hits % self.verify_every == 0
+
+    def record_error(self, cached, rendered):
+        mse = np.mean((cached.astype(np.float64) - rendered.astype(np.float64)) ** 2)
+        self.errors.append(100.0 if mse == 0 else 10 * np.log10(255.0 ** 2 / mse))
+
+    def report(self):
+        total = self.hits + self.misses
+        report = 'frame cache: {} / {} hits ({:.1f}%, {} from disk), {} frames in memory'.format(
+            self.hits, total, 100.0 * self.hits / max(total, 1), self.disk_hits, len(self.frames))
+        if self.errors:
+            report += ', PSNR of {} verified hits: mean {:.2f} dB, min {:.2f} dB'.format(
+                len(self.errors), np.mean(self.errors), np.min(self.errors))
+        return report
+
+    def _insert(self, key, image):
+        self.frames[key] = image
+        self.frames.move_to_end(key)
+        while len(self.frames) > self.capacity:
+            self.frames.popitem(last=False)
+
+    def _path(self, key):
+        if self.disk_dir is None:
+            return None
+        return os.path.join(self.disk_dir, key + '.npy')
+
+
+def renderer_namespace(opt, mode=''):
+    ''' FrameCache namespace of the Feature2Face checkpoint of opt (RenderOptions) run as mode (profile / backend) '''
+    ckp = opt.load_epoch
+    mtime = os.path.getmtime(ckp) if os.path.exists(ckp) else 0
+
+    return '{}|{}|{}|{}'.format(os.path.abspath(ckp), mtime, opt.size, mode)
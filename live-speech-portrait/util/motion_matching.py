@@ -0,0 +1,231 @@
+import numpy as np
+
+
+min_mel = np.log(1e-5)   # Audio2Mel's log-mel floor, the mels are normalized with it
+
+
+def tracked_headposes(fit_data):
+    ''' [n, 6] headposes of a 3d_fit_data.npz as Audio2Headpose is trained on them
+    (datasets.audiovisual_dataset): x rotation - 180, translation - mean '''
+    rot_angles = fit_data['rot_angles'].astype(np.float32)
+    rot_angles[rot_angles[:, 0] < 0, 0] += 360
+    rot_angles[:, 0] -= 180
+    trans = fit_data['trans'][:, :, 0].astype(np.float32)
+    trans = trans - trans.mean(axis=0)
+
+    return np.concatenate([rot_angles, trans], axis=1)
+
+
+class MotionMatchingHeadpose(object):
+    ''' headposes without the autoregressive WaveNet: the avatar's tracked headposes
+    (3d_fit_data.npz) are cut into overlapping windows and the output is a
+    crossfaded sequence of them. Every window has a motion intensity (mean
+    normalized pose velocity); each segment of the output picks, among the top_k
+    windows whose intensity is closest to the one the audio asks for, the window
+    that continues the previous one best (pose and velocity over the overlap).
+    The audio drive is the loudness (relative to the loudest frame so far) and
+    the APC feature activity (frame to frame change, relative to its mean so far),
+    mapped onto the quantiles of the window intensities.
+    generate_sequences() chooses all segments at once (Viterbi), the stream
+    greedily, one hop after the audio of a segment arrived.
+    Output as Audio2HeadposeModel: [nframe, 12] headposes (x rotation - 180,
+    translation - mean) and their velocities.
+    Args:
+        headposes(array): [n, 6] tracked rotation angles and translations, as above
+        window(int): frames per segment
+        hop(int): frames between segment starts, window - hop frames are crossfaded
+        stride(int): frames between the starts of the database windows
+        top_k(int): candidate windows per segment
+        transition_weight(float): weight of the continuity against the audio match
+        range_db(float): loudness range below the loudest frame mapped onto [0, 1]
+        seed: of the random candidate choice (sigma_scale), None for a random one
+    '''
+    def __init__(self, headposes, window=48, hop=24, stride=4, top_k=16, transition_weight=1.0, range_db=40,
+                 seed=None):
+        headposes = np.asarray(headposes, np.float32)
+        if len(headposes) < window:
+            raise ValueError('{} tracked headposes, a motion matching window needs {}'.format(len(headposes), window))
+        assert 0 < hop <= window
+        self.window = window
+        self.hop = hop
+        self.top_k = top_k
+        self.transition_weight = transition_weight
+        self.range_db = range_db
+        self.seed = seed
+
+        velocity = np.concatenate([np.zeros([1, 6], np.float32), np.diff(headposes, axis=0)])
+        pose_scale = headposes.std(axis=0) + 1e-6
+        velocity_scale = velocity.std(axis=0) + 1e-6
+        starts = np.arange(0, len(headposes) - window + 1, stride)
+        index = starts[:, None] + np.arange(window)
+        self.windows = headposes[index]                                     # [n_windows, window, 6]
+        speed = np.abs(velocity / velocity_scale).sum(axis=1)
+        self.intensity = speed[index].mean(axis=1)                          # [n_windows]
+        self.intensity_scale = self.intensity.std() + 1e-6
+        # normalized pose & velocity of the frames crossfaded with the previous / next segment
+        features = np.concatenate([headposes / pose_scale, velocity / velocity_scale], axis=1)[index]
+        self.heads = features[:, :window - hop]
+        self.tails = features[:, hop:]
+        ramp = np.minimum(np.arange(window) + 1, window - np.arange(window)).astype(np.float32)
+        self.weights = ramp / ramp.max()
+
+    @classmethod
+    def from_fit_data(cls, fit_data, **kwargs):
+        return cls(tracked_headposes(fit_data), **kwargs)
+
+    ############################## Offline ##################################
+    def generate_sequences(self, audio_feats, mel80, sigma_scale=0.0, opt=None):
+        ''' headposes of a whole utterance
+        Args:
+            audio_feats: [2 * n, 512] APC features
+            mel80: [2 * n, 80] the normalized log-mels they were computed from
+            opt: Headopt, the last opt.frame_future frames are left out as by Audio2HeadposeModel
+        Returns:
+            pred_headpose: [n - frame_future, 12]
+        '''
+        state = self.init_stream()
+        drive = self.frame_drive(state, audio_feats, mel80)
+        nframe = max(0, len(drive) - getattr(opt, 'frame_future', 0))
+        nseg = -(-nframe // self.hop)
+        if nseg == 0:
+            return np.zeros([0, 12], np.float32)
+        candidates, audio_cost = self.candidates(self.segment_targets(drive, nseg), sigma_scale, state['rng'])
+
+        # Viterbi over the segments
+        cost, back = audio_cost[0], []
+        for s in range(1, nseg):
+            total = cost[:, None] + self.transition_cost(candidates[s - 1], candidates[s])
+            back.append(np.argmin(total, axis=0))
+            cost = total[back[-1], np.arange(total.shape[1])] + audio_cost[s]
+        path = [int(np.argmin(cost))]
+        for b in reversed(back):
+            path.append(int(b[path[-1]]))
+        path = candidates[np.arange(nseg), path[::-1]]
+
+        poses = np.zeros([nseg * self.hop + self.window, 6], np.float32)
+        weights = np.zeros([nseg * self.hop + self.window, 1], np.float32)
+        for s, w in enumerate(path):
+            poses[s * self.hop: s * self.hop + self.window] += self.weights[:, None] * self.windows[w]
+            weights[s * self.hop: s * self.hop + self.window] += self.weights[:, None]
+        poses = poses[:nframe] / weights[:nframe]
+        velocity = np.concatenate([np.zeros([1, 6], np.float32), np.diff(poses, axis=0)])
+
+        return np.concatenate([poses, velocity], axis=1)
+
+    ############################## Streaming ##################################
+    def init_stream(self):
+        return {'rng': np.random.default_rng(self.seed),
+                'peak': -np.inf,          # loudest APC frame so far (dB)
+                'activity': [0.0, 0],     # sum & count of the APC activity so far
+                'prev_feat': None,        # last APC frame
+                'pending': None,          # drive of an odd APC frame waiting for its pair
+                'drive': np.zeros(0),     # drive of the video frames from 'drive_offset' on
+                'drive_offset': 0,
+                'n_frames': 0,            # video frames of audio so far
+                'n_seg': 0,               # segments chosen
+                'prev': None,             # window of the last segment
+                'poses': np.zeros([0, 6], np.float32),   # crossfade buffers from frame 'next' on
+                'weights': np.zeros([0, 1], np.float32),
+                'next': 0,                # next frame to hand out
+                'last_pose': None}
+
+    def generate_sequences_stream(self, state, audio_feats, mel80, sigma_scale=0.0, last=False, opt=None):
+        ''' incremental generate_sequences(): feed the next APC frames and their
+        mels, get the headposes of the frames whose segments are chosen, [m, 12]
+        '''
+        drive = self.frame_drive(state, audio_feats, mel80)
+        state['drive'] = np.concatenate([state['drive'], drive])
+        state['n_frames'] += len(drive)
+        limit = max(0, state['n_frames'] - getattr(opt, 'frame_future', 0))
+
+        while (state['n_seg'] + 1) * self.hop <= state['n_frames'] or (last and state['n_seg'] * self.hop < limit):
+            s = state['n_seg']
+            target = self.segment_targets(state['drive'][s * self.hop - state['drive_offset']:], 1)
+            candidates, audio_cost = self.candidates(target, sigma_scale, state['rng'])
+            cost = audio_cost[0]
+            if state['prev'] is not None:
+                cost = cost + self.transition_cost(np.array([state['prev']]), candidates[0])[0]
+            w = state['prev'] = candidates[0, np.argmin(cost)]
+            start = s * self.hop - state['next']
+            grow = start + self.window - len(state['poses'])
+            if grow > 0:
+                state['poses'] = np.concatenate([state['poses'], np.zeros([grow, 6], np.float32)])
+                state['weights'] = np.concatenate([state['weights'], np.zeros([grow, 1], np.float32)])
+            state['poses'][start: start + self.window] += self.weights[:, None] * self.windows[w]
+            state['weights'][start: start + self.window] += self.weights[:, None]
+            state['n_seg'] += 1
+            # the drive of the chosen segments is not needed any more
+            state['drive'] = state['drive'][(s + 1) * self.hop - state['drive_offset']:]
+            state['drive_offset'] = (s + 1) * self.hop
+
+        # frames no later segment overlaps
+        nready = max(0, min(state['n_seg'] * self.hop, limit) - state['next'])
+        poses = state['poses'][:nready] / np.maximum(state['weights'][:nready], 1e-6)
+        state['poses'], state['weights'] = state['poses'][nready:], state['weights'][nready:]
+        state['next'] += nready
+        if nready == 0:
+            return np.zeros([0, 12], np.float32)
+        previous = poses[:1] if state['last_pose'] is None else state['last_pose']
+        velocity = np.diff(np.concatenate([previous, poses]), axis=0)
+        state['last_pose'] = poses[-1:]
+
+        return np.concatenate([poses, velocity], axis=1)
+
+    ############################## Matching ##################################
+    def frame_drive(self, state, audio_feats, mel80):
+        ''' audio drive in [0, 1] of the video frames (APC frame pairs) of the next APC
+        frames, from the loudness and APC activity relative to the statistics so far '''
+        audio_feats = np.asarray(audio_feats, np.float32).reshape(-1, 512)
+        mel80 = np.asarray(mel80, np.float64).reshape(-1, 80)
+        n = min(len(audio_feats), len(mel80))
+        audio_feats, mel80 = audio_feats[:n], mel80[:n]
+
+        loudness = 20 / np.log(10) * np.log(np.exp(mel80 * -min_mel + min_mel).mean(axis=1))
+        peak = np.maximum.accumulate(np.concatenate([[state['peak']], loudness]))[1:]
+        loud = np.clip((loudness - peak) / self.range_db + 1, 0, 1)
+        if n:
+            state['peak'] = peak[-1]
+
+        previous = audio_feats[:1] if state['prev_feat'] is None else state['prev_feat']
+        activity = np.linalg.norm(np.diff(np.concatenate([previous, audio_feats]), axis=0), axis=1)
+        total = state['activity'][0] + np.cumsum(activity)
+        count = state['activity'][1] + np.arange(1, n + 1)
+        active = np.clip(activity / (2 * total / count + 1e-6), 0, 1)
+        if n:
+            state['activity'] = [total[-1], count[-1]]
+            state['prev_feat'] = audio_feats[-1:]
+
+        drive = (loud + active) / 2
+        if state['pending'] is not None:
+            drive = np.concatenate([state['pending'], drive])
+            state['pending'] = None
+        if len(drive) % 2 == 1:
+            state['pending'], drive = drive[-1:], drive[:-1]
+
+        return drive.reshape(-1, 2).mean(axis=1)
+
+    def segment_targets(self, drive, nseg):
+        ''' window intensity asked for by the mean drive of the first hop frames of each segment '''
+        if len(drive) == 0:
+            drive = np.full(1, 0.5)
+        drive = np.concatenate([drive, np.full(max(0, nseg * self.hop - len(drive)), drive[-1])])
+        drive = drive[:nseg * self.hop].reshape(nseg, self.hop).mean(axis=1)
+
+        return np.quantile(self.intensity, np.clip(drive, 0, 1))
+
+    def candidates(self, targets, sigma_scale, rng):
+        ''' the top_k windows closest to the target intensities [nseg] (randomized by
+        sigma_scale) and their audio costs, [nseg, top_k] each '''
+        cost = ((self.intensity[None] - targets[:, None]) / self.intensity_scale) ** 2
+        noisy = cost + sigma_scale * rng.random(cost.shape) if sigma_scale > 0 else cost
+        k = min(self.top_k, cost.shape[1])
+        candidates = np.argpartition(noisy, k - 1, axis=1)[:, :k]
+
+        return candidates, np.take_along_axis(cost, candidates, axis=1)
+
+    def transition_cost(self, previous, candidates):
+        ''' [len(previous), len(candidates)] mismatch over the crossfaded frames '''
+        if self.window == self.hop:
+            return np.zeros([len(previous), len(candidates)])
+        diff = self.tails[previous][:, None] - self.heads[candidates][None]
+        return self.transition_weight * (diff ** 2).mean(axis=(2, 3))
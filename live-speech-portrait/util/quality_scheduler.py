@@ -0,0 +1,82 @@
+import time
+
+
+class QualityScheduler(object):
+    ''' picks the generator size per frame so that rendering keeps up with the
+    frame rate: one tier down when the smoothed render latency stays above the
+    frame budget, one tier up when it has stayed well below it for a while.
+    Args:
+        tiers(list): tier names, best quality first, e.g. ['large', 'normal']
+        fps(float): frame rate, the deadline of a frame is 1 / fps
+        budget(float): switch down above budget * deadline
+        headroom(float): switch up below headroom * deadline (< budget, the hysteresis)
+        down_after(int): frames over budget before switching down
+        up_after(int): frames below headroom before switching up; doubled (up
+            to max_up_after) each time an up switch had to be undone within
+            up_after frames, reset after a stable up switch
+        alpha(float): weight of a new latency in the moving average
+        log: callable(str) for the switch messages, None for silent
+    '''
+    def __init__(self, tiers, fps=60, budget=1.0, headroom=0.7, down_after=5, up_after=120,
+                 max_up_after=1920, alpha=0.1, log=print):
+        assert len(tiers) > 0 and headroom < budget
+        self.tiers = list(tiers)
+        self.deadline = 1.0 / fps
+        self.budget = budget
+        self.headroom = headroom
+        self.down_after = down_after
+        self.base_up_after = self.up_after = up_after
+        self.max_up_after = max_up_after
+        self.alpha = alpha
+        self.log = log
+        self.level = 0                # index into tiers
+        self.latency = {}             # moving average per tier, while in use
+        self.frames = 0
+        self.over = self.under = 0    # consecutive frames over budget / below headroom
+        self.last_switch = (0, None)  # (frame, 'up' | 'down' | 'held')
+        self.switches = []            # (frame, from tier, to tier, latency)
+
+    @property
+    def tier(self):
+        return self.tiers[self.level]
+
+    def record(self, latency, lag=0.0):
+        ''' latency of the frame just rendered (seconds); lag: how far the output
+        is behind real time (seconds), if known. Returns the tier for the next frame.
+        '''
+        self.frames += 1
+        tier = self.tier
+        avg = self.latency.get(tier)
+        avg = latency if avg is None else self.alpha * latency + (1 - self.alpha) * avg
+        self.latency[tier] = avg
+
+        frame, direction = self.last_switch
+        if direction == 'up' and self.frames - frame >= self.up_after:
+            # the up switch held
+            self.up_after = self.base_up_after
+            self.last_switch = (frame, 'held')
+
+        behind = avg > self.budget * self.deadline or lag > self.down_after * self.deadline
+        self.over = self.over + 1 if behind else 0
+        self.under = self.under + 1 if avg < self.headroom * self.deadline and lag <= 0 else 0
+
+        if self.over >= self.down_after and self.level + 1 < len(self.tiers):
+            if self.last_switch[1] == 'up':
+                # the better tier did not hold, wait longer before the next try
+                self.up_after = min(2 * self.up_after, self.max_up_after)
+            self._switch(self.level + 1, 'down', avg)
+        elif self.under >= self.up_after and self.level > 0:
+            self._switch(self.level - 1, 'up', avg)
+        return self.tier
+
+    def _switch(self, level, direction, avg):
+        old = self.tier
+        self.level = level
+        # start the new tier from a fresh average
+        self.latency.pop(self.tier, None)
+        self.over = self.under = 0
+        self.last_switch = (self.frames, direction)
+        self.switches.append((self.frames, old, self.tier, avg))
+        if self.log is not None:
+            self.log('[{}] render quality {} -> {} at frame {} (avg {:.1f} ms, deadline {:.1f} ms)'.format(
+                time.strftime('%H:%M:%S'), old, self.tier, self.frames, 1000 * avg, 1000 * self.deadline))
@@ -0,0 +1,160 @@
+import time
+import heapq
+import itertools
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+
+class RenderSession(object):
+    ''' the frames of one avatar session, see RenderScheduler.session() '''
+    def __init__(self, scheduler, name, fps, delay):
+        self.scheduler = scheduler
+        self.name = name
+        self.fps = fps
+        self.delay = delay
+        self.start = None        # playback clock, set by the first frame
+        self.frames = 0
+        self.lags = []           # completion time - deadline of every frame (s)
+
+    def deadline(self, index):
+        if self.start is None:
+            self.start = time.time() + self.delay
+        return self.start + index / self.fps
+
+    def render(self, model, feature_map, cand_image, index=None):
+        ''' Future of model.inference(feature_map, cand_image) for frame index
+        (default: the next one) of the session '''
+        if index is None:
+            index = self.frames
+        self.frames = index + 1
+        return self.scheduler.submit(self, model, feature_map, cand_image, self.deadline(index))
+
+
+class RenderScheduler(object):
+    ''' renders the frames of many concurrent sessions with shared generator
+    forwards: requests of the same model and candidate images (one avatar
+    checkpoint) are stacked into one batch; the batch of the request with the
+    earliest playback deadline goes first. A batch that is not full waits up to
+    max_wait for more requests, if the deadline leaves that much slack.
+    Models whose generator cannot batch (exported backends) run one frame per call.
+    Args:
+        max_batch(int): frames per generator forward
+        max_wait(float): seconds a batch may wait to fill up
+    '''
+    def __init__(self, max_batch=8, max_wait=0.004):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.cond = threading.Condition()
+        self.pending = []        # heap of (deadline, seq, request)
+        self.seq = itertools.count()
+        self.sessions = OrderedDict()
+        self.batches = {}        # group -> [batches, frames, busy seconds]
+        self.closed = False
+        self.thread = threading.Thread(target=self._work, name='render-scheduler', daemon=True)
+        self.thread.start()
+
+    def session(self, name=None, fps=60, delay=0.1):
+        ''' a new session, whose frame k is due delay + k / fps seconds after its first request '''
+        with self.cond:
+            if name is None:
+                name = 'session {}'.format(len(self.sessions))
+            assert name not in self.sessions, 'session {} exists'.format(name)
+            self.sessions[name] = RenderSession(self, name, fps, delay)
+            return self.sessions[name]
+
+    def submit(self, session, model, feature_map, cand_image, deadline):
+        future = Future()
+        future.deadline = deadline
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('the render scheduler is closed')
+            heapq.heappush(self.pending, (deadline, next(self.seq), (session, model, feature_map, cand_image, future)))
+            self.cond.notify()
+        return future
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                batch = self._take()
+                batch += self._take(batch, self._batch_size(batch) - len(batch))
+                # wait for more frames of the group while the first deadline allows it
+                wait_until = min(time.time() + self.max_wait, batch[0][0] - self._estimate(batch))
+                while len(batch) < self._batch_size(batch) and time.time() < wait_until and not self.closed:
+                    self.cond.wait(wait_until - time.time())
+                    batch += self._take(batch, self._batch_size(batch) - len(batch))
+            self._run([request for _, _, request in batch])
+
+    def _group(self, request):
+        session, model, feature_map, cand_image, future = request
+        return id(model), id(cand_image), tuple(feature_map.shape[1:])
+
+    def _batch_size(self, batch):
+        model = batch[0][2][1]
+        G = getattr(model, 'Feature2Face_G', None)
+        G = getattr(G, 'module', G)
+        return self.max_batch if getattr(G, 'batch_inference', True) else 1
+
+    def _estimate(self, batch):
+        ''' expected run time of a batch of this group (s) '''
+        stats = self.batches.get(self._group(batch[0][2]))
+        if stats is None:
+            return 0.0
+        return stats[2] / stats[0]
+
+    def _take(self, batch=None, limit=None):
+        ''' pops the earliest request (batch None) or up to limit requests of the group of batch '''
+        if batch is None:
+            return [heapq.heappop(self.pending)]
+        group = self._group(batch[0][2])
+        taken = [entry for entry in sorted(self.pending) if self._group(entry[2]) == group][:limit]
+        if taken:
+            ids = set(id(entry[2]) for entry in taken)
+            self.pending = [entry for entry in self.pending if id(entry[2]) not in ids]
+            heapq.heapify(self.pending)
+        return taken
+
+    def _run(self, requests):
+        model, cand_image = requests[0][1], requests[0][3]
+        st = time.time()
+        try:
+            feature_maps = torch.cat([request[2] for request in requests])
+            images = model.inference(feature_maps, cand_image)
+        except Exception as e:
+            for request in requests:
+                request[4].set_exception(e)
+            return
+        now = time.time()
+        stats = self.batches.setdefault(self._group(requests[0]), [0, 0, 0.0])
+        stats[0] += 1
+        stats[1] += len(requests)
+        stats[2] += now - st
+        for (session, _, _, _, future), image in zip(requests, images):
+            session.lags.append(now - future.deadline)
+            future.set_result(image[None])
+
+    def report(self):
+        lines = []
+        for name, session in self.sessions.items():
+            lags = np.array(session.lags) * 1000
+            if len(lags) == 0:
+                continue
+            lines.append('{}: {} frames, lag mean {:.1f} ms, max {:.1f} ms, {} late'.format(
+                name, len(lags), lags.mean(), lags.max(), int((lags > 0).sum())))
+        for (model, cand, shape), (n, frames, busy) in self.batches.items():
+            lines.append('generator {:x}: {} batches, {:.2f} frames / batch, {:.1f} ms / frame'.format(
+                model, n, frames / n, 1000 * busy / frames))
+        return '\n'.join(lines)
@@ -0,0 +1,101 @@
+import numpy as np
+import torch
+
+
+mouth_points = slice(46, 64)
+
+
+class ROIRenderer(object):
+    ''' Feature2Face on a crop around the mouth while the rest of the head stays
+    put: the feature map only differs from the one of the last full render
+    inside the crop, so the generator runs on the crop and the result is blended
+    onto the last full render with a feathered mask. A full render is done when
+    a landmark outside of the crop or a shoulder point moved more than threshold
+    pixels since the last full render, when the mouth does not fit into the crop,
+    and every full_every frames, so that errors do not build up.
+    The crop size has to be a multiple of 2 ** n_downsample_G (the U-Net's
+    input), its offsets are multiples of align: the deeper levels see less
+    context than in the full frame, check the quality (report) before use.
+    Args:
+        model: Feature2FaceModel, exported backends (see models.backends) are always run full frame
+        threshold(float): largest movement in pixels of a point outside of the crop
+        full_every(int): frames between forced full renders
+        size(int): crop size, default 2 ** n_downsample_G
+        align(int): the crop offsets are multiples of align
+        pad(int): least distance of the mouth landmarks to the crop border
+        feather(int): width in pixels of the blend at the crop border
+    '''
+    def __init__(self, model, threshold=1.0, full_every=30, size=None, align=32, pad=32, feather=16):
+        self.model = model
+        G = getattr(model, 'Feature2Face_G', None)
+        self.enabled = hasattr(getattr(G, 'module', G), 'inference_crop')
+        if size is None:
+            size = 2 ** getattr(getattr(model, 'opt', None), 'n_downsample_G', 8)
+        assert align % 2 == 0 and 2 * (pad + feather) < size
+        self.threshold = threshold
+        self.full_every = full_every
+        self.size = size
+        self.align = align
+        self.pad = pad
+        ramp = np.clip((np.arange(size) + 0.5) / feather, 0, 1)
+        ramp = np.minimum(ramp, ramp[::-1]).astype(np.float32)
+        self.mask = torch.from_numpy(np.outer(ramp, ramp))[None, None]
+        self.base = None       # (landmarks, shoulders, image) of the last full render
+        self.since_full = 0
+        self.full = self.partial = 0
+
+    def reset(self):
+        self.base = None
+
+    def crop(self, landmarks, height, width):
+        ''' (y0, x0) of the crop around the mouth, None if the mouth does not fit '''
+        if height < self.size or width < self.size:
+            return None
+        mouth = landmarks[mouth_points]
+        offsets = []
+        for axis, extent in ((1, height), (0, width)):
+            center = (mouth[:, axis].min() + mouth[:, axis].max()) / 2
+            start = int(round((center - self.size / 2) / self.align)) * self.align
+            start = min(max(start, 0), (extent - self.size) // self.align * self.align)
+            if mouth[:, axis].min() < start + self.pad or mouth[:, axis].max() >= start + self.size - self.pad:
+                return None
+            offsets.append(start)
+        return tuple(offsets)
+
+    def inference(self, feature_map, cand_image, landmarks, shoulders):
+        ''' Feature2Face output [1, 3, H, W] of feature_map [1, input_nc, H, W], drawn
+        from landmarks [73, 2] and shoulders [18, 2] '''
+        window = None
+        if self.enabled and self.base is not None and self.since_full < self.full_every:
+            window = self.crop(landmarks, *feature_map.shape[-2:])
+        if window is not None:
+            base_landmarks, base_shoulders, base_image = self.base
+            y0, x0 = window
+            moved = np.abs(landmarks - base_landmarks).max(axis=1) > self.threshold
+            inside = (landmarks[:, 0] >= x0 + self.pad) & (landmarks[:, 0] < x0 + self.size - self.pad) & \
+                     (landmarks[:, 1] >= y0 + self.pad) & (landmarks[:, 1] < y0 + self.size - self.pad)
+            if np.any(moved & ~inside) or np.abs(shoulders - base_shoulders).max() > self.threshold:
+                window = None
+        if window is None:
+            image = self.model.inference(feature_map, cand_image)
+            if self.enabled:
+                self.base = (np.array(landmarks, copy=True), np.array(shoulders, copy=True), image)
+            self.since_full = 0
+            self.full += 1
+            return image
+
+        y0, x0 = window
+        feature_crop = feature_map[..., y0: y0 + self.size, x0: x0 + self.size]
+        crop = self.model.inference_crop(feature_crop, cand_image, y0, x0)
+        image = base_image.clone()
+        base_crop = image[..., y0: y0 + self.size, x0: x0 + self.size]
+        mask = self.mask.to(device=image.device, dtype=image.dtype)
+        base_crop.copy_(torch.lerp(base_crop, crop.to(image.dtype), mask))
+        self.since_full += 1
+        self.partial += 1
+        return image
+
+    def report(self):
+        total = max(self.full + self.partial, 1)
+        return 'ROI rendering: {} full, {} partial ({:.1f}%) renders, {}x{} crop'.format(
+            self.full, self.partial, 100.0 * self.partial / total, self.size, self.size)
@@ -0,0 +1,190 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+
+_STOP = object()
+
+
+class Stage(object):
+    ''' one step of a StageExecutor.
+    Args:
+        name(str): used in the statistics
+        fn: callable(item) -> item for the next stage
+        workers(int): number of concurrent calls of fn
+        kind(str): 'thread', or 'process' to run fn in a process pool (fn, its
+            items and initargs must be picklable, fn a module level function)
+        initializer, initargs: per-process setup, only for kind == 'process'
+    '''
+    def __init__(self, name, fn, workers=1, kind='thread', initializer=None, initargs=()):
+        assert kind in ('thread', 'process'), kind
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, int(workers))
+        self.kind = kind
+        self.initializer = initializer
+        self.initargs = initargs
+
+
+
+class StageExecutor(object):
+    ''' runs stages concurrently, connected by bounded queues: while one frame is
+    rendered the next ones are drawn and the previous ones encoded. Items leave
+    every stage in input order, also with several workers. Per-stage counters:
+        items     processed items
+        busy      seconds spent in fn
+        starved   seconds waiting for input
+        blocked   seconds waiting for room in the next queue
+        utilization  busy / (wall time * workers)
+    The first exception raised by a stage stops the pipeline and is re-raised by run().
+    '''
+    def __init__(self, stages, maxsize=8):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.counters = OrderedDict()
+        self.wall = 0.0
+
+    def run(self, items):
+        ''' generator over the outputs of the last stage, in input order '''
+        self._abort = threading.Event()
+        self._error = None
+        self.counters = OrderedDict((s.name, {'items': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0})
+                                    for s in self.stages)
+        queues = [queue.Queue(self.maxsize) for _ in range(len(self.stages) + 1)]
+        pools, threads = [], []
+        start = time.time()
+        try:
+            for i, stage in enumerate(self.stages):
+                pool = None
+                if stage.kind == 'process':
+                    pool = ProcessPoolExecutor(stage.workers, initializer=stage.initializer, initargs=stage.initargs)
+                    pools.append(pool)
+                state = {'alive': stage.workers, 'next': 0, 'pending': {}, 'sending': False, 'lock': threading.Lock()}
+                for _ in range(stage.workers):
+                    t = threading.Thread(target=self._work, args=(stage, pool, queues[i], queues[i + 1], state),
+                                         name='stage-' + stage.name, daemon=True)
+                    t.start()
+                    threads.append(t)
+            feeder = threading.Thread(target=self._feed, args=(items, queues[0]), name='stage-feeder', daemon=True)
+            feeder.start()
+            threads.append(feeder)
+
+            while True:
+                item = self._get(queues[-1])
+                if item is _STOP or self._error is not None:
+                    break
+                yield item[1]
+            if self._error is not None:
+                raise self._error
+        finally:
+            self._abort.set()
+            for t in threads:
+                t.join()
+            for pool in pools:
+                pool.shutdown()
+            self.wall = time.time() - start
+
+    def stats(self):
+        stats = OrderedDict()
+        for stage in self.stages:
+            counter = dict(self.counters[stage.name])
+            counter['utilization'] = counter['busy'] / max(self.wall * stage.workers, 1e-9)
+            stats[stage.name] = counter
+        return stats
+
+    def report(self):
+        lines = ['{:<16s}{:>8s}{:>10s}{:>10s}{:>10s}{:>8s}'.format('stage', 'items', 'busy(s)', 'starved', 'blocked', 'util')]
+        for name, c in self.stats().items():
+            lines.append('{:<16s}{:>8d}{:>10.2f}{:>10.2f}{:>10.2f}{:>7.0f}%'.format(
+                name, c['items'], c['busy'], c['starved'], c['blocked'], 100 * c['utilization']))
+        lines.append('wall time: {:.2f}s, sum of stage times: {:.2f}s'.format(
+            self.wall, sum(c['busy'] for c in self.counters.values())))
+        return '\n'.join(lines)
+
+    ############################## internals ##################################
+    def _get(self, q, counter=None, lock=None):
+        st = time.time()
+        while True:
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self._abort.is_set():
+                    item = _STOP
+                    break
+        if counter is not None:
+            with lock:
+                counter['starved'] += time.time() - st
+        return item
+
+    def _put(self, q, item, counter=None, lock=None):
+        st = time.time()
+        while not self._abort.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        if counter is not None:
+            with lock:
+                counter['blocked'] += time.time() - st
+
+    def _fail(self, e):
+        if self._error is None:
+            self._error = e
+        self._abort.set()
+
+    def _feed(self, items, q):
+        try:
+            for seq, item in enumerate(items):
+                if self._abort.is_set():
+                    return
+                self._put(q, (seq, item))
+        except Exception as e:
+            self._fail(e)
+        self._put(q, _STOP)
+
+    def _work(self, stage, pool, q_in, q_out, state):
+        counter, lock = self.counters[stage.name], state['lock']
+        while True:
+            item = self._get(q_in, counter, lock)
+            if item is _STOP:
+                break
+            seq, data = item
+            st = time.time()
+            try:
+                if pool is not None:
+                    result = pool.submit(stage.fn, data).result()
+                else:
+                    result = stage.fn(data)
+            except Exception as e:
+                self._fail(e)
+                break
+            with lock:
+                counter['busy'] += time.time() - st
+                counter['items'] += 1
+                state['pending'][seq] = result
+                if state['sending']:
+                    # the worker handing on passes this one on too
+                    continue
+                state['sending'] = True
+            # hand on in input order, outside of the lock: one worker at a time, the
+            # others keep working while it waits for room in the next queue
+            while True:
+                with lock:
+                    if state['next'] not in state['pending']:
+                        state['sending'] = False
+                        break
+                    ready = (state['next'], state['pending'].pop(state['next']))
+                    state['next'] += 1
+                self._put(q_out, ready, counter, lock)
+
+        # let the sibling workers see the end too; the last one closes the next stage
+        self._put(q_in, _STOP)
+        with lock:
+            state['alive'] -= 1
+            last = state['alive'] == 0
+        if last:
+            self._put(q_out, _STOP)